@@ -0,0 +1,94 @@
+# 广播吞吐基准: 模拟 100 / 1k / 10k 个在线连接, 比较逐个 push_data 与广播引擎每秒可完成的公共消息数
+# burst 列为同一轮事件循环里连续广播 BURST 条消息时的吞吐 (发送队列把它们合并成一次 write)
+# 运行: python -m bench.bench_broadcast
+import asyncio
+import logging
+import os
+import time
+from classes.server import Server
+from classes.broadcast import broadcast
+from struct import pack
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from utils.protocols import SessionCipher, encode_data
+
+logging.disable(logging.CRITICAL)
+
+ROOM_SIZES = [100, 1000, 10000]
+BURST = 10
+MESSAGE = '公共聊天基准消息 public room benchmark message'
+
+
+class DummyWriter:
+    def __init__(self):
+        self.bytes = 0
+        self.transport = self
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 0)
+
+    def write(self, data):
+        self.bytes += len(data)
+
+    def close(self):
+        pass
+
+
+def make_peers(n):
+    peers = []
+    for i in range(n):
+        server = Server(None, DummyWriter(), None, None)
+        server.username = f'user{i}'
+        server.cipher = SessionCipher(os.urandom(32), 0, 0)
+        server.handshake = True
+        server.login = True
+        server.outbound.start(server.cipher)
+        peers.append(server)
+    return peers
+
+
+def legacy_send_everyone(peers, keys, data):  # 原实现: 每个连接重新构造字典, 序列化并新建 AESGCM
+    for i, server in enumerate(peers):
+        frame = encode_data({'type': 'send_everyone', 'data': dict(data)})
+        frame = AESGCM(keys[i]).encrypt(pack('>Q', i), frame, None)
+        server.writer.write(pack('>I', len(frame)) + frame)
+
+
+async def broadcast_and_flush(peers, data, burst=1):  # 广播并等待所有发送队列加密、写出
+    for _ in range(burst):
+        await broadcast(peers, 'send_everyone', data)
+    while any(server.outbound.frames for server in peers):
+        await asyncio.sleep(0)
+
+
+def run(n, rounds):
+    peers = make_peers(n)
+    keys = [os.urandom(32) for _ in range(n)]
+    data = {'from': 'sender', 'message': MESSAGE}
+    loop = asyncio.get_event_loop()
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        legacy_send_everyone(peers, keys, data)
+    legacy = rounds / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        loop.run_until_complete(broadcast_and_flush(peers, data))
+    engine = rounds / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(max(1, rounds // BURST)):
+        loop.run_until_complete(broadcast_and_flush(peers, data, BURST))
+    burst = max(1, rounds // BURST) * BURST / (time.perf_counter() - start)
+    return legacy, engine, burst
+
+
+if __name__ == '__main__':
+    print(f'{"peers":>8} {"legacy msg/s":>14} {"engine msg/s":>14} {"burst msg/s":>14} {"speedup":>8}')
+    for n in ROOM_SIZES:
+        rounds = max(BURST, 20000 // n)
+        legacy, engine, burst = run(n, rounds)
+        print(f'{n:>8} {legacy:>14.1f} {engine:>14.1f} {burst:>14.1f} {engine / legacy:>7.2f}x')
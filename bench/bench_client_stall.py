@@ -0,0 +1,121 @@
+# 客户端事件循环的卡顿: 界面和网络共用一个事件循环, 每 16 ms 一帧; 测量一批推送到达时每一帧比预定时间晚多少
+#   --peers 个用户 (在独立进程里) 同时向目标用户发起私聊 DH, 协商完成后各发 --messages 条私聊
+#   inline    原来的做法, DH 在推送回调里直接计算, read_loop 一直处理到缓冲区读空
+#   offload   DH 和签名在 make_crypto_executor() 创建的 executor 里计算 (cryptography 为线程, python 为进程),
+#             read_loop 每 Client.read_slice 秒让出一次事件循环
+# 运行: python -m bench.bench_client_stall --peers 200 --messages 5 --provider cryptography
+import argparse
+import asyncio
+import time
+from bench.common import load_bench_keys, spawn_server, stop_server, run_client_processes, wait_barrier, percentile
+from classes.client import get_client, make_crypto_executor
+from utils import crypto
+
+FRAME = 0.016
+
+
+async def peer_main(index, args, barrier):
+    crypto.set_provider(args.provider)
+    keys = load_bench_keys()
+    clients = []
+    for i in range(args.peers // args.procs):
+        client = await get_client('127.0.0.1', args.port, keys['server_public'])
+        username = f'{args.target}_{index}_{i}'
+        await client.send_register(keys['user_public'], username)
+        await client.send_login(keys['user_private'], username)
+        listener = asyncio.ensure_future(client.start_listen({}))
+        listener.add_done_callback(lambda task: task.cancelled() or task.exception())
+        clients.append((client, listener))
+    await wait_barrier(barrier)
+    for client, _ in clients:
+        for i in range(args.messages):
+            client.send_to_user(args.target, f'message {i}')  # 没有密钥时发起 DH, 消息排队
+    deadline = time.perf_counter() + 60
+    while any(client.outbox for client, _ in clients) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.5)
+    for client, listener in clients:
+        listener.cancel()
+        await client.close()
+    return True
+
+
+async def frames(stop, lateness):  # 模拟界面的帧: 记录每一帧比预定时间晚多少
+    next_frame = time.perf_counter()
+    while not stop.is_set():
+        next_frame += FRAME
+        await asyncio.sleep(max(0.0, next_frame - time.perf_counter()))
+        late = time.perf_counter() - next_frame
+        lateness.append(late)
+        if late > FRAME:
+            next_frame = time.perf_counter()  # 错过的帧不补
+
+
+async def run(args, keys, mode):
+    loop = asyncio.get_event_loop()
+    args.target = f'stall_{mode}'
+    client = await get_client('127.0.0.1', args.port, keys['server_public'])
+    if mode == 'offload':
+        client.crypto_executor = make_crypto_executor()
+    else:
+        client.read_slice = None
+    await client.send_register(keys['user_public'], args.target)
+    await client.send_login(keys['user_private'], args.target)
+    received = []
+    expected = args.peers // args.procs * args.procs * args.messages
+    done = loop.create_future()
+
+    def on_message(client, response):
+        received.append(response)
+        if len(received) == expected and not done.done():
+            done.set_result(time.perf_counter())
+
+    listener = asyncio.ensure_future(client.start_listen({'send_user': on_message}))
+    listener.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    stop = asyncio.Event()
+    lateness = []
+    peers = loop.run_in_executor(None, run_client_processes, peer_main, args.procs, args)
+    while not client.user_dh_keys:  # 第一个 DH 请求到达时开始计时
+        await asyncio.sleep(0.001)
+    start = time.perf_counter()
+    frame_task = asyncio.ensure_future(frames(stop, lateness))
+    try:
+        finished = await asyncio.wait_for(done, 120)
+    except asyncio.TimeoutError:
+        finished = time.perf_counter()
+    stop.set()
+    await frame_task
+    await peers
+    listener.cancel()
+    await client.close()
+    if client.crypto_executor is not None:
+        client.crypto_executor.shutdown()
+    return finished - start, len(received), expected, lateness
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--peers', type=int, default=200, help='同时发起 DH 的用户数')
+    parser.add_argument('--messages', type=int, default=5, help='每个用户协商完成后发送的私聊数')
+    parser.add_argument('--procs', type=int, default=1, help='运行这些用户的进程数')
+    parser.add_argument('--provider', choices=list(crypto.PROVIDERS), default=crypto.DEFAULT_PROVIDER)
+    parser.add_argument('--port', type=int, default=19986)
+    parser.add_argument('--modes', nargs='+', default=['inline', 'offload'])
+    args = parser.parse_args()
+    crypto.set_provider(args.provider)
+
+    keys = load_bench_keys()
+    server = spawn_server(args.port)
+    try:
+        print(f'{args.provider} provider, {args.peers} peers start DH at once, then send {args.messages} messages each; '
+              f'frame every {FRAME * 1000:.0f} ms')
+        print(f'{"mode":<8} {"total ms":>9} {"received":>9} {"frames":>7} {"late p50":>9} {"late p99":>9} '
+              f'{"max stall":>10} {">50ms":>6}')
+        for mode in args.modes:
+            total, received, expected, lateness = asyncio.get_event_loop().run_until_complete(run(args, keys, mode))
+            print(f'{mode:<8} {total * 1000:>9.0f} {f"{received}/{expected}":>9} {len(lateness):>7} '
+                  f'{percentile(lateness, 50) * 1000:>9.1f} {percentile(lateness, 99) * 1000:>9.1f} '
+                  f'{max(lateness, default=0) * 1000:>10.1f} {sum(late > 0.05 for late in lateness):>6}')
+    finally:
+        stop_server(server)
@@ -0,0 +1,115 @@
+# 集群模式 (broker_main.py + 多个 server_main.py 节点) 的测量:
+# 1. 私聊从 0 号节点投递到各节点上的用户的延迟, 0 号节点本地投递作为对照
+# 2. 上线/下线通知传播到所有节点的时间 (在线状态收敛时间)
+# 运行: python -m bench.bench_cluster --nodes 3
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from bench.common import load_bench_keys, spawn_server_main, spawn_broker, percentile
+from classes.client import get_client
+
+
+class Observer():
+    # 直接读取推送帧, 记录每条推送到达的时间
+    def __init__(self, client):
+        self.client = client
+        self.arrivals = dict()  # (type, username) -> 到达时间
+        self.latencies = []
+        self.task = asyncio.ensure_future(self.listen())
+
+    async def listen(self):
+        while True:
+            response = await self.client.get_response()
+            now = time.perf_counter()
+            if response.get('type') in ('online', 'offline'):
+                self.arrivals[(response['type'], response['data'])] = now
+            elif response.get('type') == 'presence':  # 协议版本 4 起上下线合并推送
+                for req_type in ('online', 'offline'):
+                    for username in response['data'][req_type]:
+                        self.arrivals[(req_type, username)] = now
+            elif response.get('type') == 'send_user':
+                self.latencies.append(now - float(response['data']['iv']))
+
+
+async def login(keys, port, username):
+    client = await get_client('127.0.0.1', port, keys['server_public'])
+    await client.send_register(keys['user_public'], username)
+    await client.send_login(keys['user_private'], username)
+    return client
+
+
+async def wait_arrivals(observers, key, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while not all(key in observer.arrivals for observer in observers):
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f'{key} 没有传播到所有节点')
+        await asyncio.sleep(0.0005)
+    return max(observer.arrivals[key] for observer in observers)
+
+
+async def measure(args, ports):
+    keys = load_bench_keys()
+    sender = await login(keys, ports[0], 'cluster_sender')
+    observers = [Observer(await login(keys, port, f'observer_{i}')) for i, port in enumerate(ports)]
+    await asyncio.sleep(0.5)
+
+    for _ in range(args.messages):
+        for i in range(len(ports)):
+            sender.send_request('send_user', {'username': f'observer_{i}', 'iv': str(time.perf_counter()),
+                                              'ciphertext': ''})
+        await sender.get_response()
+        await asyncio.sleep(args.interval)
+    await asyncio.sleep(0.5)
+    delivery = [observer.latencies for observer in observers]
+
+    online, offline = [], []
+    remote = observers[1:]
+    for i in range(args.rounds):
+        username = f'probe_{i}'
+        await asyncio.sleep(0.1)  # 在线状态的两批推送至少间隔一个 tick, 测量空闲时的传播时间
+        probe = await get_client('127.0.0.1', ports[0], keys['server_public'])
+        await probe.send_register(keys['user_public'], username)
+        await probe.send_login(keys['user_private'], username)
+        start = time.perf_counter()
+        online.append(await wait_arrivals(remote, ('online', username)) - start)
+
+        await asyncio.sleep(0.1)
+        probe.writer.close()
+        start = time.perf_counter()
+        offline.append(await wait_arrivals(remote, ('offline', username)) - start)
+
+    for observer in observers:
+        observer.task.cancel()
+    return delivery, online, offline
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--messages', type=int, default=300, help='发给每个节点上用户的私聊数')
+    parser.add_argument('--interval', type=float, default=0.005)
+    parser.add_argument('--rounds', type=int, default=50, help='上线/下线的测量次数')
+    parser.add_argument('--port', type=int, default=19870, help='broker 端口, 节点依次使用之后的端口')
+    args = parser.parse_args()
+
+    db = os.path.join(tempfile.mkdtemp(prefix='chat_bench_'), 'user.db')  # 所有节点共用一个用户数据库
+    broker = spawn_broker(args.port)
+    ports = [args.port + 1 + i for i in range(args.nodes)]
+    nodes = [spawn_server_main(port, '--broker', f'tcp:127.0.0.1:{args.port}', '--node-id', f'node{i}',
+                               '--crypto-workers', 0, '--db', f'sqlite:///{db}') for i, port in enumerate(ports)]
+    try:
+        delivery, online, offline = asyncio.get_event_loop().run_until_complete(measure(args, ports))
+    finally:
+        for process in nodes + [broker]:
+            process.terminate()
+            process.wait()
+
+    print(f'{"send_user node0 ->":<22}{"p50 ms":>10}{"p99 ms":>10}')
+    for i, latencies in enumerate(delivery):
+        name = f'node{i}' + (' (local)' if i == 0 else '')
+        print(f'{name:<22}{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}')
+    print(f'\n{"presence convergence":<22}{"p50 ms":>10}{"p99 ms":>10}')
+    for name, values in (('online', online), ('offline', offline)):
+        print(f'{name:<22}{percentile(values, 50) * 1000:>10.2f}{percentile(values, 99) * 1000:>10.2f}')
@@ -0,0 +1,80 @@
+# 逐连接压缩的效果: 模拟服务器推送给一个客户端的消息流, 比较压缩后的字节数和压缩/解压耗时
+#   per-frame  每帧单独 zlib.compress, 没有跨帧的历史
+#   stream     每个方向一个 deflate 流 (FrameCompressor), 不同的级别和阈值
+# 运行: python -m bench.bench_compression --frames 20000
+import argparse
+import os
+import random
+import time
+import zlib
+from utils.protocols import JSON_CODEC, BINARY_CODEC, FrameCompressor, FrameDecompressor
+
+WORDS = ('今天', '晚上', '一起', '吃饭', '开会', '明天', '项目', '进度', '好的', '收到', '哈哈', '周末',
+         'ok', 'lol', 'see', 'you', 'tomorrow', 'meeting', 'deploy', 'done', 'thanks', 'review')
+
+
+def traffic(count, seed=1):  # 公共聊天为主, 夹杂上下线和端到端加密的私聊 (密文不可压缩)
+    rng = random.Random(seed)
+    users = [f'user_{i:03d}' for i in range(200)]
+    frames = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.7:
+            message = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 30)))
+            frames.append({'type': 'send_everyone', 'data': {'from': rng.choice(users), 'message': message}})
+        elif kind < 0.85:
+            frames.append({'type': rng.choice(('online', 'offline')), 'data': rng.choice(users)})
+        else:
+            frames.append({'type': 'send_user', 'data': {'from': rng.choice(users), 'iv': os.urandom(16),
+                                                         'ciphertext': os.urandom(16 * rng.randint(1, 20))}})
+    return frames
+
+
+def per_frame(payloads):
+    start = time.perf_counter()
+    compressed = [zlib.compress(payload, 6) for payload in payloads]
+    compress_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for data in compressed:
+        zlib.decompress(data)
+    return sum(map(len, compressed)), compress_time, time.perf_counter() - start
+
+
+def stream(payloads, level, threshold):
+    compressor = FrameCompressor(level, threshold)
+    decompressor = FrameDecompressor()
+    start = time.perf_counter()
+    compressed = [compressor.compress(payload) for payload in payloads]
+    compress_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for data in compressed:
+        decompressor.decompress(data)
+    return sum(map(len, compressed)), compress_time, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=20000)
+    args = parser.parse_args()
+
+    frames = traffic(args.frames)
+    print(f'{"codec":<8}{"mode":<24}{"bytes/frame":>12}{"ratio":>8}{"comp us":>9}{"decomp us":>11}')
+    for codec in (JSON_CODEC, BINARY_CODEC):
+        payloads = [codec.encode(frame) for frame in frames]
+        raw = sum(map(len, payloads))
+        results = [('none', (raw, 0.0, 0.0)), ('per-frame level 6', per_frame(payloads))]
+        for level, threshold in ((1, 32), (6, 0), (6, 32), (6, 128), (6, 512), (9, 32)):
+            results.append((f'stream level {level} >={threshold}B', stream(payloads, level, threshold)))
+        for name, (size, compress_time, decompress_time) in results:
+            print(f'{codec.name:<8}{name:<24}{size / len(frames):>12.1f}{size / raw:>8.3f}'
+                  f'{compress_time / len(frames) * 1e6:>9.2f}{decompress_time / len(frames) * 1e6:>11.2f}')
+
+    decompressor = FrameDecompressor(1024 * 1024)
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -12)
+    bomb = b'\x01' + compressor.compress(b'\0' * (1 << 30)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    start = time.perf_counter()
+    try:
+        decompressor.decompress(bomb)
+    except ValueError:
+        pass
+    print(f'\n{len(bomb)} 字节的压缩炸弹 (解压后 1GB) 在 {(time.perf_counter() - start) * 1000:.2f} ms 内被拒绝')
@@ -0,0 +1,67 @@
+# 密码学实现对比: 纯 Python (rsa + pow) 与 cryptography (OpenSSL) 在握手、登录、生成密钥上的耗时
+# 运行: python -m bench.bench_crypto
+import time
+from base64 import b64encode
+from struct import pack
+from classes import crypto_pool
+from utils import crypto
+from utils.tools import random_string
+
+ROUNDS = 20
+KEYGEN_ROUNDS = 2
+
+
+def measure(func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def run(provider_name):
+    provider = crypto.set_provider(provider_name)
+    server_public, server_private = provider.newkeys(2048)
+    user_public, user_private = provider.newkeys(2048)
+    crypto_pool._private_key = server_private
+
+    def client_handshake():
+        crypto.encrypt(pack('>Q', 1), server_public)
+        crypto.encrypt(pack('>Q', 2), server_public)
+        dh_private = crypto.dh_gen_private()
+        dh_public = crypto.dh_get_public(dh_private).to_bytes(233, 'big')
+        crypto.encrypt(dh_public, server_public)
+        return dh_private, dh_public
+
+    dh_private, dh_public = client_handshake()
+    request = (crypto.encrypt(dh_public, server_public),
+               crypto.encrypt(pack('>Q', 1), server_public),
+               crypto.encrypt(pack('>Q', 2), server_public))
+
+    def server_handshake():
+        crypto_pool.server_handshake(*request)
+
+    server_dh_public, sign, _, _, _ = crypto_pool.server_handshake(*request)
+
+    def client_finish():
+        crypto.verify(server_dh_public, sign, server_public)
+        crypto.dh_get_common_key(dh_private, int.from_bytes(server_dh_public, 'big'))
+
+    challenge = random_string().encode()
+    login_sign = crypto.sign(challenge, user_private)
+
+    return {
+        'client handshake': measure(client_handshake, ROUNDS) + measure(client_finish, ROUNDS),
+        'server handshake': measure(server_handshake, ROUNDS),
+        'login sign (client)': measure(lambda: b64encode(crypto.sign(challenge, user_private)), ROUNDS),
+        'login verify (server)': measure(lambda: crypto.verify(challenge, login_sign, user_public), ROUNDS),
+        'keygen 2048': measure(lambda: crypto.newkeys(2048), KEYGEN_ROUNDS)
+    }
+
+
+if __name__ == '__main__':
+    results = {name: run(name) for name in crypto.PROVIDERS}
+    names = list(results)
+    print(f'{"ms/op":<24}' + ''.join(f'{name:>14}' for name in names) + f'{"speedup":>10}')
+    for op in results[names[0]]:
+        row = [results[name][op] for name in names]
+        print(f'{op:<24}' + ''.join(f'{value:>14.2f}' for value in row) + f'{row[0] / row[-1]:>9.1f}x')
@@ -0,0 +1,100 @@
+# 握手基准:
+# 1. 不同 --workers (握手进程池大小) 下服务器每秒能完成的握手数
+# 2. 连接风暴 (--storm 个客户端同时握手) 期间, 两个已登录用户之间公共消息的投递延迟
+# 运行: python -m bench.bench_handshake --workers 0 1 2 4 --storm 1000 --provider python
+import argparse
+import asyncio
+import threading
+import time
+from bench.common import load_bench_keys, spawn_server, stop_server, run_client_processes, wait_barrier, percentile
+from classes.client import get_client
+from utils import crypto
+
+
+async def connect_many(index, args, barrier):
+    crypto.set_provider(args.provider)
+    keys = load_bench_keys()
+    await wait_barrier(barrier)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def connect():
+        async with semaphore:
+            client = await get_client('127.0.0.1', args.port, keys['server_public'])
+            client.writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[connect() for _ in range(args.handshakes // args.procs)])
+    return args.handshakes // args.procs, time.perf_counter() - start
+
+
+def handshake_rate(args, workers):
+    server = spawn_server(args.port, args.provider, crypto_workers=workers)
+    results = run_client_processes(connect_many, args.procs, args)
+    stop_server(server)
+    return sum(result[0] for result in results) / max(result[1] for result in results)
+
+
+async def chat_latency_during_storm(args, workers):
+    keys = load_bench_keys()
+    server = spawn_server(args.port, args.provider, crypto_workers=workers)
+
+    sender = await get_client('127.0.0.1', args.port, keys['server_public'])
+    receiver = await get_client('127.0.0.1', args.port, keys['server_public'])
+    for client, username in ((sender, 'probe_sender'), (receiver, 'probe_receiver')):
+        await client.send_register(keys['user_public'], username)
+        await client.send_login(keys['user_private'], username)
+
+    latencies = []
+
+    def on_message(client, response):
+        latencies.append(time.perf_counter() - float(response['data']['message']))
+
+    listeners = [
+        asyncio.ensure_future(sender.start_listen({})),
+        asyncio.ensure_future(receiver.start_listen({'send_everyone': on_message}))
+    ]
+
+    storm_args = argparse.Namespace(**vars(args))
+    storm_args.handshakes = args.storm
+    done = threading.Event()
+
+    def storm():
+        run_client_processes(connect_many, args.procs, storm_args)
+        done.set()
+
+    threading.Thread(target=storm, daemon=True).start()
+    start = time.perf_counter()
+    while not done.is_set():
+        sender.send_to_everyone(str(time.perf_counter()))
+        await asyncio.sleep(0.02)
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0.5)
+
+    for task in listeners:
+        task.cancel()
+    stop_server(server)
+    return elapsed, latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--handshakes', type=int, default=200)
+    parser.add_argument('--storm', type=int, default=1000)
+    parser.add_argument('--procs', type=int, default=4, help='客户端进程数')
+    parser.add_argument('--concurrency', type=int, default=50, help='每个客户端进程同时进行的握手数')
+    parser.add_argument('--provider', choices=list(crypto.PROVIDERS), default=crypto.DEFAULT_PROVIDER)
+    parser.add_argument('--port', type=int, default=19991)
+    args = parser.parse_args()
+    crypto.set_provider(args.provider)
+
+    print(f'{"workers":>8} {"handshakes/s":>13}')
+    for workers in args.workers:
+        print(f'{workers:>8} {handshake_rate(args, workers):>13.1f}')
+
+    print(f'\n{"workers":>8} {"storm":>6} {"storm s":>8} {"chat p50 ms":>12} {"chat p99 ms":>12} {"chat max ms":>12}')
+    loop = asyncio.get_event_loop()
+    for workers in args.workers:
+        elapsed, latencies = loop.run_until_complete(chat_latency_during_storm(args, workers))
+        print(f'{workers:>8} {args.storm:>6} {elapsed:>8.1f} {percentile(latencies, 50) * 1000:>12.1f} '
+              f'{percentile(latencies, 99) * 1000:>12.1f} {max(latencies) * 1000:>12.1f}')
@@ -0,0 +1,120 @@
+# 公共聊天历史基准:
+# 1. 环形缓冲本身: 写满 --capacity 条 --size 字节的消息并继续覆盖时的写入速率, 取一页最新消息的时间
+#    (直接复制原始记录, 对比逐条解析成 dict), 以及重新打开文件的时间
+# 2. 经过服务器: 先发 --capacity 条公共消息, 再测量新用户从发出登录请求到收齐登录时推送的历史的时间
+#    和一直向前翻页取完全部历史的时间
+# 运行: python -m bench.bench_history --capacity 1000 10000 --login 200
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from bench.common import load_bench_keys, spawn_server, stop_server, percentile
+from classes.client import get_client
+from utils.history_ring import HistoryRing, iter_records
+
+
+def bench_ring(args):
+    print(f'ring: {args.size}-byte messages, page of {args.login}')
+    print(f'{"capacity":>8} {"append/s":>10} {"page us":>8} {"page KiB":>8} {"decode us":>9} {"reopen ms":>9}')
+    message = 'x' * args.size
+    for capacity in args.capacity:
+        path = os.path.join(tempfile.mkdtemp(prefix='chat_bench_history_'), 'history.ring')
+        ring = HistoryRing(path, capacity, capacity * (args.size + 64))
+        ring.open()
+        count = capacity * 3  # 转两圈以上, 包括覆盖和 wrap
+        start = time.perf_counter()
+        for i in range(count):
+            ring.append(f'user{i % 100}', message)
+        append = count / (time.perf_counter() - start)
+
+        pages = []
+        decodes = []
+        for _ in range(200):
+            start = time.perf_counter()
+            first, records, more = ring.page(None, args.login)
+            pages.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            [{'seq': seq, 'timestamp': ts, 'from': sender, 'message': text}
+             for seq, ts, sender, text in iter_records(records)]
+            decodes.append(time.perf_counter() - start)
+        ring.close()
+
+        start = time.perf_counter()
+        ring = HistoryRing(path, capacity, capacity * (args.size + 64))
+        ring.open()
+        reopen = time.perf_counter() - start
+        assert ring.messages == capacity, ring.stats()
+        ring.close()
+        shutil.rmtree(os.path.dirname(path))
+        print(f'{capacity:>8} {append:>10.0f} {percentile(pages, 50) * 1e6:>8.1f} {len(records) / 1024:>8.1f} '
+              f'{percentile(decodes, 50) * 1e6:>9.1f} {reopen * 1000:>9.2f}')
+
+
+async def server_run(args, keys, port, capacity):
+    sender = await get_client('127.0.0.1', port, keys['server_public'])
+    await sender.send_register(keys['user_public'], 'history_sender')
+    await sender.send_login(keys['user_private'], 'history_sender')
+    message = 'x' * args.size
+    for i in range(0, capacity, 100):  # 每 100 条等一次响应, 不让发送队列溢出
+        for _ in range(min(99, capacity - i - 1)):
+            sender.send_to_everyone(message)
+        await sender.send_request_with_res('send_everyone', {'message': message})
+
+    results = []
+    for i in range(args.rounds):
+        client = await get_client('127.0.0.1', port, keys['server_public'])
+        username = f'history_reader{i}'
+        await client.send_register(keys['user_public'], username)
+        start = time.perf_counter()
+        await client.send_login(keys['user_private'], username)
+        while True:
+            response = await client.get_response()
+            if response is not None and response.get('type') == 'history':
+                break
+        login = time.perf_counter() - start
+        received = sum(1 for _ in iter_records(response['data']['records']))
+        data = response['data']
+        while data['more']:  # 翻页取完全部历史
+            response = await client.send_request_with_res('history', {'before': data['first'], 'limit': args.login})
+            data = response['data']
+            received += sum(1 for _ in iter_records(data['records']))
+        results.append((login, time.perf_counter() - start, received))
+        await client.close()
+    await sender.close()
+    return results
+
+
+def bench_server(args):
+    keys = load_bench_keys()
+    loop = asyncio.get_event_loop()
+    print(f'\nserver: login pushes the latest {args.login} messages, older pages requested with history')
+    print(f'{"capacity":>8} {"login+history ms":>17} {"all pages ms":>13} {"messages":>9}')
+    for index, capacity in enumerate(args.capacity):
+        port = args.port + index
+        server = spawn_server(port, history={'max_messages': capacity, 'max_bytes': capacity * (args.size + 64),
+                                             'login_messages': args.login})
+        try:
+            results = loop.run_until_complete(server_run(args, keys, port, capacity))
+        finally:
+            stop_server(server)
+        logins = [login for login, _, _ in results]
+        totals = [total for _, total, _ in results]
+        print(f'{capacity:>8} {percentile(logins, 50) * 1000:>17.1f} {percentile(totals, 50) * 1000:>13.1f} '
+              f'{results[0][2]:>9}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capacity', type=int, nargs='+', default=[1000, 10000], help='保存的消息数')
+    parser.add_argument('--size', type=int, default=100, help='每条消息的字符数')
+    parser.add_argument('--login', type=int, default=200, help='登录时推送 (以及每次翻页) 的消息数')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--port', type=int, default=19984)
+    parser.add_argument('--skip-ring', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_ring:
+        bench_ring(args)
+    bench_server(args)
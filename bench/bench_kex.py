@@ -0,0 +1,75 @@
+# 两种握手方式的对比: 客户端测得的建立连接延迟, 以及服务器每次握手消耗的 CPU 时间
+#   dh      RSA 加密的 1536 位有限域 DH (纯 Python 实现与 cryptography 实现各测一次)
+#   x25519  X25519 + RSA-PSS 签名
+# 运行: python -m bench.bench_kex --connects 200 --storm 400
+import argparse
+import asyncio
+import time
+from bench.common import load_bench_keys, spawn_server, stop_server, run_client_processes, wait_barrier, \
+    percentile, process_cpu_time
+from classes.client import get_client
+from utils import crypto
+
+MODES = [
+    ('python', crypto.KEX_DH),
+    ('cryptography', crypto.KEX_DH),
+    ('cryptography', crypto.KEX_X25519)
+]
+
+
+async def connect_latency(args, kex):
+    keys = load_bench_keys()
+    latencies = []
+    for _ in range(args.connects):
+        start = time.perf_counter()
+        client = await get_client('127.0.0.1', args.port, keys['server_public'], kex)
+        latencies.append(time.perf_counter() - start)
+        client.writer.close()
+    return latencies
+
+
+async def connect_many(index, args, barrier):
+    crypto.set_provider(args.provider)
+    keys = load_bench_keys()
+    await wait_barrier(barrier)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def connect():
+        async with semaphore:
+            client = await get_client('127.0.0.1', args.port, keys['server_public'], args.kex)
+            client.writer.close()
+
+    await asyncio.gather(*[connect() for _ in range(args.storm // args.procs)])
+    return args.storm // args.procs
+
+
+def run(args, provider, kex):
+    crypto.set_provider(provider)
+    server = spawn_server(args.port, provider, crypto_workers=0)  # 握手全部在服务器主进程里计算
+    loop = asyncio.get_event_loop()
+    latencies = loop.run_until_complete(connect_latency(args, kex))
+
+    storm_args = argparse.Namespace(**vars(args))
+    storm_args.provider = provider
+    storm_args.kex = kex
+    cpu = process_cpu_time(server.pid)
+    handshakes = sum(run_client_processes(connect_many, args.procs, storm_args))
+    cpu = process_cpu_time(server.pid) - cpu
+    stop_server(server)
+    return latencies, cpu / handshakes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connects', type=int, default=200, help='逐个建立连接测延迟的次数')
+    parser.add_argument('--storm', type=int, default=400, help='测服务器 CPU 时并发握手的总数')
+    parser.add_argument('--procs', type=int, default=4, help='客户端进程数')
+    parser.add_argument('--concurrency', type=int, default=50, help='每个客户端进程同时进行的握手数')
+    parser.add_argument('--port', type=int, default=19993)
+    args = parser.parse_args()
+
+    print(f'{"provider":<14}{"kex":<8}{"connect p50 ms":>16}{"connect p99 ms":>16}{"server cpu ms":>15}')
+    for provider, kex in MODES:
+        latencies, cpu = run(args, provider, kex)
+        print(f'{provider:<14}{kex:<8}{percentile(latencies, 50) * 1000:>16.2f}'
+              f'{percentile(latencies, 99) * 1000:>16.2f}{cpu * 1000:>15.2f}')
@@ -0,0 +1,89 @@
+# 预生成 DH 密钥池的效果:
+# 1. 生成一个服务器 DH 公钥的耗时: pow() 与生成元 2 的窗口表
+# 2. 握手关键路径上服务器的计算耗时: 现场生成并签名 与 从池中取出
+# 3. 逐个建立 DH 握手连接时客户端测得的延迟: 关闭与开启密钥池
+# 运行: python -m bench.bench_keypool --connects 200
+import argparse
+import asyncio
+import secrets
+import time
+from struct import pack
+from bench.common import load_bench_keys, spawn_server, stop_server, percentile
+from classes import crypto_pool
+from classes.client import get_client
+from utils import crypto
+from utils.tools import DH, FixedBasePow
+
+ROUNDS = 50
+
+
+def measure(func, rounds=ROUNDS):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def generation():
+    bits = crypto_pool.KEYPOOL_EXPONENT_BITS
+    start = time.perf_counter()
+    fixed_base = FixedBasePow(DH.DH_GENERATOR, DH.DH_PRIME, bits)
+    build = (time.perf_counter() - start) * 1000
+    short = secrets.randbits(bits)
+    full = secrets.randbelow(DH.DH_PRIME)
+    print(f'{"dh public ms/op":<36}')
+    print(f'{"pow(), 1536-bit exponent":<36}{measure(lambda: pow(2, full, DH.DH_PRIME)):>10.3f}')
+    print(f'{f"pow(), {bits}-bit exponent":<36}{measure(lambda: pow(2, short, DH.DH_PRIME)):>10.3f}')
+    print(f'{f"fixed-base table, {bits}-bit exponent":<36}{measure(lambda: fixed_base.pow(short)):>10.3f}')
+    print(f'{"build table (once per process)":<36}{build:>10.3f}')
+
+
+def critical_path(provider):
+    crypto.set_provider(provider)
+    keys = load_bench_keys()
+    crypto_pool._private_key = keys['server_private']
+    dh_public = crypto.dh_get_public(crypto.dh_gen_private()).to_bytes(233, 'big')
+    request = (crypto.encrypt(dh_public, keys['server_public']),
+               crypto.encrypt(pack('>Q', 1), keys['server_public']),
+               crypto.encrypt(pack('>Q', 2), keys['server_public']))
+    entries = crypto_pool.generate_dh_entries(ROUNDS)
+    inline = measure(lambda: crypto_pool.server_handshake(*request))
+    pooled = measure(lambda: crypto_pool.server_handshake(*request, entries.pop()))
+    return inline, pooled
+
+
+async def connect_latency(args):
+    keys = load_bench_keys()
+    latencies = []
+    for _ in range(args.connects):
+        start = time.perf_counter()
+        client = await get_client('127.0.0.1', args.port, keys['server_public'], crypto.KEX_DH)
+        latencies.append(time.perf_counter() - start)
+        client.writer.close()
+        await asyncio.sleep(args.interval)  # 连接之间留出空闲, 密钥池在后台补充
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--provider', choices=list(crypto.PROVIDERS), default=crypto.DEFAULT_PROVIDER)
+    parser.add_argument('--connects', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.02, help='两次连接之间的间隔秒数')
+    parser.add_argument('--port', type=int, default=19994)
+    args = parser.parse_args()
+
+    generation()
+
+    print(f'\n{"server handshake ms/op":<24}{"inline":>10}{"keypool":>10}')
+    for provider in crypto.PROVIDERS:
+        inline, pooled = critical_path(provider)
+        print(f'{provider:<24}{inline:>10.2f}{pooled:>10.2f}')
+
+    crypto.set_provider(args.provider)
+    print(f'\n{args.provider + " dh connect":<24}{"p50 ms":>10}{"p99 ms":>10}')
+    for name, size in (('inline', (0, 0)), ('keypool', (16, 1024))):
+        server = spawn_server(args.port, crypto_workers=0, dh_keypool=size)
+        time.sleep(1)
+        latencies = asyncio.get_event_loop().run_until_complete(connect_latency(args))
+        stop_server(server)
+        print(f'{name:<24}{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}')
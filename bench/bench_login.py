@@ -0,0 +1,57 @@
+# 注册/登录风暴基准: 服务器运行在独立进程, 多个客户端进程先各自建立已握手的连接,
+# 再同时注册并登录, 统计登录请求 (login, 不含客户端签名) 的延迟分位数
+# 运行: python -m bench.bench_login --clients 400 --procs 4 --db-workers 4
+import argparse
+import asyncio
+import time
+from base64 import b64encode
+from bench.common import load_bench_keys, spawn_server, stop_server, run_client_processes, wait_barrier, percentile
+from classes.client import get_client
+from utils import crypto
+
+
+async def register_and_login(client, keys, username, latencies):
+    await client.send_register(keys['user_public'], username)
+    res = await client.send_request_with_res('get_challenge')
+    sign = crypto.sign(res['data']['challenge'].encode(), keys['user_private'])
+    data = {
+        'sign': b64encode(sign).decode(),
+        'username': username
+    }
+    start = time.perf_counter()
+    res = await client.send_request_with_res('login', data)
+    latencies.append(time.perf_counter() - start)
+    return res['success']
+
+
+async def storm(index, args, barrier):
+    keys = load_bench_keys()
+    clients = []
+    for _ in range(args.clients // args.procs):  # 握手不计入登录延迟
+        clients.append(await get_client('127.0.0.1', args.port, keys['server_public']))
+    await wait_barrier(barrier)
+
+    latencies = []
+    results = await asyncio.gather(*[
+        register_and_login(client, keys, f'bench{index:02d}{i:06d}', latencies) for i, client in enumerate(clients)
+    ])
+    return sum(results), latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=400)
+    parser.add_argument('--procs', type=int, default=4)
+    parser.add_argument('--db-workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=19990)
+    args = parser.parse_args()
+
+    server = spawn_server(args.port, db_workers=args.db_workers)
+    results = run_client_processes(storm, args.procs, args)
+    stop_server(server)
+
+    ok = sum(result[0] for result in results)
+    latencies = [latency for result in results for latency in result[1]]
+    print(f'clients={len(latencies)} procs={args.procs} db_workers={args.db_workers} ok={ok}')
+    print(f'login p50={percentile(latencies, 50) * 1000:.1f}ms '
+          f'p99={percentile(latencies, 99) * 1000:.1f}ms max={max(latencies) * 1000:.1f}ms')
@@ -0,0 +1,134 @@
+# 埋点开销:
+# 1. 每次记录的耗时 (计数器, 带标签的计数器, 直方图, 以及一对 perf_counter), 和统计处理函数 CPU 时间的 CpuTimed 包装
+# 2. 服务器在独立进程里运行, 打开/关闭埋点各运行 --rounds 轮同样的负载 (登录后的 list/send_everyone 请求),
+#    比较服务器每个请求消耗的 CPU 时间
+# 3. 导出一次 /metrics 的耗时
+# 运行: python -m bench.bench_metrics --clients 20 --requests 500
+import argparse
+import asyncio
+import time
+import timeit
+from bench.common import load_bench_keys, spawn_server, stop_server, process_cpu_time
+from classes.client import get_client
+from utils import metrics
+from utils.profiling import CpuTimed
+
+
+def micro():
+    registry = metrics.Registry()
+    counter = registry.register(metrics.Counter('bench_counter', ''))
+    labelled = registry.register(metrics.Counter('bench_labelled', '', ('type',)))
+    histogram = registry.register(metrics.Histogram('bench_histogram', '', ('type',)))
+    number = 1000000
+    results = []
+    for enabled in (True, False):
+        metrics.set_enabled(enabled)
+        results.append([
+            timeit.timeit(lambda: counter.inc(), number=number) / number * 1e9,
+            timeit.timeit(lambda: labelled.labels('send_user').inc(), number=number) / number * 1e9,
+            timeit.timeit(lambda: histogram.labels('send_user').observe(0.0003), number=number) / number * 1e9
+        ])
+    metrics.set_enabled(True)
+    timer = timeit.timeit(lambda: time.perf_counter() - time.perf_counter(), number=number) / number * 1e9
+    return results, timer, cpu_timed()
+
+
+def cpu_timed():  # 直接 await 和包装后 await 一个不挂起的处理函数的耗时差, 每多挂起一次再多两次 thread_time
+    async def handler():
+        return None
+
+    async def run(wrap, number):
+        start = time.perf_counter()
+        for _ in range(number):
+            if wrap:
+                await CpuTimed(handler())
+            else:
+                await handler()
+        return time.perf_counter() - start
+
+    loop = asyncio.get_event_loop()
+    number = 100000
+    plain = min(loop.run_until_complete(run(False, number)) for _ in range(3))
+    wrapped = min(loop.run_until_complete(run(True, number)) for _ in range(3))
+    return (wrapped - plain) / number * 1e9
+
+
+async def load(args, keys):
+    clients = []
+    for i in range(args.clients):
+        client = await get_client('127.0.0.1', args.port, keys['server_public'])
+        await client.send_register(keys['user_public'], f'metrics{i:04d}')
+        await client.send_login(keys['user_private'], f'metrics{i:04d}')
+        clients.append(client)
+
+    async def drain(client):  # 读掉广播, 不让发送队列堆积
+        while True:
+            await client.get_response()
+
+    readers = [asyncio.ensure_future(drain(client)) for client in clients]
+
+    async def run(client, index):
+        for j in range(args.requests):
+            if j % 10 == index % 10:
+                client.send_to_everyone('x' * 32)
+            await client.send_request_with_res('list')
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run(client, i) for i, client in enumerate(clients)])
+    elapsed = time.perf_counter() - start
+    for task in readers:
+        task.cancel()
+    await asyncio.gather(*[client.close() for client in clients])
+    return elapsed
+
+
+def server_cost(args, keys, enabled):
+    server = spawn_server(args.port, metrics=enabled)
+    loop = asyncio.get_event_loop()
+    cpu = process_cpu_time(server.pid)
+    elapsed = loop.run_until_complete(load(args, keys))
+    cpu = process_cpu_time(server.pid) - cpu
+    stop_server(server)
+    return cpu, elapsed
+
+
+def render_cost():
+    registry = metrics.REGISTRY
+    from classes import server  # 注册服务器的全部指标
+    histogram = registry.metrics['chat_request_seconds']
+    for req_type in ('register', 'get_challenge', 'login', 'list', 'send_everyone', 'send_user', 'dh_request'):
+        histogram.labels(req_type).observe(0.001)
+    number = 200
+    return timeit.timeit(metrics.render, number=number) / number * 1000, len(metrics.render())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=500, help='每个客户端的 list 请求数, 另有十分之一的广播')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--port', type=int, default=19984)
+    args = parser.parse_args()
+
+    (enabled, disabled), timer, wrapper = micro()
+    print(f'{"ns/op":<28} {"enabled":>8} {"disabled":>9}')
+    for name, on, off in zip(('counter.inc', 'labels().inc', 'labels().observe'), enabled, disabled):
+        print(f'{name:<28} {on:>8.0f} {off:>9.0f}')
+    print(f'{"perf_counter pair":<28} {timer:>8.0f}')
+    print(f'{"CpuTimed wrap":<28} {wrapper:>8.0f}')
+
+    keys = load_bench_keys()
+    requests = args.clients * args.requests * 1.1
+    costs = {True: [], False: []}
+    for _ in range(args.rounds):  # 交替运行, 减少机器状态变化的影响
+        for enabled in (True, False):
+            cpu, elapsed = server_cost(args, keys, enabled)
+            costs[enabled].append(cpu / requests * 1e6)
+    print(f'\nserver CPU us/request (best of {args.rounds}, {args.clients} clients, {int(requests)} requests)')
+    for enabled in (True, False):
+        print(f'{"metrics on" if enabled else "metrics off":<14} {min(costs[enabled]):>8.1f}')
+    overhead = min(costs[True]) - min(costs[False])
+    print(f'{"overhead":<14} {overhead:>8.1f} ({overhead / min(costs[False]) * 100:.1f}%)')
+
+    ms, size = render_cost()
+    print(f'\nrender /metrics: {ms:.2f} ms, {size} bytes')
@@ -0,0 +1,120 @@
+# 离线消息队列基准:
+# 1. 存储本身: --producers 个协程同时写入 --messages 条 --size 字节的消息, 比较每条 fsync (each)、合并 fsync (group)
+#    和不 fsync (none) 的写入速率、每批记录数和写入延迟, 以及重新打开目录时重建索引的时间
+# 2. 经过服务器: --senders 个客户端同时给不在线的用户发私聊, 然后收件人登录, 测量从发出登录请求到收齐 --drain 条离线消息的时间
+# 运行: python -m bench.bench_offline --messages 20000 --producers 64 --drain 100 1000
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from bench.common import load_bench_keys, spawn_server, stop_server, percentile
+from classes.client import get_client
+from utils.offline_store import OfflineStore, SYNC_MODES
+
+
+async def store_run(path, sync, args):
+    store = OfflineStore(path, max_messages=args.messages, max_bytes=args.messages * (args.size + 128), sync=sync)
+    store.open()
+    payload = os.urandom(args.size)
+    latencies = []
+
+    async def produce(index):
+        for i in range(index, args.messages, args.producers):
+            start = time.perf_counter()
+            await store.put(f'user{i % args.users}', 'send_user', {'from': f'user{index}', 'iv': payload[:16],
+                                                                   'ciphertext': payload})
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[produce(i) for i in range(args.producers)])
+    elapsed = time.perf_counter() - start
+    stats = store.stats()
+    store.close()
+    return elapsed, stats, latencies
+
+
+def bench_store(args):
+    loop = asyncio.get_event_loop()
+    print(f'store: {args.messages} messages x {args.size} bytes, {args.producers} producers, {args.users} recipients')
+    print(f'{"sync":<6} {"msg/s":>9} {"commits":>8} {"rec/commit":>10} {"p50 ms":>8} {"p99 ms":>8}')
+    for sync in SYNC_MODES:
+        path = tempfile.mkdtemp(prefix='chat_bench_offline_')
+        elapsed, stats, latencies = loop.run_until_complete(store_run(path, sync, args))
+        print(f'{sync:<6} {args.messages / elapsed:>9.0f} {stats["commits"]:>8} {stats["records_per_commit"]:>10.1f} '
+              f'{percentile(latencies, 50) * 1000:>8.2f} {percentile(latencies, 99) * 1000:>8.2f}')
+        if sync == SYNC_MODES[0]:
+            start = time.perf_counter()
+            store = OfflineStore(path)
+            store.open()
+            print(f'{"":<6} reopen: {store.messages} messages in {stats["segments"]} segments, '
+                  f'{(time.perf_counter() - start) * 1000:.1f} ms')
+            store.close()
+        shutil.rmtree(path)
+
+
+async def server_run(args, keys, count):
+    recipient = f'offline{count}'
+    senders = []
+    for i in range(args.senders):
+        client = await get_client('127.0.0.1', args.port, keys['server_public'])
+        await client.send_register(keys['user_public'], f'sender{count}_{i}')
+        await client.send_login(keys['user_private'], f'sender{count}_{i}')
+        senders.append(client)
+    await senders[0].send_register(keys['user_public'], recipient)  # 注册后不登录
+
+    async def send(client, index):
+        queued = 0
+        for i in range(index, count, args.senders):
+            res = await client.send_request_with_res('send_user', {'username': recipient, 'iv': b'\0' * 16,
+                                                                   'ciphertext': b'\0' * args.size})
+            queued += bool(res.get('queued'))
+        return queued
+
+    start = time.perf_counter()
+    queued = sum(await asyncio.gather(*[send(client, i) for i, client in enumerate(senders)]))
+    enqueue = time.perf_counter() - start
+
+    client = await get_client('127.0.0.1', args.port, keys['server_public'])
+    start = time.perf_counter()  # 离线消息紧跟在登录响应后面, 从发出登录请求开始计时
+    await client.send_login(keys['user_private'], recipient)
+    received = 0
+    while received < queued:
+        response = await client.get_response()
+        if response is not None and response.get('type') == 'send_user':
+            received += 1
+    drain = time.perf_counter() - start
+    await asyncio.gather(*[c.close() for c in senders + [client]])
+    return queued, enqueue, drain
+
+
+def bench_server(args):
+    keys = load_bench_keys()
+    server = spawn_server(args.port, offline={'max_messages': max(args.drain)})
+    loop = asyncio.get_event_loop()
+    print(f'\nserver: {args.senders} senders, {args.size} bytes, recipient logs in after all messages are queued')
+    print(f'{"messages":>8} {"enqueue msg/s":>14} {"login+drain ms":>15} {"drain msg/s":>12}')
+    try:
+        for count in args.drain:
+            queued, enqueue, drain = loop.run_until_complete(server_run(args, keys, count))
+            print(f'{queued:>8} {queued / enqueue:>14.0f} {drain * 1000:>15.1f} {queued / drain:>12.0f}')
+    finally:
+        stop_server(server)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--producers', type=int, default=64)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=256, help='密文字节数')
+    parser.add_argument('--senders', type=int, default=16)
+    parser.add_argument('--drain', type=int, nargs='+', default=[100, 1000], help='收件人登录时积压的消息数')
+    parser.add_argument('--port', type=int, default=19982)
+    parser.add_argument('--skip-store', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_store:
+        bench_store(args)
+    bench_server(args)
@@ -0,0 +1,109 @@
+# 私聊密钥协商基准: --online 个在线用户时, 新登录的用户
+#   eager   原来的做法, 收到用户列表后立即和每个在线用户 DH, 测量全部完成的时间和转发的 dh_request 帧数
+#   lazy    只在第一次给某个用户发消息时协商, 测量这条消息送达的时间 (包括 DH 和排队)
+#   cached  重新登录后用本地缓存里的密钥, 第一条消息送达的时间 (不需要 DH)
+# 运行: python -m bench.bench_pairwise --online 100 500
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from bench.common import load_bench_keys, spawn_server, stop_server
+from classes.client import get_client
+from utils.message_store import MessageStore
+
+
+async def connect(args, keys, username, received=None):
+    client = await get_client('127.0.0.1', args.port, keys['server_public'])
+    await client.send_register(keys['user_public'], username)
+    await client.send_login(keys['user_private'], username)
+    callbacks = {}
+    if received is not None:
+        callbacks['send_user'] = lambda client, response: received.set_result(time.perf_counter()) \
+            if not received.done() else None
+    listener = asyncio.ensure_future(client.start_listen(callbacks))
+    listener.add_done_callback(lambda task: task.cancelled() or task.exception())
+    return client, listener
+
+
+async def disconnect(client, listener):
+    listener.cancel()
+    await client.close()
+
+
+async def run(args, keys, online):
+    loop = asyncio.get_event_loop()
+    peers = [await connect(args, keys, f'pair{online}_{i:05d}') for i in range(online)]
+    names = [f'pair{online}_{i:05d}' for i in range(online)]
+
+    client, listener = await connect(args, keys, f'pair{online}_eager')
+    sent = []
+    send_request = client.send_request
+
+    def counted(req_type, data={}, request_id=None):
+        sent.append(req_type)
+        send_request(req_type, data, request_id)
+
+    client.send_request = counted
+    start = time.perf_counter()
+    for username in names:
+        client.send_dh_request(username, True)
+    while not all('dh_common_key' in client.user_dh_keys.get(username, {}) for username in names):
+        await asyncio.sleep(0.005)
+    eager = time.perf_counter() - start
+    frames = sent.count('dh_request') * 2  # 每个请求和回应都经过服务器转发
+    await disconnect(client, listener)
+
+    received = loop.create_future()
+    target, target_listener = await connect(args, keys, f'pair{online}_target', received)
+    directory = tempfile.mkdtemp(prefix='chat_bench_pairwise_')
+    store = MessageStore(os.path.join(directory, 'lazy.history.db'), b'bench key')
+    store.open()
+    target_store = MessageStore(os.path.join(directory, 'target.history.db'), b'bench key')
+    target_store.open()
+    target.key_cache = target_store
+
+    client, listener = await connect(args, keys, f'pair{online}_lazy')
+    client.key_cache = store
+    start = time.perf_counter()
+    client.send_to_user(target.username, 'hello')
+    lazy = await received - start
+    await disconnect(client, listener)
+
+    received = loop.create_future()
+    await disconnect(target, target_listener)
+    target, target_listener = await connect(args, keys, f'pair{online}_target', received)
+    target.key_cache = target_store
+    client, listener = await connect(args, keys, f'pair{online}_lazy')
+    client.key_cache = store
+    start = time.perf_counter()
+    cached_sent = client.send_to_user(target.username, 'hello again')
+    cached = await received - start
+    await disconnect(client, listener)
+    await disconnect(target, target_listener)
+    store.close()
+    target_store.close()
+    shutil.rmtree(directory)
+    for peer in peers:
+        await disconnect(*peer)
+    return eager, frames, lazy, cached, cached_sent
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--online', type=int, nargs='+', default=[100, 500], help='已经在线的用户数')
+    parser.add_argument('--port', type=int, default=19985)
+    args = parser.parse_args()
+
+    keys = load_bench_keys()
+    server = spawn_server(args.port)
+    try:
+        print(f'{"online":>7} {"eager ms":>9} {"dh frames":>10} {"lazy first msg ms":>18} {"cached first msg ms":>20}')
+        for online in args.online:
+            eager, frames, lazy, cached, cached_sent = asyncio.get_event_loop().run_until_complete(
+                run(args, keys, online))
+            assert cached_sent, '缓存的密钥没有被使用'
+            print(f'{online:>7} {eager * 1000:>9.1f} {frames:>10} {lazy * 1000:>18.1f} {cached * 1000:>20.1f}')
+    finally:
+        stop_server(server)
@@ -0,0 +1,111 @@
+# 请求流水线基准: 客户端经过一个模拟网络延迟的代理连接服务器
+# 1. 同一个连接上逐个等待响应 (窗口为 1) 与同时保持 --window 个请求在途时的请求速率和延迟
+# 2. 注册 + 登录依次等待与流水线发出 (Login.login 的做法) 的耗时
+# 运行: python -m bench.bench_pipeline --rtt 20 --requests 500 --window 1 8 32
+import argparse
+import asyncio
+import time
+from bench.common import load_bench_keys, spawn_server, stop_server, percentile
+from classes.client import get_client
+
+
+async def start_delay_proxy(port, target_port, rtt):
+    # 每个方向的数据延迟 rtt / 2 后再转发, 保持顺序
+    async def pipe(reader, writer):
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+
+        async def forward():
+            while True:
+                due, data = await queue.get()
+                if data is None:
+                    writer.close()
+                    return
+                await asyncio.sleep(max(due - loop.time(), 0))
+                writer.write(data)
+
+        task = asyncio.ensure_future(forward())
+        try:
+            while True:
+                data = await reader.read(65536)
+                queue.put_nowait((loop.time() + rtt / 2, data or None))
+                if not data:
+                    break
+        except ConnectionError:
+            queue.put_nowait((loop.time(), None))
+        await task
+
+    async def handle(reader, writer):
+        server_reader, server_writer = await asyncio.open_connection('127.0.0.1', target_port)
+        await asyncio.gather(pipe(reader, server_writer), pipe(server_reader, writer))
+
+    return await asyncio.start_server(handle, '127.0.0.1', port)
+
+
+async def request_rate(args, keys, window):
+    client = await get_client('127.0.0.1', args.proxy_port, keys['server_public'])
+    semaphore = asyncio.Semaphore(window)
+
+    async def request():
+        async with semaphore:
+            await client.send_request_with_res('get_challenge')
+
+    start = time.perf_counter()
+    await asyncio.gather(*[request() for _ in range(args.requests)])
+    elapsed = time.perf_counter() - start
+    stats = client.stats()
+    client.writer.close()
+    return args.requests / elapsed, stats
+
+
+async def login_time(args, keys, index, pipelined):
+    client = await get_client('127.0.0.1', args.proxy_port, keys['server_public'])
+    username = f'pipe{index:06d}{int(pipelined)}'
+    start = time.perf_counter()
+    if pipelined:
+        await asyncio.gather(
+            client.send_register(keys['user_public'], username),
+            client.send_login(keys['user_private'], username)
+        )
+    else:
+        await client.send_register(keys['user_public'], username)
+        await client.send_login(keys['user_private'], username)
+    elapsed = time.perf_counter() - start
+    client.writer.close()
+    return elapsed
+
+
+async def main(args):
+    keys = load_bench_keys()
+    proxy = await start_delay_proxy(args.proxy_port, args.port, args.rtt / 1000)
+
+    print(f'rtt={args.rtt}ms requests={args.requests}')
+    print(f'{"window":>7} {"req/s":>9} {"p50 ms":>8} {"p99 ms":>8} {"max in flight":>14}')
+    for window in args.window:
+        rate, stats = await request_rate(args, keys, window)
+        print(f'{window:>7} {rate:>9.1f} {stats["latency_p50"]:>8.1f} {stats["latency_p99"]:>8.1f} '
+              f'{stats["max_in_flight"]:>14}')
+
+    print(f'\n{"login":>10} {"p50 ms":>8} {"p99 ms":>8}')
+    for pipelined in (False, True):
+        times = [await login_time(args, keys, i, pipelined) for i in range(args.logins)]
+        print(f'{"pipelined" if pipelined else "serial":>10} {percentile(times, 50) * 1000:>8.1f} '
+              f'{percentile(times, 99) * 1000:>8.1f}')
+    proxy.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rtt', type=float, default=20, help='代理模拟的往返延迟 (毫秒)')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--window', type=int, nargs='+', default=[1, 8, 32], help='同时在途的请求数')
+    parser.add_argument('--logins', type=int, default=20)
+    parser.add_argument('--port', type=int, default=19986)
+    parser.add_argument('--proxy-port', type=int, default=19985)
+    args = parser.parse_args()
+
+    server = spawn_server(args.port)
+    try:
+        asyncio.get_event_loop().run_until_complete(main(args))
+    finally:
+        stop_server(server)
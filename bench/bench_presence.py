@@ -0,0 +1,107 @@
+# 在线状态基准: --users 个已登录用户在 --drop 秒内全部断线, 再在 --reconnect 秒内全部重新登录 (重连风暴),
+# 统计服务器推送的在线状态帧数和字节数
+#   legacy: 协议版本 3 的客户端, 每次上线/下线推送给每个在线用户一帧 (O(N²))
+#   batched: 协议版本 4 的客户端, 每个 tick 合并成一帧 presence 推送给每个在线用户
+# 连接是只统计入队帧数的假连接, 上下线和推送走服务器的真实代码 (global_users, Presence, publish_presence, broadcast)
+# 运行: python -m bench.bench_presence --users 10000 --tick 0.05
+import argparse
+import asyncio
+import logging
+import time
+from classes import broadcast
+from classes import server
+from utils.protocols import BINARY_CODEC
+
+
+class CountingOutbound():
+    def __init__(self, counter):
+        self.counter = counter
+
+    def offer(self, data, droppable=True):
+        self.counter['frames'] += 1
+        self.counter['bytes'] += len(data)
+        return True
+
+
+class FakeConnection():
+    died = False
+    codec = BINARY_CODEC
+
+    def __init__(self, username, version, counter):
+        self.username = username
+        self.version = version
+        self.outbound = CountingOutbound(counter)
+
+
+async def settle():  # 等待最后一批合并和推送完成
+    await asyncio.sleep(server.PRESENCE_TICK * 2 + 0.01)
+    while broadcast._tasks:
+        await asyncio.gather(*list(broadcast._tasks))
+
+
+async def spread(usernames, seconds, action):  # 在 seconds 秒内均匀地对每个用户执行 action
+    step = 0.005
+    chunk = max(1, int(len(usernames) * step / seconds)) if seconds > 0 else len(usernames)
+    for i in range(0, len(usernames), chunk):
+        for username in usernames[i:i + chunk]:
+            action(username)
+        await asyncio.sleep(step)
+
+
+async def storm(args, version, tick):
+    counter = {'frames': 0, 'bytes': 0}
+    server.global_users.clear()
+    server.set_presence(tick)
+    usernames = [f'user{i:06d}' for i in range(args.users)]
+
+    def login(username):
+        server.global_users[username] = FakeConnection(username, version, counter)
+        server.presence.touch(username)
+
+    def logout(username):
+        server.global_users.pop(username)
+        server.presence.touch(username)
+
+    for username in usernames:
+        login(username)
+    await settle()
+    counter['frames'] = counter['bytes'] = 0
+    batches = server.presence.batches
+
+    start = time.perf_counter()
+    cpu = time.process_time()
+    await spread(usernames, args.drop, logout)
+    await spread(usernames, args.reconnect, login)
+    await settle()
+    return {
+        'frames': counter['frames'],
+        'bytes': counter['bytes'],
+        'batches': server.presence.batches - batches,
+        'wall': time.perf_counter() - start,
+        'cpu': time.process_time() - cpu
+    }
+
+
+async def main(args):
+    logging.disable(logging.CRITICAL)
+    print(f'users={args.users} drop={args.drop}s reconnect={args.reconnect}s')
+    print(f'{"mode":>8} {"frames":>12} {"MB":>9} {"frames/user":>12} {"batches":>8} {"cpu s":>7} {"wall s":>7}')
+    modes = [('batched', 4, args.tick)]
+    if not args.skip_legacy:
+        modes.insert(0, ('legacy', 3, 0))
+    for name, version, tick in modes:
+        result = await storm(args, version, tick)
+        print(f'{name:>8} {result["frames"]:>12} {result["bytes"] / 1e6:>9.1f} '
+              f'{result["frames"] / args.users:>12.1f} {result["batches"]:>8} '
+              f'{result["cpu"]:>7.1f} {result["wall"]:>7.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--drop', type=float, default=1.0, help='全部断线所用的秒数')
+    parser.add_argument('--reconnect', type=float, default=2.0, help='全部重新登录所用的秒数')
+    parser.add_argument('--tick', type=float, default=0.05, help='batched 模式合并上下线的间隔 (秒)')
+    parser.add_argument('--skip-legacy', action='store_true', help='不运行 O(N²) 的 legacy 模式')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(main(args))
@@ -0,0 +1,111 @@
+# 本地聊天记录的全文搜索: 写入 --messages 条消息 (分散在 --conversations 个会话里), 测量建索引的写入速率和查询延迟
+#   词汇按 Zipf 分布抽取, 一半英文单词一半两个汉字的词; 查询分为常见词 / 中等 / 罕见词 / 两个词 / 中文词,
+#   每类分别在全部会话和单个会话里搜索, 取最新的 --limit 条结果 (包括解密和子串确认)
+# 建好的数据库可以用 --path 保留下来重复测试
+# 运行: python -m bench.bench_search --messages 1000000
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from bench.common import percentile
+from utils.message_store import MessageStore
+
+KEY = b'bench search key'
+
+
+def make_vocabulary(size, rng):
+    words = []
+    for i in range(size):
+        if i % 2:
+            words.append(chr(0x4e00 + rng.randrange(3000)) + chr(0x4e00 + rng.randrange(3000)))
+        else:
+            words.append(''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9))))
+    return words
+
+
+def zipf_weights(size, s=1.1):
+    total = 0
+    weights = []
+    for rank in range(1, size + 1):
+        total += 1 / rank ** s
+        weights.append(total)
+    return weights
+
+
+def build(store, args, vocabulary, rng):
+    weights = zipf_weights(len(vocabulary))
+    start = time.perf_counter()
+    batch = []
+    for i in range(args.messages):
+        words = rng.choices(vocabulary, cum_weights=weights, k=rng.randint(3, 15))
+        conversation = f'user{i % args.conversations}'
+        batch.append((conversation, {'from': conversation, 'message': ' '.join(words), 'me': False,
+                                     'time': '12:00:00'}))
+        if len(batch) == 1000:
+            store.append_many(batch)
+            batch = []
+    if batch:
+        store.append_many(batch)
+    return time.perf_counter() - start
+
+
+def run_queries(store, queries, conversation, limit):
+    times = []
+    hits = 0
+    for query in queries:
+        start = time.perf_counter()
+        results = store.search(query, conversation, limit)
+        times.append(time.perf_counter() - start)
+        hits += len(results)
+    return times, hits / len(queries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--conversations', type=int, default=50)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=200, help='每类查询的次数')
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--path', help='数据库文件, 已存在时直接使用')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    directory = None
+    path = args.path
+    if path is None:
+        directory = tempfile.mkdtemp(prefix='chat_bench_search_')
+        path = os.path.join(directory, 'bench.history.db')
+    exists = os.path.exists(path)
+    store = MessageStore(path, KEY)
+    store.open()
+    try:
+        if not exists:
+            elapsed = build(store, args, vocabulary, rng)
+            print(f'indexed {args.messages} messages in {elapsed:.1f} s ({args.messages / elapsed:.0f} messages/s), '
+                  f'database {os.path.getsize(path) / 1024 / 1024:.0f} MiB')
+        english = vocabulary[0::2]
+        chinese = vocabulary[1::2]
+        classes = {
+            'common': [rng.choice(english[:10]) for _ in range(args.queries)],
+            'medium': [rng.choice(english[100:1000]) for _ in range(args.queries)],
+            'rare': [rng.choice(english[5000:]) for _ in range(args.queries)],
+            'two words': [f'{rng.choice(english[:200])} {rng.choice(english[:200])}' for _ in range(args.queries)],
+            'chinese': [rng.choice(chinese[:1000]) for _ in range(args.queries)],
+        }
+        print(f'query latency in ms (p50 / p99), latest {args.limit} results')
+        print(f'{"query":<10} {"all p50":>8} {"all p99":>8} {"hits":>6} {"conv p50":>9} {"conv p99":>9} {"hits":>6}')
+        for name, queries in classes.items():
+            everywhere, hits = run_queries(store, queries, None, args.limit)
+            conversation = f'user{rng.randrange(args.conversations)}'
+            filtered, conversation_hits = run_queries(store, queries, conversation, args.limit)
+            print(f'{name:<10} {percentile(everywhere, 50) * 1000:>8.2f} {percentile(everywhere, 99) * 1000:>8.2f} '
+                  f'{hits:>6.1f} {percentile(filtered, 50) * 1000:>9.2f} {percentile(filtered, 99) * 1000:>9.2f} '
+                  f'{conversation_hits:>6.1f}')
+    finally:
+        store.close()
+        if directory is not None:
+            shutil.rmtree(directory)
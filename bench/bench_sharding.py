@@ -0,0 +1,87 @@
+# 多进程 (SO_REUSEPORT + 总线) 模式随工作进程数的扩展:
+# 1. 每秒完成的握手数 (CPU 密集)
+# 2. 每秒投递的私聊消息数: 发送方和接收方一般连在不同的工作进程上, 消息经过总线转发
+# 运行: python -m bench.bench_sharding --workers 1 2 4 8
+import argparse
+import asyncio
+import os
+import time
+from base64 import b64encode
+from bench.common import load_bench_keys, spawn_server_main, run_client_processes, wait_barrier
+from classes.client import get_client
+
+
+async def connect_many(index, args, barrier):
+    keys = load_bench_keys()
+    await wait_barrier(barrier)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def connect():
+        async with semaphore:
+            client = await get_client('127.0.0.1', args.port, keys['server_public'])
+            client.writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[connect() for _ in range(args.handshakes // args.procs)])
+    return args.handshakes // args.procs, time.perf_counter() - start
+
+
+async def login(keys, args, username):
+    client = await get_client('127.0.0.1', args.port, keys['server_public'])
+    await client.send_register(keys['user_public'], username)
+    await client.send_login(keys['user_private'], username)
+    return client
+
+
+async def relay(index, args, barrier):
+    # 第 index 个进程的发送方给第 index + 1 个进程的接收方发私聊, 消息内容不需要解密
+    keys = load_bench_keys()
+    senders = [await login(keys, args, f'send_{args.run}_{index}_{i}') for i in range(args.pairs)]
+    receivers = [await login(keys, args, f'recv_{args.run}_{index}_{i}') for i in range(args.pairs)]
+    peer = (index + 1) % args.procs
+    payload = {'iv': b64encode(os.urandom(16)).decode(), 'ciphertext': b64encode(os.urandom(64)).decode()}
+    await wait_barrier(barrier)
+
+    async def send(client, i):
+        for _ in range(args.messages // args.window):
+            for _ in range(args.window):
+                client.send_request('send_user', dict(payload, username=f'recv_{args.run}_{peer}_{i}'))
+            for _ in range(args.window):
+                await client.get_response()
+
+    async def receive(client):
+        for _ in range(args.messages // args.window * args.window):
+            await client.get_response()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[send(client, i) for i, client in enumerate(senders)], *map(receive, receivers))
+    return args.pairs * (args.messages // args.window * args.window), time.perf_counter() - start
+
+
+def rate(results):
+    return sum(result[0] for result in results) / max(result[1] for result in results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--handshakes', type=int, default=400)
+    parser.add_argument('--pairs', type=int, default=10, help='每个客户端进程的发送/接收用户对数')
+    parser.add_argument('--messages', type=int, default=500, help='每个发送方发送的消息数')
+    parser.add_argument('--window', type=int, default=50, help='发送方等待回应前最多发送的消息数')
+    parser.add_argument('--procs', type=int, default=4, help='客户端进程数')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--port', type=int, default=19992)
+    args = parser.parse_args()
+
+    print(f'cpus: {os.cpu_count()}')
+    print(f'{"workers":>8}{"handshakes/s":>14}{"messages/s":>12}')
+    for workers in args.workers:
+        server = spawn_server_main(args.port, '--workers', workers, '--crypto-workers', 0)
+        time.sleep(1)  # 等待所有工作进程开始监听
+        handshakes = rate(run_client_processes(connect_many, args.procs, args))
+        args.run = workers
+        messages = rate(run_client_processes(relay, args.procs, args))
+        server.terminate()
+        server.wait()
+        print(f'{workers:>8}{handshakes:>14.1f}{messages:>12.1f}')
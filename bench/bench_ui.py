@@ -0,0 +1,210 @@
+# 聊天窗口的帧时间: 会话里已经有 --messages 条消息时, 收到一条新消息 (或者切换会话) 到窗口重绘完成的时间
+#   widget  原来的做法, QListWidget 清空后为每条消息重新创建两个 QListWidgetItem
+#   model   ChatHistoryModel + 主窗口里的 list_history (QTableView), 新消息只插入两行, 切换会话只换模型
+# 没有显示器时使用 offscreen 平台; widget 在大的会话里每帧要几秒, 只测 --widget-frames 帧
+# --memory: 收到 --messages 条私聊 (分散在 --conversations 个会话里) 之后 Python 分配的内存,
+#   对比全部留在内存里和写入本地聊天记录、每个会话只保留最近 HISTORY_KEEP 条
+# --burst: 一帧之内收到 --messages 条消息时界面线程被占用的时间,
+#   对比逐条写入本地记录、插入模型并滚动, 和每帧一起写入 (一个事务)、每个会话插入一次、滚动一次
+# 运行: python -m bench.bench_ui --messages 1000 10000 100000
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from bench.common import percentile
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5 import QtWidgets
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QListWidgetItem
+from classes.history_model import ChatHistoryModel
+from utils.message_store import MessageStore
+from ui.ui_MainWindow import Ui_MainWindow
+
+HISTORY_KEEP = 200  # 与 client_main.HISTORY_KEEP 相同
+
+
+def make_messages(count, prefix):
+    return [{
+        'from': f'user{i % 50}',
+        'message': f'{prefix} message {i} ' + 'x' * (i % 80),
+        'me': i % 7 == 0,
+        'time': '12:00:00'
+    } for i in range(count)]
+
+
+def frame(app, view):  # 处理排队的事件并同步重绘可见区域
+    app.processEvents()
+    view.viewport().repaint()
+
+
+def widget_frames(app, messages, frames):
+    view = QtWidgets.QListWidget()
+    view.resize(570, 451)
+    view.show()
+    times = []
+    for i in range(frames):
+        messages.append({'from': 'me', 'message': f'new {i}', 'me': True, 'time': '12:00:00'})
+        start = time.perf_counter()
+        view.clear()
+        for message in messages:
+            item_a = QListWidgetItem(f"{message['from']} in {message['time']}:  ")
+            item_b = QListWidgetItem(message['message'] + "  ")
+            alignment = Qt.AlignRight if message['me'] else Qt.AlignLeft
+            item_a.setTextAlignment(alignment)
+            item_b.setTextAlignment(alignment)
+            view.addItem(item_a)
+            view.addItem(item_b)
+        view.scrollToBottom()
+        frame(app, view)
+        times.append(time.perf_counter() - start)
+    view.close()
+    return times
+
+
+def model_frames(app, messages, other, frames):
+    window = QtWidgets.QMainWindow()
+    ui = Ui_MainWindow()
+    ui.setupUi(window)
+    window.show()
+    view = ui.list_history
+    model = ChatHistoryModel(messages)
+    other = ChatHistoryModel(other)
+    view.setModel(model)
+    view.scrollToBottom()
+    frame(app, view)
+
+    appends = []
+    for i in range(frames):
+        start = time.perf_counter()
+        model.append({'from': 'me', 'message': f'new {i}', 'me': True, 'time': '12:00:00'})
+        view.scrollToBottom()
+        frame(app, view)
+        appends.append(time.perf_counter() - start)
+
+    switches = []
+    for i in range(min(frames, 200)):
+        start = time.perf_counter()
+        view.setModel(other if i % 2 == 0 else model)
+        view.scrollToBottom()
+        frame(app, view)
+        switches.append(time.perf_counter() - start)
+    window.close()
+    return appends, switches
+
+
+def memory_run(count, conversations, keep, stored):
+    path = tempfile.mkdtemp(prefix='chat_bench_ui_')
+    store = MessageStore(os.path.join(path, 'bench.history.db'), b'bench key')
+    store.open()
+    tracemalloc.start()
+    models = dict()
+    start = time.perf_counter()
+    for i in range(count):
+        username = f'user{i % conversations}'
+        model = models.get(username)
+        if model is None:
+            model = models[username] = ChatHistoryModel()
+        message = {'from': username, 'message': f'message {i} ' + 'x' * (i % 80), 'me': False, 'time': '12:00:00'}
+        if stored:
+            message['id'] = store.append(username, message)
+        model.append(message)
+        if stored:
+            model.trim(keep)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    store.close()
+    shutil.rmtree(path)
+    return current, elapsed
+
+
+def burst_run(app, count, batched):
+    path = tempfile.mkdtemp(prefix='chat_bench_ui_')
+    store = MessageStore(os.path.join(path, 'bench.history.db'), b'bench key')
+    store.open()
+    window = QtWidgets.QMainWindow()
+    ui = Ui_MainWindow()
+    ui.setupUi(window)
+    window.show()
+    view = ui.list_history
+    model = ChatHistoryModel(make_messages(1000, 'a'))
+    view.setModel(model)
+    view.scrollToBottom()
+    frame(app, view)
+    incoming = [('user1', message) for message in make_messages(count, 'b')]
+
+    start = time.perf_counter()
+    if batched:
+        for (_, message), message_id in zip(incoming, store.append_many(incoming)):
+            message['id'] = message_id
+        model.extend([message for _, message in incoming])
+        model.trim(HISTORY_KEEP)
+        view.scrollToBottom()
+    else:
+        for username, message in incoming:
+            message['id'] = store.append(username, message)
+            model.append(message)
+            model.trim(HISTORY_KEEP)
+            view.scrollToBottom()
+    frame(app, view)
+    elapsed = time.perf_counter() - start
+    window.close()
+    store.close()
+    shutil.rmtree(path)
+    return elapsed
+
+
+def bench_burst(app, args):
+    print('UI thread busy time for a burst of N messages arriving within one frame, ms')
+    print(f'{"messages":>9} {"per message":>12} {"per frame":>10}')
+    for count in args.messages:
+        single = burst_run(app, count, False)
+        batched = burst_run(app, count, True)
+        print(f'{count:>9} {single * 1000:>12.1f} {batched * 1000:>10.1f}')
+
+
+def bench_memory(args):
+    print(f'memory after N private messages in {args.conversations} conversations (traced Python allocations)')
+    print(f'{"messages":>9} {"in memory MiB":>14} {"stored MiB":>11} {"store us/msg":>13}')
+    for count in args.messages:
+        unbounded, _ = memory_run(count, args.conversations, args.keep, False)
+        bounded, elapsed = memory_run(count, args.conversations, args.keep, True)
+        print(f'{count:>9} {unbounded / 1024 / 1024:>14.2f} {bounded / 1024 / 1024:>11.2f} '
+              f'{elapsed / count * 1e6:>13.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, nargs='+', default=[1000, 10000, 100000], help='会话里已有的消息数')
+    parser.add_argument('--frames', type=int, default=1000)
+    parser.add_argument('--widget-frames', type=int, default=3)
+    parser.add_argument('--skip-widget', action='store_true')
+    parser.add_argument('--memory', action='store_true')
+    parser.add_argument('--burst', action='store_true')
+    parser.add_argument('--conversations', type=int, default=20)
+    parser.add_argument('--keep', type=int, default=HISTORY_KEEP, help='每个会话在内存里保留的消息数 (client_main.HISTORY_KEEP)')
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication(sys.argv)
+    if args.memory:
+        bench_memory(args)
+        sys.exit(0)
+    if args.burst:
+        bench_burst(app, args)
+        sys.exit(0)
+    print(f'platform {app.platformName()}, frame time in ms (p50 / p99 / max)')
+    print(f'{"messages":>9} {"view":<7} {"new message":>26} {"switch":>26}')
+    for count in args.messages:
+        if not args.skip_widget:
+            times = widget_frames(app, make_messages(count, 'a'), args.widget_frames)
+            print(f'{count:>9} {"widget":<7} {percentile(times, 50) * 1000:>8.2f} {percentile(times, 99) * 1000:>8.2f} '
+                  f'{max(times) * 1000:>8.2f} {"":>26}')
+        appends, switches = model_frames(app, make_messages(count, 'a'), make_messages(count, 'b'), args.frames)
+        print(f'{count:>9} {"model":<7} {percentile(appends, 50) * 1000:>8.2f} {percentile(appends, 99) * 1000:>8.2f} '
+              f'{max(appends) * 1000:>8.2f} {percentile(switches, 50) * 1000:>8.2f} '
+              f'{percentile(switches, 99) * 1000:>8.2f} {max(switches) * 1000:>8.2f}')
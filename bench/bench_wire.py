@@ -0,0 +1,64 @@
+# JSON 与二进制帧格式的对比: 每条消息的字节数 (明文 / 加密后的帧) 以及编码、解码耗时
+# 运行: python -m bench.bench_wire
+import os
+import time
+from base64 import b64encode
+from utils.protocols import JSON_CODEC, BINARY_CODEC, as_bytes
+from utils.tools import DH
+
+ROUNDS = 20000
+GCM_OVERHEAD = 4 + 16  # 长度前缀 + GCM 标签
+
+
+def send_user(size, codec):  # 客户端 -> 服务器的私聊请求, JSON 客户端自己做 base64
+    iv, ciphertext = os.urandom(16), os.urandom(size)
+    if codec is JSON_CODEC:
+        iv, ciphertext = b64encode(iv).decode(), b64encode(ciphertext).decode()
+    return {'type': 'send_user', 'data': {'username': 'bobby', 'iv': iv, 'ciphertext': ciphertext},
+            'timestamp': time.time()}
+
+
+def messages(codec):
+    return {
+        'send_user 64B': send_user(64, codec),
+        'send_user 1KB': send_user(1024, codec),
+        'send_everyone': {'type': 'send_everyone', 'data': {'from': 'alice', 'message': '今天晚上一起吃饭吗?'}},
+        'dh_request': {'type': 'dh_request', 'data': {'from': 'alice', 'init': True,
+                                                      'dh_public': DH().dh_get_public(DH().dh_gen_private())}},
+        'list 50 users': {'success': True, 'type': 'list', 'data': [f'user_{i:04d}' for i in range(50)]},
+        'send_user_info': {'success': True, 'type': 'send_user_info'}
+    }
+
+
+def relay(codec, frame):  # 服务器转发私聊: 解码, 改写字段, 重新编码
+    request = codec.decode(frame)['data']
+    request.pop('username')
+    request['from'] = 'alice'
+    as_bytes(request['iv'])
+    return codec.encode({'type': 'send_user', 'data': request})
+
+
+def measure(func, rounds=ROUNDS):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+if __name__ == '__main__':
+    codecs = (JSON_CODEC, BINARY_CODEC)
+    samples = {codec: messages(codec) for codec in codecs}
+    print(f'{"message":<16}' + ''.join(f'{codec.name + " B":>12}{"frame B":>9}{"enc us":>8}{"dec us":>8}'
+                                       for codec in codecs))
+    for name in samples[JSON_CODEC]:
+        row = f'{name:<16}'
+        for codec in codecs:
+            message = samples[codec][name]
+            data = codec.encode(message)
+            row += f'{len(data):>12}{len(data) + GCM_OVERHEAD:>9}'
+            row += f'{measure(lambda: codec.encode(message)):>8.2f}{measure(lambda: codec.decode(data)):>8.2f}'
+        print(row)
+
+    print(f'\n{"server relay send_user 64B (us)":<34}' + ''.join(f'{codec.name:>10}' for codec in codecs))
+    frames = {codec: codec.encode(samples[codec]['send_user 64B']) for codec in codecs}
+    print(f'{"":<34}' + ''.join(f'{measure(lambda: relay(codec, frames[codec])):>10.2f}' for codec in codecs))
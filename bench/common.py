@@ -0,0 +1,193 @@
+# 基准测试共用的工具: 启动本地服务器 (本进程或子进程), 生成/缓存测试密钥, 多进程客户端, 统计分位数
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from utils import crypto
+
+KEY_CACHE = os.path.join(tempfile.gettempdir(), 'chat_bench_keys.json')
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_bench_keys():  # 测试密钥缓存在临时目录里复用, 按当前的密码学实现解析
+    if os.path.exists(KEY_CACHE):
+        with open(KEY_CACHE) as f:
+            data = json.loads(f.read())
+    else:
+        server_public, server_private = crypto.newkeys(2048)
+        user_public, user_private = crypto.newkeys(1024)
+        data = {
+            'server_public': crypto.save_public_key(server_public),
+            'server_private': crypto.save_private_key(server_private),
+            'user_public': crypto.save_public_key(user_public),
+            'user_private': crypto.save_private_key(user_private)
+        }
+        with open(KEY_CACHE, 'w') as f:
+            f.write(json.dumps(data))
+    return {
+        'server_public': crypto.load_public_key(data['server_public']),
+        'server_private': crypto.load_private_key(data['server_private']),
+        'user_public': crypto.load_public_key(data['user_public']),
+        'user_private': crypto.load_private_key(data['user_private'])
+    }
+
+
+def start_local_server(keys, port, db_workers=4, crypto_workers=0, dh_keypool=(16, 1024), metrics=True, offline=None,
+                       history=None):
+    # 在当前事件循环里启动服务器, 返回服务器任务; metrics 为 False 时关闭埋点,
+    # offline 为 OfflineStore 的参数 dict 时在临时目录里保存离线消息, history 为 set_history 的参数 dict 时保存公共聊天历史
+    from classes import server
+    from utils import metrics as server_metrics
+
+    logging.disable(logging.CRITICAL)
+    server_metrics.set_enabled(metrics)
+    db_path = os.path.join(tempfile.mkdtemp(prefix='chat_bench_'), 'user.db')
+    server.set_server_keys(keys['server_public'], keys['server_private'])
+    server.set_crypto_workers(crypto_workers)
+    server.set_dh_keypool(*dh_keypool)
+    server.set_user_store(f'sqlite:///{db_path}', db_workers)
+    if offline is not None:
+        server.set_offline_store(os.path.join(os.path.dirname(db_path), 'offline'), **offline)
+    if history is not None:
+        server.set_history(os.path.join(os.path.dirname(db_path), 'history.ring'), **history)
+    return asyncio.ensure_future(server.start_server('127.0.0.1', port))
+
+
+def _server_process(port, provider, options):
+    from classes import server
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    crypto.set_provider(provider)
+    task = start_local_server(load_bench_keys(), port, **options)
+    try:
+        asyncio.get_event_loop().run_until_complete(task)
+    finally:
+        server.crypto_pool.close()  # 结束握手进程池, 不留下孤儿进程
+
+
+def spawn_server(port, provider=None, **options):  # 在独立进程里运行服务器, 避免客户端占用服务器的 CPU
+    provider = provider or crypto.get_provider().name
+    process = multiprocessing.get_context('spawn').Process(target=_server_process, args=(port, provider, options))
+    process.start()
+    wait_for_port(port)
+    return process
+
+
+def spawn_server_main(port, *options):
+    # 用 server_main.py 启动服务器 (例如 --workers N 的多进程模式), 在临时目录里写入测试密钥和数据库
+    keys = load_bench_keys()
+    workdir = tempfile.mkdtemp(prefix='chat_bench_')
+    with open(os.path.join(workdir, 'server_public_key'), 'w') as f:
+        f.write(crypto.save_public_key(keys['server_public']))
+    with open(os.path.join(workdir, 'server_private_key'), 'w') as f:
+        f.write(crypto.save_private_key(keys['server_private']))
+    server_main = os.path.join(REPO_ROOT, 'server_main.py')
+    process = subprocess.Popen([sys.executable, server_main, '--port', str(port), '--crypto-provider',
+                                crypto.get_provider().name, *map(str, options)],
+                               cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process
+
+
+def spawn_broker(port):  # 集群模式的参考 broker
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, 'broker_main.py'), '--listen',
+                                f'tcp:127.0.0.1:{port}'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process
+
+
+def stop_server(process):  # 连同服务器的进程池一起结束
+    process.terminate()
+    process.join()
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'服务器没有在 {timeout} 秒内监听 {port}')
+
+
+def _client_process(target, index, args, barrier, results):
+    logging.disable(logging.CRITICAL)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results.put(loop.run_until_complete(target(index, args, barrier)))
+
+
+def run_client_processes(target, procs, args):
+    # target(index, args, barrier) 是协程函数, 在每个进程里各运行一次, 返回值可被 pickle
+    # barrier 用来让各进程准备完毕 (例如握手) 后同时开始施压
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(procs)
+    results = ctx.Queue()
+    processes = [ctx.Process(target=_client_process, args=(target, i, args, barrier, results)) for i in range(procs)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return collected
+
+
+async def wait_barrier(barrier):
+    await asyncio.get_event_loop().run_in_executor(None, barrier.wait)
+
+
+def process_cpu_time(pid):  # 进程累计占用的 CPU 秒数 (用户态 + 内核态), 仅支持 Linux
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def process_tree(pid):  # pid 及其所有子孙进程 (例如 --workers 的工作进程和握手进程池)
+    parents = dict()
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    parents.setdefault(int(f.read().rsplit(')', 1)[1].split()[1]), []).append(int(entry))
+            except OSError:
+                pass  # 进程已经退出
+    pids = [pid]
+    for current in pids:
+        pids.extend(parents.get(current, []))
+    return pids
+
+
+def process_rss(pid):  # 常驻内存字节数
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def tree_usage(pid):  # 进程树的 (CPU 秒数, 常驻内存字节数)
+    cpu = rss = 0
+    for child in process_tree(pid):
+        try:
+            cpu += process_cpu_time(child)
+            rss += process_rss(child)
+        except OSError:
+            pass
+    return cpu, rss
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
@@ -0,0 +1,382 @@
+# 负载生成器: 多个进程驱动成千上万个无界面的 Client, 测量服务器容量
+#   1. 连接 + 握手 (可限速), 统计握手速率和握手延迟
+#   2. 注册 + 登录 (流水线), 相邻的两个用户 (2k, 2k+1) 通过服务器完成 DH, 之后互相私聊
+#   3. 在 --duration 秒内按 --rate (所有客户端合计的每秒操作数, 泊松到达) 和 --mix 的权重执行操作:
+#        send_user  给配对用户发私聊, 在对方收到时计算投递延迟
+#        broadcast  公共消息, 在所有收到的客户端计算投递延迟
+#        list       请求在线用户列表, 统计往返时间
+#        reconnect  断开后重新握手并登录 (连接抖动)
+#   4. 采样服务器进程树 (包括工作进程和握手进程池) 的 CPU 和常驻内存
+# 结果写成 JSON (--output), 附带参数、提交号和时间, 方便比较多次运行
+# 运行: python -m bench.loadgen --clients 2000 --procs 4 --rate 500 --duration 30 \
+#           --mix send_user=90,list=9,broadcast=1 --server-args "--workers 2" --output run.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import shlex
+import subprocess
+import threading
+import time
+from bench.common import REPO_ROOT, load_bench_keys, spawn_server_main, run_client_processes, wait_barrier, \
+    percentile, tree_usage
+from classes.client import get_client
+from utils import crypto
+
+OPS = ('send_user', 'broadcast', 'list', 'reconnect')
+
+
+class Samples():
+    # 蓄水池抽样, 每个进程最多保留 capacity 个值, 合并后计算分位数
+    def __init__(self, capacity=20000):
+        self.capacity = capacity
+        self.count = 0
+        self.values = []
+
+    def add(self, value):
+        self.count += 1
+        if len(self.values) < self.capacity:
+            self.values.append(value)
+        else:
+            i = random.randrange(self.count)
+            if i < self.capacity:
+                self.values[i] = value
+
+    def export(self):  # 返回给主进程的普通 dict
+        return {'count': self.count, 'values': self.values}
+
+
+def parse_mix(text):
+    mix = dict()
+    for item in text.split(','):
+        op, _, weight = item.partition('=')
+        if op not in OPS:
+            raise argparse.ArgumentTypeError(f'未知的操作 {op}, 可用: {", ".join(OPS)}')
+        mix[op] = float(weight or 1)
+    return mix
+
+
+def raise_nofile():  # 每个客户端一个 socket, 把打开文件数的软限制提高到硬限制
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class LoadClient():
+    def __init__(self, index, args, keys, stats):
+        self.index = index
+        self.username = f'{args.prefix}{index:06d}'
+        self.partner = f'{args.prefix}{index ^ 1:06d}' if (index ^ 1) < args.clients else None
+        self.args = args
+        self.keys = keys
+        self.stats = stats
+        self.client = None
+        self.listener = None
+        self.user_dh_keys = dict()  # 重新连接后沿用已经协商好的私聊密钥
+
+    async def connect(self):
+        start = time.perf_counter()
+        self.client = await get_client(self.args.host, self.args.port, self.keys['server_public'])
+        self.stats['handshake'].add(time.perf_counter() - start)
+        self.client.user_dh_keys = self.user_dh_keys
+
+    async def login(self):
+        register, login = await asyncio.gather(
+            self.client.send_register(self.keys['user_public'], self.username),
+            self.client.send_login(self.keys['user_private'], self.username)
+        )
+        return login['success']
+
+    def listen(self):
+        callbacks = {
+            'send_user': self.on_message,
+            'send_everyone': self.on_message
+        }
+        self.listener = asyncio.ensure_future(self.client.start_listen(callbacks))
+        self.listener.add_done_callback(lambda task: task.cancelled() or task.exception())  # 断开时不报错
+
+    def on_message(self, client, response):
+        sent, _, _ = response['data']['message'].partition(' ')
+        kind = 'send_user' if response['type'] == 'send_user' else 'broadcast'
+        self.stats['received'][kind] += 1
+        self.stats['delivery'][kind].add(time.time() - float(sent))
+
+    def message(self):
+        return f'{time.time():.6f} ' + 'x' * self.args.message_size
+
+    def dh_ready(self):
+        return self.partner is None or 'dh_common_key' in self.user_dh_keys.get(self.partner, {})
+
+    async def run_op(self, op):
+        if op == 'send_user':
+            if self.partner is None or not self.dh_ready():
+                return
+            self.client.send_to_user(self.partner, self.message())
+        elif op == 'broadcast':
+            self.client.send_to_everyone(self.message())
+        elif op == 'list':
+            start = time.perf_counter()
+            await self.client.send_request_with_res('list')
+            self.stats['rtt']['list'].add(time.perf_counter() - start)
+        elif op == 'reconnect':
+            self.listener.cancel()
+            await self.client.close()
+            start = time.perf_counter()
+            await self.connect()
+            await self.login()
+            self.stats['rtt']['reconnect'].add(time.perf_counter() - start)
+            self.listen()
+        self.stats['sent'][op] += 1
+
+    async def drive(self, rate, deadline, ops, weights):
+        loop = asyncio.get_event_loop()
+        next_time = loop.time() + random.expovariate(rate)
+        while next_time < deadline:
+            await asyncio.sleep(max(next_time - loop.time(), 0))
+            try:
+                await self.run_op(random.choices(ops, weights)[0])
+            except Exception:
+                self.stats['errors'] += 1
+            next_time += random.expovariate(rate)
+
+
+def export_stats(stats):
+    if isinstance(stats, Samples):
+        return stats.export()
+    if isinstance(stats, dict):
+        return {key: export_stats(value) for key, value in stats.items()}
+    return stats
+
+
+def new_stats():
+    return {
+        'handshake': Samples(),
+        'delivery': {'send_user': Samples(), 'broadcast': Samples()},
+        'rtt': {'list': Samples(), 'reconnect': Samples()},
+        'sent': {op: 0 for op in OPS},
+        'received': {'send_user': 0, 'broadcast': 0},
+        'errors': 0
+    }
+
+
+async def run_process(index, args, barrier):
+    raise_nofile()
+    crypto.set_provider(args.provider)
+    keys = load_bench_keys()
+    stats = new_stats()
+    clients = [LoadClient(i, args, keys, stats) for i in range(index, args.clients, args.procs)]
+
+    # 1. 连接和握手: 所有进程同时开始, --connect-rate 为所有进程合计的每秒握手数
+    await wait_barrier(barrier)
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    connect_start = time.time()
+    start = loop.time()
+    per_process_rate = args.connect_rate / args.procs if args.connect_rate else 0
+
+    async def connect(i, client):
+        if per_process_rate:
+            await asyncio.sleep(max(start + i / per_process_rate - loop.time(), 0))
+        async with semaphore:
+            try:
+                await client.connect()
+                return True
+            except Exception:
+                stats['errors'] += 1
+                return False
+
+    connected = await asyncio.gather(*[connect(i, client) for i, client in enumerate(clients)])
+    connect_end = time.time()
+    clients = [client for client, ok in zip(clients, connected) if ok]
+
+    # 2. 登录, 所有进程的用户都在线后再开始 DH, 配对的用户可能在其他进程
+    # 服务器拒绝时间戳偏差超过 3 秒的请求, 登录也限制并发, 不让请求在服务器上排队太久
+    async def login(client):
+        async with semaphore:
+            return await client.login()
+
+    logins = await asyncio.gather(*[login(client) for client in clients], return_exceptions=True)
+    for client in clients:
+        client.listen()
+    await wait_barrier(barrier)
+    for client in clients:
+        if client.partner is not None and client.index % 2 == 0:
+            client.client.send_dh_request(client.partner, True)
+    deadline = loop.time() + args.dh_timeout
+    while not all(client.dh_ready() for client in clients) and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+
+    # 3. 按比例执行操作
+    await wait_barrier(barrier)
+    ops = list(args.mix)
+    weights = [args.mix[op] for op in ops]
+    traffic_start = time.time()
+    deadline = loop.time() + args.duration
+    rate = args.rate / args.clients
+    if rate > 0:
+        await asyncio.gather(*[client.drive(rate, deadline, ops, weights) for client in clients])
+    traffic_end = time.time()
+    await asyncio.sleep(args.drain)  # 等待在途的消息送达
+
+    for client in clients:
+        client.listener.cancel()
+    await asyncio.gather(*[client.client.close() for client in clients], return_exceptions=True)
+    return {
+        'connected': len(clients),
+        'logged_in': sum(1 for login in logins if login is True),
+        'dh_ready': sum(1 for client in clients if client.dh_ready()),
+        'connect': (connect_start, connect_end),
+        'traffic': (traffic_start, traffic_end),
+        'stats': export_stats(stats)
+    }
+
+
+class ServerMonitor(threading.Thread):
+    # 定期采样服务器进程树的 (时间, CPU 秒数, 常驻内存)
+    def __init__(self, pid, interval=0.5):
+        threading.Thread.__init__(self, daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            cpu, rss = tree_usage(self.pid)
+            self.samples.append((time.time(), cpu, rss))
+            self.stopped.wait(self.interval)
+
+    def window(self, start, end):  # 时间段内的 CPU 利用率 (核数) 和最大常驻内存
+        inside = [sample for sample in self.samples if start <= sample[0] <= end]
+        before = [sample for sample in self.samples if sample[0] <= start][-1:]
+        after = [sample for sample in self.samples if sample[0] >= end][:1]
+        points = before + inside + after
+        if len(points) < 2:
+            return None
+        cpu = (points[-1][1] - points[0][1]) / (points[-1][0] - points[0][0])
+        return {'cpu_cores': cpu, 'rss_max_mb': max(sample[2] for sample in points) / 2 ** 20}
+
+
+def summarize(samples):
+    values = [value for sample in samples for value in sample['values']]
+    return {
+        'count': sum(sample['count'] for sample in samples),
+        'p50_ms': percentile(values, 50) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values) * 1000 if values else 0.0
+    }
+
+
+def report(args, results, monitor):
+    stats = [result['stats'] for result in results]
+    connect_start = min(result['connect'][0] for result in results)
+    connect_end = max(result['connect'][1] for result in results)
+    traffic_start = min(result['traffic'][0] for result in results)
+    traffic_end = max(result['traffic'][1] for result in results)
+    connected = sum(result['connected'] for result in results)
+    traffic_time = traffic_end - traffic_start
+
+    summary = {
+        'clients': args.clients,
+        'connected': connected,
+        'logged_in': sum(result['logged_in'] for result in results),
+        'dh_ready': sum(result['dh_ready'] for result in results),
+        'handshakes_per_sec': connected / (connect_end - connect_start),
+        'handshake': summarize([s['handshake'] for s in stats]),
+        'ops_per_sec': sum(sum(s['sent'].values()) for s in stats) / traffic_time if traffic_time else 0.0,
+        'sent': {op: sum(s['sent'][op] for s in stats) for op in OPS},
+        'received': {kind: sum(s['received'][kind] for s in stats) for kind in ('send_user', 'broadcast')},
+        'delivery': {kind: summarize([s['delivery'][kind] for s in stats]) for kind in ('send_user', 'broadcast')},
+        'rtt': {kind: summarize([s['rtt'][kind] for s in stats]) for kind in ('list', 'reconnect')},
+        'errors': sum(s['errors'] for s in stats)
+    }
+    if monitor is not None:
+        summary['server_connect'] = monitor.window(connect_start, connect_end)
+        summary['server_traffic'] = monitor.window(traffic_start, traffic_end)
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(summary):
+    print(f'connected {summary["connected"]}/{summary["clients"]}  logged in {summary["logged_in"]}  '
+          f'dh ready {summary["dh_ready"]}  errors {summary["errors"]}')
+    handshake = summary['handshake']
+    print(f'handshakes/s {summary["handshakes_per_sec"]:.1f}  '
+          f'handshake p50 {handshake["p50_ms"]:.1f} ms  p99 {handshake["p99_ms"]:.1f} ms')
+    print(f'ops/s {summary["ops_per_sec"]:.1f}  sent {summary["sent"]}  received {summary["received"]}')
+    for group in ('delivery', 'rtt'):
+        for kind, values in summary[group].items():
+            if values['count']:
+                print(f'{group} {kind:<10} n={values["count"]:<8} p50 {values["p50_ms"]:.1f} ms  '
+                      f'p99 {values["p99_ms"]:.1f} ms  max {values["max_ms"]:.1f} ms')
+    for phase in ('server_connect', 'server_traffic'):
+        if summary.get(phase):
+            print(f'{phase:<15} cpu {summary[phase]["cpu_cores"]:.2f} cores  rss {summary[phase]["rss_max_mb"]:.1f} MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--procs', type=int, default=4, help='客户端进程数')
+    parser.add_argument('--rate', type=float, default=200, help='所有客户端合计每秒的操作数')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('send_user=90,list=9,broadcast=1'),
+                        help=f'操作权重, 例如 send_user=90,list=9,broadcast=1, 可用: {", ".join(OPS)}')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--drain', type=float, default=2, help='结束后等待在途消息的秒数')
+    parser.add_argument('--message-size', type=int, default=64)
+    parser.add_argument('--connect-rate', type=float, default=0, help='每秒握手数上限, 0 表示不限')
+    parser.add_argument('--connect-concurrency', type=int, default=100, help='每个进程同时进行的握手/登录数')
+    parser.add_argument('--dh-timeout', type=float, default=30)
+    parser.add_argument('--provider', choices=list(crypto.PROVIDERS), default=crypto.DEFAULT_PROVIDER)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=19983)
+    parser.add_argument('--target', action='store_true', help='连接已经运行的服务器, 不启动 server_main')
+    parser.add_argument('--server-pid', type=int, default=None, help='与 --target 一起使用时采样该进程的 CPU/内存')
+    parser.add_argument('--server-args', default='', help='传给 server_main.py 的参数, 例如 "--workers 2"')
+    parser.add_argument('--label', default='', help='写进结果的说明')
+    parser.add_argument('--output', default=None, help='JSON 结果文件')
+    args = parser.parse_args()
+    args.prefix = f'lg{random.randrange(36 ** 4):04x}_'  # 每次运行使用新的用户名
+
+    raise_nofile()
+    crypto.set_provider(args.provider)
+    server = None
+    pid = args.server_pid
+    if not args.target:
+        server = spawn_server_main(args.port, *shlex.split(args.server_args))
+        pid = server.pid
+    monitor = ServerMonitor(pid) if pid else None
+    if monitor is not None:
+        monitor.start()
+
+    try:
+        results = run_client_processes(run_process, args.procs, args)
+    finally:
+        if monitor is not None:
+            monitor.stopped.set()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    summary = report(args, results, monitor)
+    print_summary(summary)
+    if args.output:
+        config = {key: value for key, value in vars(args).items() if key != 'prefix'}
+        with open(args.output, 'w') as f:
+            f.write(json.dumps({
+                'label': args.label,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'commit': git_commit(),
+                'host': {'python': platform.python_version(), 'cpus': os.cpu_count()},
+                'config': config,
+                'results': summary
+            }, indent=2, ensure_ascii=False))
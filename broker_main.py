@@ -0,0 +1,23 @@
+from classes.bus import BusHub
+import argparse
+import asyncio
+import logging
+
+# 集群模式的参考 broker: 维护所有节点的在线用户目录, 把消息转发到用户所在的节点
+# 节点启动时使用 python server_main.py --broker tcp:HOST:PORT --node-id NAME
+
+logging.basicConfig(level=logging.INFO)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='加密聊天室集群 broker')
+    parser.add_argument('--listen', default='tcp:127.0.0.1:9900', help='监听地址, tcp:host:port 或 unix:/path')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(BusHub().start(args.listen))
+    logging.info(f'broker 开启在 {args.listen}')
+    loop.run_forever()
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import os
+from urllib.parse import urlsplit, parse_qsl
+from classes.bus import parse_address
+
+# 本机管理接口: 极简的 HTTP/1.0 服务器, 每个连接处理一个 GET 请求后关闭
+# 地址格式和总线相同: unix:/path (curl --unix-socket /path http://x/metrics) 或 tcp:127.0.0.1:port,
+# 接口没有认证, 只应该监听本机地址
+# 路由的处理函数接收查询参数 dict, 返回 (状态码, Content-Type, 正文), 可以是协程函数
+
+logger = logging.getLogger(__name__)
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class AdminServer():
+    def __init__(self):
+        self.routes = dict()
+        self.server = None
+
+    def route(self, path, handler):
+        self.routes[path] = handler
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass  # 忽略请求头
+            status, content_type, body = await self.dispatch(request_line.decode('latin-1'))
+        except (asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        head = f'HTTP/1.0 {status} {REASONS.get(status, "")}\r\nContent-Type: {content_type}\r\n' \
+               f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+        writer.write(head.encode('latin-1') + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def dispatch(self, request_line):
+        parts = request_line.split()
+        if len(parts) < 2:
+            return 400, 'text/plain', '请求格式错误\n'
+        if parts[0] != 'GET':
+            return 405, 'text/plain', '只支持 GET\n'
+        url = urlsplit(parts[1])
+        handler = self.routes.get(url.path)
+        if handler is None:
+            return 404, 'text/plain', '可用的路径: ' + ' '.join(sorted(self.routes)) + '\n'
+        try:
+            result = handler(dict(parse_qsl(url.query)))
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+        except Exception as e:
+            logger.exception(f'管理接口 {url.path} 出错')
+            return 500, 'text/plain', f'{type(e).__name__}: {e}\n'
+
+    async def start(self, address):
+        scheme, target = parse_address(address)
+        if scheme == 'tcp':
+            self.server = await asyncio.start_server(self.handle, *target)
+        else:
+            if os.path.exists(target):
+                os.remove(target)  # 上次运行留下的 socket 文件
+            self.server = await asyncio.start_unix_server(self.handle, target)
+        logger.info(f'管理接口监听 {address}')
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
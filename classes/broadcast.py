@@ -0,0 +1,54 @@
+import asyncio
+import logging
+import time
+from utils.protocols import encode_data
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+_tasks = set()
+
+FANOUT = metrics.histogram('chat_broadcast_fanout', '每次广播推送的连接数', ('type',), metrics.SIZE_BUCKETS)
+BROADCAST_SECONDS = metrics.histogram('chat_broadcast_seconds', '一次广播从开始到全部入队的时间', ('type',))
+
+
+def enqueue(servers, req_type, data):
+    # 不让出事件循环地放进每个连接的发送队列, 之后推送的消息 (同一个处理函数里的响应、presence 变化、私聊) 都排在广播后面;
+    # 加密和写出在各个连接的队列里进行, 这里每个连接只是一次入队. 返回 block 策略下队列已满、需要等待的 [(server, raw)]
+    message = {'type': req_type, 'data': data}
+    raws = {}  # 每种编码格式只序列化一次, 每个连接只做加密
+    blocked = []
+    count = 0
+    logger.debug(f'broadcast {req_type}: {data}')
+
+    for server in servers:
+        raw = raws.get(server.codec)
+        if raw is None:
+            raw = raws[server.codec] = encode_data(message, server.codec)
+        if not server.died and not server.outbound.offer(raw):
+            blocked.append((server, raw))
+        count += 1
+    FANOUT.labels(req_type).observe(count)
+    return blocked
+
+
+async def _put_blocked(blocked, req_type, start):
+    for server, raw in blocked:
+        await server.outbound.put(raw)  # block 策略: 等待慢速客户端腾出空间
+    BROADCAST_SECONDS.labels(req_type).observe(time.perf_counter() - start)
+
+
+async def broadcast(servers, req_type, data):
+    start = time.perf_counter()
+    await _put_blocked(enqueue(servers, req_type, data), req_type, start)
+
+
+def spawn_broadcast(servers, req_type, data):  # 立即入队, 只有等待慢速客户端的部分在任务里进行; 没有时返回 None
+    start = time.perf_counter()
+    blocked = enqueue(servers, req_type, data)
+    if not blocked:
+        BROADCAST_SECONDS.labels(req_type).observe(time.perf_counter() - start)
+        return None
+    task = asyncio.ensure_future(_put_blocked(blocked, req_type, start))
+    _tasks.add(task)  # 保存引用, 防止任务在完成前被回收
+    task.add_done_callback(_tasks.discard)
+    return task
@@ -0,0 +1,280 @@
+import asyncio
+import logging
+from utils.protocols import pack_data, unpack_data, read_length, BINARY_CODEC
+
+# 工作进程/节点之间的路由总线: BusHub 维护在线用户目录并转发消息, 每个工作进程连接一个 BusClient
+#   单机多进程: 主进程运行 BusHub, 地址为 unix:/path
+#   多节点集群: broker_main.py 单独运行 BusHub, 地址为 tcp:host:port, 各节点的工作进程都连接到它
+# 消息为长度前缀的二进制格式 (utils.protocols.BinaryCodec), 私聊中的 bytes 字段原样转发, 字段 op 表示类型:
+#   hello      工作进程 -> 总线   {worker}  断线重连后工作进程会重新发送本地用户的 online
+#   snapshot   总线 -> 工作进程   {users: {username: worker}}
+#   online     双向               {username, worker}  总线转发给其他工作进程, 旧连接所在的进程会收到 kick
+#   offline    双向               {username, worker}
+#   kick       总线 -> 工作进程   {username}
+#   send_user  双向               {username, type, data}  转发给用户所在的进程, dh_request 也走这里;
+#                                  离线消息带 durable (不可丢弃), 每批最后一条带 ack (seq) 和 reply (发出的进程)
+#   delivered  双向               {worker, username, seq}  用户所在的进程把带 ack 的消息交给连接之后回复给 worker
+#   broadcast  双向               {worker, type, data}  转发给其他所有工作进程
+
+logger = logging.getLogger(__name__)
+
+
+async def read_message(reader):
+    length = read_length(await reader.readexactly(4))
+    return unpack_data(await reader.readexactly(length), BINARY_CODEC)
+
+
+def parse_address(address):  # unix:/path, tcp:host:port 或者直接是 Unix socket 路径
+    scheme, _, rest = address.partition(':')
+    if scheme == 'tcp':
+        host, _, port = rest.rpartition(':')
+        return scheme, (host, int(port))
+    if scheme == 'unix':
+        return scheme, rest
+    return 'unix', address
+
+
+async def open_connection(address):
+    scheme, target = parse_address(address)
+    if scheme == 'tcp':
+        return await asyncio.open_connection(*target)
+    return await asyncio.open_unix_connection(target)
+
+
+class RoutingBackend():
+    # 在线用户目录和跨进程/跨节点转发的接口, 服务器只通过这些方法使用它
+    # handlers 为 op -> 协程函数, 收到 online/offline/kick/send_user/broadcast 时调用,
+    # 每次 (重新) 连上后调用 connected, 服务器借此重新登记本地用户
+    users: dict  # 其他进程/节点上的在线用户 -> 所在的工作进程
+
+    async def connect(self, address):
+        raise NotImplementedError
+
+    def owner(self, username):
+        return self.users.get(username)
+
+    def online(self, username):
+        raise NotImplementedError
+
+    def offline(self, username):
+        raise NotImplementedError
+
+    def send_user(self, username, req_type, data, durable=False, ack=None):
+        raise NotImplementedError
+
+    def delivered(self, worker, username, seq):
+        raise NotImplementedError
+
+    def broadcast(self, req_type, data):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class BusHub():
+    # 在线用户目录 (用户名 -> 工作进程) 只由总线维护, 工作进程保存它的副本
+    def __init__(self):
+        self.users = dict()
+        self.workers = dict()  # worker -> StreamWriter
+        self.forwarded = 0
+
+    def send(self, worker, message):
+        writer = self.workers.get(worker)
+        if writer is not None:
+            writer.write(pack_data(message, BINARY_CODEC))
+            self.forwarded += 1
+
+    def send_others(self, worker, message):
+        data = pack_data(message, BINARY_CODEC)  # 只序列化一次
+        for other, writer in self.workers.items():
+            if other != worker:
+                writer.write(data)
+                self.forwarded += 1
+
+    def handle_online(self, message):
+        username = message['username']
+        worker = message['worker']
+        old = self.users.get(username)
+        if old is not None and old != worker:
+            self.send(old, {'op': 'kick', 'username': username})  # 同一用户在其他进程重复登录
+        self.users[username] = worker
+        self.send_others(worker, message)
+
+    def handle_offline(self, message):
+        username = message['username']
+        if self.users.get(username) == message['worker']:  # 已经被其他进程的新登录取代时忽略
+            self.users.pop(username)
+            self.send_others(message['worker'], message)
+
+    async def handle_worker(self, reader, writer):
+        worker = None
+        try:
+            message = await read_message(reader)
+            worker = message['worker']
+            self.workers[worker] = writer
+            self.send(worker, {'op': 'snapshot', 'users': self.users})
+            logger.info(f'工作进程 {worker} 连接到总线')
+
+            while True:
+                message = await read_message(reader)
+                op = message['op']
+                if op == 'online':
+                    self.handle_online(message)
+                elif op == 'offline':
+                    self.handle_offline(message)
+                elif op == 'send_user':
+                    owner = self.users.get(message['username'])
+                    if owner is not None:
+                        self.send(owner, message)
+                elif op == 'broadcast':
+                    self.send_others(message['worker'], message)
+                elif op == 'delivered':
+                    self.send(message['worker'], message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if worker is not None and self.workers.get(worker) is writer:
+                self.workers.pop(worker)
+                logger.info(f'工作进程 {worker} 断开总线')
+                for username in [name for name, owner in self.users.items() if owner == worker]:
+                    self.handle_offline({'op': 'offline', 'username': username, 'worker': worker})
+            writer.close()
+
+    async def start(self, address):
+        scheme, target = parse_address(address)
+        if scheme == 'tcp':
+            return await asyncio.start_server(self.handle_worker, *target)
+        return await asyncio.start_unix_server(self.handle_worker, target)
+
+
+class BusClient(RoutingBackend):
+    # 工作进程一端: users 为其他进程在线用户的副本, 收到的消息交给 handlers 中对应 op 的回调
+    # 重连后总线 (例如重启的 broker) 的快照可能还不完整, 快照里缺少的用户在 RESYNC_GRACE 秒内
+    # 没有被重新登记才算下线, 已知的用户重新登记时不再通知客户端
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+
+    RESYNC_GRACE = 5
+
+    def __init__(self, worker, handlers):
+        self.worker = worker
+        self.handlers = handlers
+        self.users = dict()
+        self._stale = dict()  # 重连后尚未重新登记的用户 -> 原来所在的工作进程
+        self.address = None
+        self.reader = None
+        self.writer = None
+        self._task = None
+
+    async def connect(self, address, timeout=30):
+        self.address = address
+        await self._open(timeout)
+        self._task = asyncio.ensure_future(self.listen())
+
+    async def _open(self, timeout=None):  # timeout 为 None 时一直重试
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        while True:
+            try:
+                self.reader, self.writer = await open_connection(self.address)
+                break
+            except OSError:
+                if deadline is not None and loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)  # 总线还没有开始监听或者正在重启
+        self.send({'op': 'hello', 'worker': self.worker})
+        await self.dispatch({'op': 'connected'})
+
+    def send(self, message):
+        if not self.writer.is_closing():
+            self.writer.write(pack_data(message, BINARY_CODEC))
+
+    async def dispatch(self, message):
+        if message['op'] in self.handlers:
+            try:
+                await self.handlers[message['op']](message)
+            except Exception:
+                logger.exception(f'处理总线消息 {message["op"]} 失败')
+
+    def online(self, username):
+        self.send({'op': 'online', 'username': username, 'worker': self.worker})
+
+    def offline(self, username):
+        self.send({'op': 'offline', 'username': username, 'worker': self.worker})
+
+    def send_user(self, username, req_type, data, durable=False, ack=None):
+        message = {'op': 'send_user', 'username': username, 'type': req_type, 'data': data}
+        if durable:
+            message['durable'] = True
+        if ack is not None:
+            message['ack'] = ack
+            message['reply'] = self.worker
+        self.send(message)
+
+    def delivered(self, worker, username, seq):
+        self.send({'op': 'delivered', 'worker': worker, 'username': username, 'seq': seq})
+
+    def broadcast(self, req_type, data):
+        self.send({'op': 'broadcast', 'worker': self.worker, 'type': req_type, 'data': data})
+
+    async def listen(self):
+        while True:
+            try:
+                message = await read_message(self.reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.warning(f'与总线 {self.address} 的连接断开, 正在重连')
+                self.writer.close()
+                await self._open()
+                continue
+            op = message['op']
+            if op == 'snapshot':
+                await self.resync(message['users'])
+                continue
+            elif op == 'online':
+                username = message['username']
+                known = self.users.get(username) == message['worker']
+                self.users[username] = message['worker']
+                if self._stale.pop(username, None) is not None and known:
+                    continue  # 重连后重新登记的已知用户
+            elif op == 'offline':
+                if self.users.get(message['username']) == message['worker']:
+                    self.users.pop(message['username'])
+            await self.dispatch(message)
+
+    async def resync(self, users):
+        users = {name: owner for name, owner in users.items() if owner != self.worker}
+        for name, owner in users.items():
+            if self.users.get(name) != owner:
+                self.users[name] = owner
+                await self.dispatch({'op': 'online', 'username': name, 'worker': owner})
+        self._stale = {name: owner for name, owner in self.users.items() if name not in users}
+        if self._stale:
+            asyncio.get_event_loop().call_later(self.RESYNC_GRACE, lambda: asyncio.ensure_future(self.expire_stale()))
+
+    async def expire_stale(self):
+        stale, self._stale = self._stale, dict()
+        for name, owner in stale.items():
+            if self.users.get(name) == owner:
+                self.users.pop(name)
+                await self.dispatch({'op': 'offline', 'username': name, 'worker': owner})
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+BACKENDS = {
+    'unix': BusClient,
+    'tcp': BusClient
+}
+
+
+def register_backend(scheme, backend):  # backend(worker, handlers) 需要实现 RoutingBackend 的方法
+    BACKENDS[scheme] = backend
+
+
+def create_backend(address, worker, handlers):
+    return BACKENDS.get(address.partition(':')[0], BusClient)(worker, handlers)  # 不带前缀的地址为 Unix socket 路径
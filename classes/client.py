@@ -1,55 +1,162 @@
 from utils.protocols import *
+from struct import pack
 from base64 import b64encode, b64decode
-import rsa
 import random
 import time
-from utils.tools import random_string, DH, sha3_256
+from utils import crypto
+from utils.tools import random_string, sha3_256
+from utils.history_ring import iter_records
 import asyncio
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+SESSION_KEY_TTL = 7 * 24 * 3600  # 私聊密钥的有效期, 过期后重新协商
+DH_RETRY = 30  # 发起的 DH 超过这个秒数没有完成时重新发起
+OUTBOX_LIMIT = 1000  # 每个用户等待密钥协商的消息数, 超过时丢弃最早的
 
-class Client(DH):
+
+def dh_generate():  # 发起协商: -> (dh_private, dh_public)
+    dh_private = crypto.dh_gen_private()
+    return dh_private, crypto.dh_get_public(dh_private)
+
+
+def dh_respond(dh_his_public):  # 回应对方发起的协商: -> (dh_public, 共同密钥)
+    dh_private = crypto.dh_gen_private()
+    return crypto.dh_get_public(dh_private), sha3_256(crypto.dh_get_common_key(dh_private, dh_his_public))
+
+
+def dh_finish(dh_private, dh_his_public):
+    return sha3_256(crypto.dh_get_common_key(dh_private, dh_his_public))
+
+
+def _ping():
+    pass
+
+
+def make_crypto_executor():
+    # Client.crypto_executor: OpenSSL 计算时释放 GIL, 一个线程就不阻塞事件循环; 纯 Python 的 pow() 和 rsa 模块一直持有 GIL,
+    # 放在线程里界面照样卡顿, 改用一个工作进程 (DH 的整数和 rsa 模块的密钥都可以 pickle)
+    provider = crypto.get_provider()
+    if provider.native:
+        return ThreadPoolExecutor(1, thread_name_prefix='client-crypto')
+    executor = ProcessPoolExecutor(1, multiprocessing.get_context('fork'), initializer=crypto.set_provider,
+                                   initargs=(provider.name,))
+    executor.submit(_ping).result()  # 立即启动工作进程, 避免之后在已有其他线程 (Qt) 的进程里 fork
+    return executor
+
+
+class Client():
     reader: asyncio.StreamReader
     writer: asyncio.StreamWriter
 
-    server_public_key: rsa.PublicKey
-    aes_gcm_key = b''
+    server_public_key = None
+    cipher: SessionCipher
+    codec = JSON_CODEC  # 握手时协商的帧编码格式
+    wire = WIRE_FORMATS  # 握手时提供的编码格式, 按偏好排列
+    compress = ()  # 握手时请求的压缩方式, 默认不压缩
+    compressor: FrameCompressor = None
+    decompressor: FrameDecompressor = None
     server_count = 0
     client_count = 0
 
-    user_dh_keys = {}
     username = ""
     handshake = False
+    kex = None  # 握手协商出的密钥交换方式
+    version = 1  # 握手协商出的协议版本, 3 以上的服务器会在响应里带回请求的 id
+    # 私聊 DH 和登录签名在这个 executor (由 make_crypto_executor 创建) 里计算, 不阻塞界面所在的事件循环; None 时直接计算
+    crypto_executor = None
+    # read_loop 连续处理缓冲区里的帧超过这个秒数后让出事件循环, 一批推送不会一直占用界面线程; None 时不让出
+    # 私聊的 AES 解密和帧解码留在事件循环里: 每条约 20 us (解密 13 us, 解码 5-8 us), 放进 executor 往返约 77 us,
+    # 反而更慢; 按时间片让出后一批推送每片最多处理约 250 条
+    read_slice = 0.005
 
     def __init__(self, reader, writer):
         with open('server_public_key') as f:
-            self.server_public_key = rsa.PublicKey.load_pkcs1(f.read())
+            self.server_public_key = crypto.load_public_key(f.read())
         self.reader = reader
         self.writer = writer
 
-        self.client_count = random.randint(0, 18446744073709551616)
-        self.server_count = random.randint(0, 18446744073709551616)
+        self.client_count = random.randint(0, COUNT_MASK)
+        self.server_count = random.randint(0, COUNT_MASK)
+
+        # 连接只由 read_loop 读取: 响应按 id 交给等待它的 future, 推送交给 start_listen 的回调,
+        # 还没有开始监听时放进 pushes 队列, 由 get_response 取出
+        self.pending = dict()  # 请求 id -> (future, 发送时间)
+        self.order = deque()  # 旧服务器不带回 id, 响应按请求顺序对应; None 代表不等待响应的请求
+        self.pushes = asyncio.Queue()
+        self.callbacks = None
+        self.closed_exc = None  # 连接断开或读取出错的原因
+        self._reader_task = None
+        self.next_id = 0
+        self.completed = 0
+        self.max_in_flight = 0
+        self.latencies = deque(maxlen=1024)  # 最近完成的请求的往返时间 (秒)
+
+        self.roster = set()  # 协议版本 4 起由 presence 推送维护的在线用户 (包括自己)
+        self.presence_version = None  # 收到完整列表之前为 None
+        self.presence_syncing = False
+
+        # 私聊密钥只在打开会话或第一次发消息时协商 (ensure_key), 协商完成之前发出的消息在 outbox 里排队
+        self.user_dh_keys = dict()  # 用户名 -> {dh_private, dh_public (协商中), dh_common_key, expires}
+        self.outbox = dict()  # 用户名 -> 等待密钥的消息
+        self.inbox = dict()  # 用户名 -> 协商期间收到的消息
+        self.key_cache = None  # 有 save/load/delete_session_key 的对象 (MessageStore), 密钥在重新登录后继续使用
+
+    async def send_handshake(self, kex=None):
+        kex = kex or crypto.get_provider().kex[0]
+        if kex == crypto.KEX_X25519 and await self.send_handshake_x25519():
+            return
+        await self.send_handshake_dh()  # 服务器不支持 X25519 时退回 DH 握手
+
+    async def send_handshake_x25519(self):
+        x25519_private = crypto.x25519_gen_private()
+        x25519_public = crypto.x25519_get_public(x25519_private)
+        request = {
+            'version': PROTOCOL_VERSION,
+            'kex': crypto.KEX_X25519,
+            'wire': list(self.wire),
+            'compress': list(self.compress),
+            'x25519_public': b64encode(x25519_public).decode('utf-8')
+        }
+        self.writer.write(pack_data(request))
+        res = await self.get_response_without_enc()
+        if not res['success']:
+            if crypto.KEX_DH in res.get('data', {}).get('kex', []):
+                return False
+            raise Exception(f'握手失败: {res.get("msg")}')
 
-    def add_server_count(self):
-        self.server_count += 1
-        if self.server_count == 18446744073709551616:
-            self.server_count = 0
+        res = res['data']
+        sign = b64decode(res['sign'])
+        server_public = b64decode(res['x25519_public'])
+        if not crypto.verify_pss(crypto.X25519_LABEL + x25519_public + server_public, sign, self.server_public_key):
+            raise Exception('签名验证不成功, 可能为中间人攻击')
 
-    def add_client_count(self):
-        self.client_count += 1
-        if self.client_count == 18446744073709551616:
-            self.client_count = 0
+        key, self.client_count, self.server_count = \
+            crypto.x25519_derive(x25519_private, x25519_public, server_public, server_public)
+        self.cipher = SessionCipher(key, self.client_count, self.server_count)
+        self.codec = negotiate_wire([res.get('wire')])
+        self.start_compression(res.get('compress'))
+        self.version = res.get('version', 2)
+        self.kex = crypto.KEX_X25519
+        self.handshake = True
+        return True
 
-    async def send_handshake(self):
-        client_count = rsa.encrypt(pack('>Q', self.client_count), self.server_public_key)
-        server_count = rsa.encrypt(pack('>Q', self.server_count), self.server_public_key)
+    async def send_handshake_dh(self):
+        client_count = crypto.encrypt(pack('>Q', self.client_count), self.server_public_key)
+        server_count = crypto.encrypt(pack('>Q', self.server_count), self.server_public_key)
 
-        dh_private = self.dh_gen_private()
-        dh_public = self.dh_get_public(dh_private)
+        dh_private = crypto.dh_gen_private()
+        dh_public = crypto.dh_get_public(dh_private)
 
         dh_public = dh_public.to_bytes(233, 'big')
-        dh_public = rsa.encrypt(dh_public, self.server_public_key)
+        dh_public = crypto.encrypt(dh_public, self.server_public_key)
 
         request = {
+            'version': PROTOCOL_VERSION,
+            'kex': crypto.KEX_DH,
+            'wire': list(self.wire),
+            'compress': list(self.compress),
             'dh_public': b64encode(dh_public).decode('utf-8'),
             'client_count': b64encode(client_count).decode('utf-8'),
             'server_count': b64encode(server_count).decode('utf-8')
@@ -62,61 +169,196 @@ class Client(DH):
         sign = b64decode(res['sign'])
         dh_other_public = b64decode(res['dh_public'])
 
-        try:
-            ret = rsa.verify(dh_other_public, sign, self.server_public_key)
-            assert ret == 'SHA-512'
-        except Exception:
+        if not crypto.verify(dh_other_public, sign, self.server_public_key):
             raise Exception('签名验证不成功, 可能为中间人攻击')
 
         dh_other_public = int.from_bytes(dh_other_public, 'big')
-        tmp_key = self.dh_get_common_key(dh_private, dh_other_public)
-        self.aes_gcm_key = sha3_256(tmp_key)
-
+        tmp_key = crypto.dh_get_common_key(dh_private, dh_other_public)
+        self.cipher = SessionCipher(sha3_256(tmp_key), self.client_count, self.server_count)
+        self.codec = negotiate_wire([res.get('wire')])  # 旧服务器不返回 wire, 使用 JSON
+        self.start_compression(res.get('compress'))
+        self.version = res.get('version', 1)
+        self.kex = crypto.KEX_DH
         self.handshake = True
 
+    def start_compression(self, compression):  # 服务器同意时每个方向建立一个压缩流
+        if compression is not None and compression in self.compress:
+            self.compressor = FrameCompressor()
+            self.decompressor = FrameDecompressor()
+
     async def start_listen(self, callbacks):
         def handle_send_user(self, response):
             response = response['data']
             username = response['from']
-            if username in self.user_dh_keys:
-                iv = b64decode(response['iv'])
-                ciphertext = b64decode(response['ciphertext'])
+            keys = self.user_dh_keys.get(username)
+            negotiating = keys is not None and 'dh_common_key' not in keys
+            if not self.ensure_key(username):
+                if negotiating:  # 对方收到回应后立即发出的消息可能比这边算出密钥先到, 密钥算出后再处理
+                    queue = self.inbox.get(username)
+                    if queue is None:
+                        queue = self.inbox[username] = deque(maxlen=OUTBOX_LIMIT)
+                    queue.append(response)
+                else:  # 用已经失效的密钥加密的消息无法解密, 已经重新协商, 告诉界面这条消息丢失
+                    self.message_lost(username)
+                return
+            iv = as_bytes(response['iv'])
+            ciphertext = as_bytes(response['ciphertext'])
+            try:
                 plaintext = decrypt_aes_cbc(iv, ciphertext, self.user_dh_keys[username]['dh_common_key'])
-                if 'send_user' in callbacks:
-                    callbacks['send_user'](self, {
-                        'type': 'send_user',
-                        'data': {
-                            'from': username,
-                            'message': plaintext.decode()
-                        }
-                    })
+                message = plaintext.decode()
+            except ValueError:  # 对方已经没有这个密钥 (例如清除了本地记录), 重新协商, 这条消息丢失
+                self.drop_key(username)
+                self.ensure_key(username)
+                self.message_lost(username)
+                return
+            if 'send_user' in callbacks:
+                callbacks['send_user'](self, {
+                    'type': 'send_user',
+                    'data': {
+                        'from': username,
+                        'message': message
+                    }
+                })
+
+        def handle_presence(self, response):
+            data = response['data']
+            first = self.presence_version is None
+            if 'success' in response:  # presence 请求的响应, 从请求的版本开始, 不检查是否连续
+                self.presence_syncing = False
+            if data.get('full'):
+                users = set(data['online'])
+                online, offline = users - self.roster, self.roster - users
+                self.roster = users
+            elif first or data['version'] <= self.presence_version:
+                return  # 完整列表还没有到, 或者这批变化已经包含在列表里
+            elif 'success' not in response and (self.presence_syncing or data['version'] != self.presence_version + 1):
+                # 推送中间缺了一批 (例如慢速连接上被发送队列丢弃), 请求缺少的变化, 响应到达之前忽略推送
+                if not self.presence_syncing:
+                    self.presence_syncing = True
+                    self.send_request('presence', {'since': self.presence_version})
+                return
+            else:
+                online = set(data['online']) - self.roster  # 重新同步时可能包含已经知道的变化
+                offline = set(data['offline']) & self.roster
+                self.roster |= online
+                self.roster -= offline
+            self.presence_version = data['version']
+
+            if first:
+                if 'list' in callbacks:
+                    users = [username for username in self.roster if username != self.username]
+                    callbacks['list'](self, {'type': 'list', 'data': users})
+                return
+            for req_type, usernames in (('online', online), ('offline', offline)):
+                if req_type in callbacks:
+                    for username in usernames:
+                        if username != self.username:
+                            callbacks[req_type](self, {'type': req_type, 'data': username})
+
+        def handle_history(self, response):  # 登录时的推送和翻页请求的响应, 解析成消息列表
+            if 'history' in callbacks and response.get('success', True):
+                data = response['data']
+                messages = [{'seq': seq, 'timestamp': timestamp, 'from': sender, 'message': message}
+                            for seq, timestamp, sender, message in iter_records(as_bytes(data['records']))]
+                callbacks['history'](self, {
+                    'type': 'history',
+                    'data': {'first': data['first'], 'more': data['more'], 'messages': messages}
+                })
 
         default_callbacks = {
             'dh_request': self.complete_dh,
-            'send_user': handle_send_user
+            'send_user': handle_send_user,
+            'presence': handle_presence,
+            'history': handle_history
         }
 
         for key in callbacks:
             if key not in default_callbacks:
                 default_callbacks[key] = callbacks[key]
 
-        while True:
-            length = await self.reader.readexactly(4)
-            length = read_length(length)
-            data = await self.reader.readexactly(length)
-            response = unpack_enc_data(data, self.server_count, self.aes_gcm_key)
-            self.add_server_count()
-            if response['type'] in default_callbacks:
-                default_callbacks[response['type']](self, response)
-            else:
-                pass
-
-    async def get_response(self):
+        task = self.start_reader()
+        self.callbacks = default_callbacks
+        try:
+            while not self.pushes.empty():  # 开始监听之前收到的推送
+                response = self.pushes.get_nowait()
+                if response is None:
+                    break
+                self.dispatch(response)
+            await asyncio.shield(task)  # 取消监听时不取消 read_loop, 之后的推送重新放进队列
+            raise self.closed_exc
+        finally:
+            self.callbacks = None
+
+    def dispatch(self, response):
+        if response.get('type') in self.callbacks:
+            self.callbacks[response['type']](self, response)
+
+    def start_reader(self):
+        if self._reader_task is None:
+            self._reader_task = asyncio.ensure_future(self.read_loop())
+        return self._reader_task
+
+    async def read_loop(self):
+        try:
+            slice_start = time.perf_counter()
+            while True:
+                # 缓冲区里还有数据时 readexactly 不会让出事件循环
+                response = await self.read_frame()
+                future = self.pop_pending(response) if 'success' in response else None  # 推送没有 success 字段
+                if future is not None:
+                    if not future.done():
+                        future.set_result(response)
+                elif self.callbacks is not None:
+                    self.dispatch(response)
+                else:
+                    self.pushes.put_nowait(response)
+                if self.read_slice is not None and time.perf_counter() - slice_start > self.read_slice:
+                    await asyncio.sleep(0)
+                    slice_start = time.perf_counter()
+        except Exception as e:
+            self.closed_exc = e
+        finally:
+            if self.closed_exc is None:
+                self.closed_exc = ConnectionError('连接已关闭')
+            for future, _ in self.pending.values():
+                if not future.done():
+                    future.set_exception(self.closed_exc)
+            self.pending.clear()
+            self.order.clear()
+            self.pushes.put_nowait(None)
+
+    def pop_pending(self, response):  # 返回等待这个响应的 future, 不等待响应的请求返回 None
+        if 'id' in response:
+            request_id = response['id']
+        elif self.version < 3 and self.order:
+            request_id = self.order.popleft()
+        else:
+            return None
+        entry = self.pending.pop(request_id, None)
+        if entry is None:
+            return None
+        future, sent = entry
+        self.latencies.append(time.perf_counter() - sent)
+        self.completed += 1
+        return future
+
+    async def read_frame(self):
         length = await self.reader.readexactly(4)
         length = read_length(length)
         data = await self.reader.readexactly(length)
-        response = unpack_enc_data(data, self.server_count, self.aes_gcm_key)
-        self.add_server_count()
+        return unpack_enc_data(data, self.cipher, self.codec, self.decompressor)
+
+    async def close(self):  # 关闭连接并等待 read_loop 结束, 未完成的请求以 closed_exc 失败
+        self.writer.close()
+        if self._reader_task is not None:
+            await asyncio.shield(self._reader_task)
+
+    async def get_response(self):  # 下一条推送或者不等待响应的请求 (send_request) 的响应
+        self.start_reader()
+        response = await self.pushes.get()
+        if response is None:
+            self.pushes.put_nowait(None)  # 连接已经断开, 留给其他等待者
+            raise self.closed_exc
         return response
 
     async def get_response_without_enc(self):
@@ -127,28 +369,49 @@ class Client(DH):
         return response
 
     async def send_request_with_res(self, req_type, data={}):
+        # 不必等待上一个请求的响应, 多个请求可以同时在途 (pipelining), 响应按 id 对应
+        self.start_reader()
+        if self.closed_exc is not None:
+            raise self.closed_exc
+        self.next_id += 1
+        future = asyncio.get_event_loop().create_future()
+        self.pending[self.next_id] = (future, time.perf_counter())
+        self.max_in_flight = max(self.max_in_flight, len(self.pending))
+        self.send_request(req_type, data, self.next_id)
+        return await future
+
+    def send_request(self, req_type, data={}, request_id=None):
         request = {}
         request['type'] = req_type
         request['data'] = data
         request['timestamp'] = time.time()
-        data = pack_enc_data(request, self.client_count, self.aes_gcm_key)
-        self.add_client_count()
+        if self.version >= 3:
+            if request_id is not None:
+                request['id'] = request_id
+        else:
+            self.order.append(request_id)
+        data = pack_enc_data(request, self.cipher, self.codec, self.compressor)
         self.writer.write(data)
-        res = await self.get_response()
-        return res
 
-    def send_request(self, req_type, data={}):
-        request = {}
-        request['type'] = req_type
-        request['data'] = data
-        request['timestamp'] = time.time()
-        data = pack_enc_data(request, self.client_count, self.aes_gcm_key)
-        self.add_client_count()
-        self.writer.write(data)
+    async def run_crypto(self, func, *args):
+        if self.crypto_executor is None:
+            return func(*args)
+        return await asyncio.get_event_loop().run_in_executor(self.crypto_executor, func, *args)
+
+    def stats(self):  # 在途请求数和最近请求的往返时间 (毫秒)
+        latencies = sorted(self.latencies)
+        return {
+            'in_flight': len(self.pending),
+            'max_in_flight': self.max_in_flight,
+            'requests': self.next_id,
+            'completed': self.completed,
+            'latency_p50': latencies[len(latencies) // 2] * 1000 if latencies else None,
+            'latency_p99': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None
+        }
 
     async def send_register(self, public_key, username):
         data = {
-            'pubkey': public_key.save_pkcs1().decode(),
+            'pubkey': crypto.save_public_key(public_key),
             'username': username
         }
         res = await self.send_request_with_res('register', data)
@@ -157,7 +420,7 @@ class Client(DH):
     async def send_login(self, private_key, username):
         res = await self.send_request_with_res('get_challenge')
         challenge = res['data']['challenge']
-        sign = rsa.sign(challenge.encode(), private_key, 'SHA-512')
+        sign = await self.run_crypto(crypto.sign, challenge.encode(), private_key)
         data = {
             'sign': b64encode(sign).decode(),
             'username': username
@@ -166,24 +429,84 @@ class Client(DH):
         self.username = username
         return res
 
-    def send_get_users(self):
-        self.send_request('list')
+    def send_get_users(self):  # 新服务器返回 presence 完整列表, 之后的变化由推送增量更新
+        if self.version >= 4:
+            self.send_request('presence', {'since': self.presence_version})
+        else:
+            self.send_request('list')
+
+    def send_get_history(self, before, limit=200):  # 公共聊天中 seq 小于 before 的消息, 响应由 history 回调处理
+        if self.version >= 5:
+            self.send_request('history', {'before': before, 'limit': limit})
 
-    def send_to_user(self, username, message):
-        message = message.encode()
-        if username in self.user_dh_keys:
-            common_key = self.user_dh_keys[username]['dh_common_key']
-            iv, ciphertext = encrypt_aes_cbc(message, common_key)
-            data = {
-                'username': username,
-                'iv': b64encode(iv).decode('utf-8'),
-                'ciphertext': b64encode(ciphertext).decode('utf-8')
-            }
-            self.send_request('send_user', data)
+    def send_to_user(self, username, message):  # 返回是否已经发出, 还没有密钥时排队, 协商完成后按顺序发出
+        if self.ensure_key(username):
+            self.send_encrypted(username, message)
             return True
-        else:
-            self.send_dh_request(username, True)
-            return False
+        queue = self.outbox.get(username)
+        if queue is None:
+            queue = self.outbox[username] = deque(maxlen=OUTBOX_LIMIT)
+        queue.append(message)
+        return False
+
+    def send_encrypted(self, username, message):
+        common_key = self.user_dh_keys[username]['dh_common_key']
+        iv, ciphertext = encrypt_aes_cbc(message.encode(), common_key)
+        data = {
+            'username': username,
+            'iv': iv,  # JSON 格式下编码成 base64
+            'ciphertext': ciphertext
+        }
+        self.send_request('send_user', data)
+
+    def ensure_key(self, username):
+        # 返回和 username 的密钥是否可用; 不可用时先查本地缓存, 缓存里没有并且没有正在进行的协商时发起 DH
+        keys = self.user_dh_keys.get(username)
+        if keys is not None and 'dh_common_key' in keys:
+            if keys['expires'] > time.time():
+                return True
+            self.drop_key(username)
+            keys = None
+        if keys is None and self.key_cache is not None:
+            cached = self.key_cache.load_session_key(username)
+            if cached is not None:
+                self.user_dh_keys[username] = {'dh_common_key': cached[0], 'expires': cached[1]}
+                return True
+        if keys is None or keys['sent'] + DH_RETRY < time.monotonic():
+            self.start_dh(username)
+        return False
+
+    def start_dh(self, username):  # 发起协商, 模幂在 crypto_executor 里计算
+        keys = self.user_dh_keys[username] = {'sent': time.monotonic()}
+        asyncio.ensure_future(self._start_dh(username, keys))
+
+    async def _start_dh(self, username, keys):
+        dh_private, dh_public = await self.run_crypto(dh_generate)
+        if self.user_dh_keys.get(username) is not keys:
+            return  # 计算期间对方发起了协商, 已经回应对方
+        keys['dh_private'] = dh_private
+        keys['dh_public'] = dh_public
+        self.send_request('dh_request', {'username': username, 'dh_public': dh_public, 'init': True})
+
+    def message_lost(self, username):
+        if self.callbacks is not None and 'send_user_lost' in self.callbacks:
+            self.callbacks['send_user_lost'](self, {'type': 'send_user_lost', 'data': {'from': username}})
+
+    def drop_key(self, username):
+        self.user_dh_keys.pop(username, None)
+        if self.key_cache is not None:
+            self.key_cache.delete_session_key(username)
+
+    def key_established(self, username, dh_common_key):  # 保存密钥并发出排队的消息
+        expires = time.time() + SESSION_KEY_TTL
+        self.user_dh_keys[username] = {'dh_common_key': dh_common_key, 'expires': expires}
+        if self.key_cache is not None:
+            self.key_cache.save_session_key(username, dh_common_key, expires)
+        for message in self.outbox.pop(username, ()):
+            self.send_encrypted(username, message)
+        for response in self.inbox.pop(username, ()):
+            if self.callbacks is not None:
+                self.dispatch({'type': 'send_user', 'data': response})
 
     def send_to_everyone(self, message):
         data = {
@@ -194,15 +517,15 @@ class Client(DH):
     def send_dh_request(self, username, init):  # init 代表是否从 0 开始握手
         if not init:
             dh_private = self.user_dh_keys[username]['dh_private']
-            dh_public = self.dh_get_public(dh_private)
+            dh_public = crypto.dh_get_public(dh_private)
             data = {
                 'username': username,
                 'dh_public': dh_public,
                 'init': False
             }
         else:
-            dh_private = self.dh_gen_private()
-            dh_public = self.dh_get_public(dh_private)
+            dh_private = crypto.dh_gen_private()
+            dh_public = crypto.dh_get_public(dh_private)
 
             data = {
                 'username': username,
@@ -210,43 +533,54 @@ class Client(DH):
                 'init': True
             }
             self.user_dh_keys[username] = {
-                'dh_private': dh_private
+                'dh_private': dh_private,
+                'dh_public': dh_public,
+                'sent': time.monotonic()
             }
         self.send_request('dh_request', data)
 
     @staticmethod
-    def complete_dh(self, data):
-        data = data['data']
+    def complete_dh(self, data):  # 收到 dh_request 推送, 计算在 finish_dh 里进行, 不阻塞后面的推送
+        asyncio.ensure_future(self.finish_dh(data['data']))
+
+    async def finish_dh(self, data):
         username = data['from']
-        init = data['init']
         dh_his_public = data['dh_public']
-
-        if not init:
-            dh_private = self.user_dh_keys[username]['dh_private']
-            dh_common_key = self.dh_get_common_key(dh_private, dh_his_public)
-            dh_common_key = sha3_256(dh_common_key)
-
-            self.user_dh_keys[username]['dh_common_key'] = dh_common_key
-            self.user_dh_keys[username]['dh_his_public'] = dh_his_public
-        else:
-            dh_private = self.dh_gen_private()
-            dh_common_key = self.dh_get_common_key(dh_private, dh_his_public)
-            dh_common_key = sha3_256(dh_common_key)
-
-            self.user_dh_keys[username] = {
-                'dh_his_public': dh_his_public,
-                'dh_private': dh_private,
-                'dh_common_key': dh_common_key
-            }
-            self.send_dh_request(username, False)
-
-
-async def get_client(host, port, server_public_key):
+        keys = self.user_dh_keys.get(username)
+
+        if not data['init']:
+            if keys is None or 'dh_private' not in keys or 'dh_common_key' in keys:
+                return  # 不是自己发起的, 或者已经完成的协商
+            if data.get('reply_to', keys.get('dh_public')) != keys.get('dh_public'):
+                return  # 回应的是被重试替换掉的请求 (旧客户端的回应不带 reply_to)
+            dh_common_key = await self.run_crypto(dh_finish, keys['dh_private'], dh_his_public)
+            if self.user_dh_keys.get(username) is keys:  # 计算期间没有开始新的协商
+                self.key_established(username, dh_common_key)
+        else:  # 对方发起时重新协商, 已有的密钥作废
+            if keys is not None and 'dh_private' in keys and 'dh_common_key' not in keys and self.username < username:
+                return  # 双方同时发起时只保留用户名较小的一方发起的协商, 对方会回应这边的请求
+            keys = self.user_dh_keys[username] = {'sent': time.monotonic()}
+            dh_public, dh_common_key = await self.run_crypto(dh_respond, dh_his_public)
+            if self.user_dh_keys.get(username) is not keys:
+                return  # 计算期间对方又发起了一次, 以后一次为准
+            self.send_request('dh_request', {'username': username, 'dh_public': dh_public, 'init': False,
+                                             'reply_to': dh_his_public})
+            self.key_established(username, dh_common_key)
+
+async def get_client(host, port, server_public_key, kex=None):
     reader, writer = await asyncio.open_connection(host, port)
 
     c = Client(reader, writer)
     c.server_public_key = server_public_key
-    await c.send_handshake()
+    try:
+        await c.send_handshake(kex)
+    except asyncio.IncompleteReadError:
+        if (kex or crypto.get_provider().kex[0]) == crypto.KEX_DH:
+            raise
+        # 不认识协商字段的旧服务器会直接断开连接, 重新连接并使用 DH 握手
+        writer.close()
+        return await get_client(host, port, server_public_key, crypto.KEX_DH)
+    c.start_reader()
     return c
 
 
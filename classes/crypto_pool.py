@@ -0,0 +1,109 @@
+import asyncio
+import secrets
+from concurrent.futures import ProcessPoolExecutor, wait
+from struct import unpack
+from utils import crypto
+from utils.tools import sha3_256, DH, FixedBasePow
+
+KEYPOOL_EXPONENT_BITS = 256  # 预生成 DH 密钥的指数长度, 与 OpenSSL 一样使用短指数
+
+_private_key = None  # 工作进程里的服务器私钥, 由 initializer 设置, 不随每个任务传递
+_fixed_base: FixedBasePow = None  # 生成元 2 的窗口表, 每个进程第一次使用时建立
+
+
+def _init_worker(private_key, provider_name):  # 密钥对象不一定能被 pickle, 以 PEM 文本传入
+    global _private_key
+    crypto.set_provider(provider_name)
+    _private_key = crypto.load_private_key(private_key)
+
+
+def _ping():
+    pass
+
+
+def generate_dh_entries(count):
+    # 返回 count 个已签名的临时 DH 密钥 (dh_private, dh_public, sign), dh_private 为整数, 可以在进程间传递
+    global _fixed_base
+
+    if _fixed_base is None:
+        _fixed_base = FixedBasePow(DH.DH_GENERATOR, DH.DH_PRIME, KEYPOOL_EXPONENT_BITS)
+    entries = []
+    for _ in range(count):
+        dh_private = secrets.randbits(KEYPOOL_EXPONENT_BITS) | (1 << (KEYPOOL_EXPONENT_BITS - 1))
+        dh_public = _fixed_base.pow(dh_private).to_bytes(233, 'big')
+        entries.append((dh_private, dh_public, crypto.sign(dh_public, _private_key)))
+    return entries
+
+
+def server_handshake(dh_other_public, client_count, server_count, entry=None):
+    # 参数为客户端发来的 RSA 密文和可选的预生成密钥, 返回 (dh_public, sign, aes_gcm_key, client_count, server_count)
+    if entry is None:
+        dh_private = crypto.dh_gen_private()
+        dh_public = crypto.dh_get_public(dh_private).to_bytes(233, 'big')
+        dh_public_sign = crypto.sign(dh_public, _private_key)
+    else:
+        dh_private, dh_public, dh_public_sign = entry
+
+    dh_other_public = int.from_bytes(crypto.decrypt(dh_other_public, _private_key), 'big')
+    client_count = unpack('>Q', crypto.decrypt(client_count, _private_key))[0]
+    server_count = unpack('>Q', crypto.decrypt(server_count, _private_key))[0]
+
+    if entry is None:
+        tmp_key = crypto.dh_get_common_key(dh_private, dh_other_public)
+    else:
+        tmp_key = crypto.dh_get_common_key_raw(dh_private, int.from_bytes(dh_public, 'big'), dh_other_public)
+    return dh_public, dh_public_sign, sha3_256(tmp_key), client_count, server_count
+
+
+def server_handshake_x25519(client_public):
+    # 只需要一次 X25519 和一次 RSA 签名, 返回 (x25519_public, sign, aes_gcm_key, client_count, server_count)
+    private = crypto.x25519_gen_private()
+    public = crypto.x25519_get_public(private)
+    sign = crypto.sign_pss(crypto.X25519_LABEL + client_public + public, _private_key)
+    key, client_count, server_count = crypto.x25519_derive(private, client_public, public, client_public)
+    return public, sign, key, client_count, server_count
+
+
+class CryptoPool():
+    # 握手和登录验签的 RSA 运算; max_workers 为 0 时在事件循环里直接计算
+    executor: ProcessPoolExecutor
+
+    def __init__(self, private_key, max_workers=0):
+        global _private_key
+        _private_key = private_key
+
+        self.max_workers = max_workers
+        self.executor = None
+        if max_workers > 0:
+            initargs = (crypto.save_private_key(private_key), crypto.get_provider().name)
+            self.executor = ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=initargs)
+            # 立即启动全部工作进程, 避免之后在已有其他线程的进程里 fork
+            wait([self.executor.submit(_ping) for _ in range(max_workers)])
+        self.pending = 0
+
+    async def _run(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        self.pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def server_handshake(self, dh_other_public, client_count, server_count, entry=None):
+        return await self._run(server_handshake, dh_other_public, client_count, server_count, entry)
+
+    async def generate_dh_entries(self, count):
+        return await self._run(generate_dh_entries, count)
+
+    async def server_handshake_x25519(self, client_public):
+        return await self._run(server_handshake_x25519, client_public)
+
+    async def verify(self, message, sign, public_key):
+        if crypto.get_provider().native:
+            return crypto.verify(message, sign, public_key)  # OpenSSL 验签比进程间通信还快
+        return await self._run(crypto.verify, message, sign, public_key)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,63 @@
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex
+
+# 聊天记录的列表模型, 每个会话一个, 视图切换会话时只换模型
+# 每条消息占两行 (发送者和时间, 消息内容), 与原来的 QListWidget 外观相同;
+# 新消息只插入两行, 视图只为可见的行调用 data
+# 视图使用固定行高的 QTableView: QListView 插入行后会为每一行调用一次 rowCount (Python) 重新排版, 10 万条消息时每帧约 1 秒
+# 行高一致, 多行消息在列表里显示为一行 (换行显示为 ↵), 完整内容在提示里
+
+
+class ChatHistoryModel(QAbstractListModel):
+    def __init__(self, messages=None, parent=None):
+        QAbstractListModel.__init__(self, parent)
+        self.messages = messages if messages is not None else []  # {'from', 'message', 'me', 'time'}
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.messages) * 2
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        message = self.messages[index.row() >> 1]
+        header = not index.row() & 1
+        if role == Qt.DisplayRole:
+            if header:
+                return f"{message['from']} in {message['time']}:  "
+            return message['message'].replace('\n', ' ↵ ') + "  "
+        elif role == Qt.TextAlignmentRole:
+            return (Qt.AlignRight if message['me'] else Qt.AlignLeft) | Qt.AlignVCenter
+        elif role == Qt.ToolTipRole and not header:
+            return message['message']
+        return None
+
+    def append(self, message):
+        row = len(self.messages) * 2
+        self.beginInsertRows(QModelIndex(), row, row + 1)
+        self.messages.append(message)
+        self.endInsertRows()
+
+    def extend(self, messages):  # 一帧里收到的多条消息一次插入
+        if not messages:
+            return
+        row = len(self.messages) * 2
+        self.beginInsertRows(QModelIndex(), row, row + len(messages) * 2 - 1)
+        self.messages.extend(messages)
+        self.endInsertRows()
+
+    def trim(self, keep):  # 只保留最近 keep 条, 更早的需要时再从本地记录或服务器加载; 返回是否删除了消息
+        remove = len(self.messages) - keep
+        if remove <= 0:
+            return False
+        self.beginRemoveRows(QModelIndex(), 0, remove * 2 - 1)
+        del self.messages[:remove]
+        self.endRemoveRows()
+        return True
+
+    def prepend(self, messages):  # 更早的一页消息插入到最前面
+        if not messages:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(messages) * 2 - 1)
+        self.messages[:0] = messages
+        self.endInsertRows()
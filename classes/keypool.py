@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from classes.crypto_pool import CryptoPool
+
+logger = logging.getLogger(__name__)
+
+
+class DHKeyPool():
+    # 后台预先生成并签名的临时 DH 密钥, 握手时直接取用; 每个密钥只用于一次握手, 取出后即丢弃
+    # 池的目标大小随握手速率变化: 约为 horizon 秒内的握手数, 限制在 [min_size, max_size] 之间
+    entries: deque
+    rate: float
+
+    def __init__(self, crypto_pool: CryptoPool, min_size=16, max_size=1024, horizon=2.0, batch_size=8, max_age=300):
+        self.crypto_pool = crypto_pool
+        self.min_size = min_size
+        self.max_size = max_size
+        self.horizon = horizon
+        self.batch_size = batch_size if crypto_pool.executor is not None else 1  # 在事件循环里生成时每次只生成一个
+        self.max_age = max_age  # 放置过久的密钥直接丢弃, 不用于握手
+
+        self.entries = deque()
+        self.target = min_size
+        self.rate = 0.0  # 握手速率 (次/秒) 的指数滑动平均
+        self._count = 0
+        self._last = time.monotonic()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.discarded = 0
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._refill())
+
+    def pop(self):  # 返回 (dh_private, dh_public, sign), 池为空时返回 None, 由调用者现场生成
+        self._count += 1
+        now = time.monotonic()
+        while self.entries:
+            created, entry = self.entries.popleft()
+            if now - created <= self.max_age:
+                self.hits += 1
+                if len(self.entries) < self.target:
+                    self._wakeup.set()
+                return entry
+            self.discarded += 1
+        self.misses += 1
+        self._wakeup.set()
+        return None
+
+    def _update_target(self):
+        now = time.monotonic()
+        elapsed = now - self._last
+        if elapsed < 1:
+            return
+        rate = self._count / elapsed
+        self.rate = rate if rate > self.rate else self.rate * 0.7 + rate * 0.3  # 速率上升时立即跟上, 下降时慢慢收缩
+        self._count = 0
+        self._last = now
+        self.target = int(min(max(self.rate * self.horizon, self.min_size), self.max_size))
+
+        while len(self.entries) > self.target:  # 多余的密钥不再使用
+            self.entries.popleft()
+            self.discarded += 1
+
+    async def _refill(self):
+        while True:
+            self._update_target()
+            if len(self.entries) < self.target:
+                count = min(self.batch_size, self.target - len(self.entries))
+                try:
+                    entries = await self.crypto_pool.generate_dh_entries(count)
+                except Exception:
+                    logger.exception('预生成 DH 密钥失败')
+                    await asyncio.sleep(1)
+                    continue
+                now = time.monotonic()
+                self.entries.extend((now, entry) for entry in entries)
+                self.generated += len(entries)
+                await asyncio.sleep(0)  # 在事件循环里生成时让出, 不阻塞握手和消息
+            else:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'target': self.target,
+            'rate': self.rate,
+            'hits': self.hits,
+            'misses': self.misses,
+            'generated': self.generated,
+            'discarded': self.discarded
+        }
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
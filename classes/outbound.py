@@ -0,0 +1,194 @@
+import asyncio
+import logging
+from collections import deque
+from utils import metrics
+
+DROP_OLDEST = 'drop_oldest'  # 队列满时丢弃最旧的可丢弃消息 (聊天/广播)
+DISCONNECT = 'disconnect'  # 队列满时断开慢速客户端
+BLOCK = 'block'  # 队列满时让发送方等待, 超过 block_timeout 仍未腾出空间则断开
+POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+HIGH_WATER = 64 * 1024  # 内核/transport 缓冲超过该值时暂停写出, 等待 drain
+
+logger = logging.getLogger(__name__)
+
+FRAMES_OUT = metrics.counter('chat_outbound_frames_total', '握手之后加密发出的帧数')
+BYTES_OUT = metrics.counter('chat_outbound_bytes_total', '握手之后写入连接的字节数 (压缩和加密之后)')
+WRITES = metrics.counter('chat_outbound_writes_total', '发送队列合并后的 write 次数')
+DROPPED = metrics.counter('chat_outbound_dropped_total', '发送队列溢出时丢弃的帧数')
+OVERFLOW_CLOSES = metrics.counter('chat_outbound_overflow_closes_total', '因为发送队列溢出或阻塞超时断开的连接数')
+
+
+class OutboundQueue():
+    # 一个连接的有界发送队列: 队列里保存序列化后的明文, 同一轮事件循环中入队的帧
+    # 在出队时按顺序加密并合并成一次 write; 丢弃消息不会让双方的 nonce 计数器错位
+    writer: asyncio.StreamWriter
+
+    def __init__(self, writer, max_frames, max_bytes, policy=DROP_OLDEST, block_timeout=5.0, on_close=None):
+        if policy not in POLICIES:
+            raise ValueError(f'未知的溢出策略: {policy}')
+        self.writer = writer
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.on_close = on_close
+
+        self.frames = deque()  # (data, droppable)
+        self.bytes = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.writes = 0
+        self.closing = False
+        self.closed = False
+
+        self.cipher = None
+        self.compressor = None
+        self._loop = asyncio.get_event_loop()
+        self._scheduled = False
+        self._paused = False
+        self._space = asyncio.Event()
+        self._flushed = asyncio.Event()
+
+    def start(self, cipher, compressor=None):  # compressor 在加密之前按发送顺序压缩, 被丢弃的帧不会进入压缩流
+        self.cipher = cipher
+        self.compressor = compressor
+        self._schedule()
+
+    def full(self):
+        return len(self.frames) >= self.max_frames or self.bytes >= self.max_bytes
+
+    def offer(self, data, droppable=True):  # 不等待地入队, block 策略下队列已满时返回 False
+        if self.closing:
+            return True
+        if self.full():
+            if self.policy == DISCONNECT:
+                logger.info(f'发送队列溢出, 断开连接 ({len(self.frames)} 帧, {self.bytes} 字节)')
+                OVERFLOW_CLOSES.inc()
+                self.abort()
+                return True
+            elif self.policy == DROP_OLDEST:
+                if not self._drop_oldest() and droppable:
+                    self.dropped += 1  # 队列里全是不可丢弃的响应, 丢弃新消息
+                    DROPPED.inc()
+                    return True
+            elif droppable:
+                return False
+
+        self.frames.append((data, droppable))
+        self.bytes += len(data)
+        if len(self.frames) > self.max_depth:
+            self.max_depth = len(self.frames)
+        self._schedule()
+        return True
+
+    async def put(self, data, droppable=True):
+        while not self.offer(data, droppable):
+            self._space.clear()
+            try:
+                await asyncio.wait_for(self._space.wait(), self.block_timeout)
+            except asyncio.TimeoutError:
+                logger.info(f'发送队列阻塞超过 {self.block_timeout} 秒, 断开连接')
+                OVERFLOW_CLOSES.inc()
+                self.abort()
+
+    def _drop_oldest(self):
+        for i, (data, droppable) in enumerate(self.frames):
+            if droppable:
+                del self.frames[i]
+                self.bytes -= len(data)
+                self.dropped += 1
+                DROPPED.inc()
+                return True
+        return False
+
+    async def wait_flushed(self):  # 等到队列里的帧都已交给 transport, 并且没有因为对方读得慢暂停写出
+        while (self.frames or self._paused) and not self.closed:
+            self._flushed.clear()
+            await self._flushed.wait()
+
+    def stats(self):
+        transport = self.writer.transport
+        return {
+            'depth': len(self.frames),
+            'bytes': self.bytes,
+            'transport_bytes': transport.get_write_buffer_size() if transport else 0,
+            'max_depth': self.max_depth,
+            'dropped': self.dropped,
+            'writes': self.writes,
+            'policy': self.policy
+        }
+
+    def close(self):  # 发送完已入队的数据后关闭连接
+        self.closing = True
+        if self._paused:
+            self.abort()  # 对方已经不再读取, 不必等待
+        elif not self.frames or self.cipher is None:
+            self._finish()
+
+    def abort(self):  # 丢弃未发送的数据并立即关闭连接
+        self.frames.clear()
+        self.bytes = 0
+        self.closing = True
+        self._finish()
+
+    def _finish(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._space.set()
+        self._flushed.set()
+        self.writer.close()
+        if self.on_close is not None:
+            self.on_close()
+
+    def _schedule(self):
+        if not self._scheduled and not self._paused and self.cipher is not None and self.frames:
+            self._scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._scheduled = False
+        if self.closed:
+            return
+
+        seal_frame = self.cipher.seal_frame
+        if self.compressor is not None:
+            seal = seal_frame
+            compress = self.compressor.compress
+            seal_frame = lambda data: seal(compress(data))
+        FRAMES_OUT.inc(len(self.frames))
+        if len(self.frames) == 1:
+            data = seal_frame(self.frames.popleft()[0])
+        else:
+            data = b''.join([seal_frame(self.frames.popleft()[0]) for _ in range(len(self.frames))])
+        self.bytes = 0
+        if self.policy == BLOCK:
+            self._space.set()
+
+        try:
+            self.writer.write(data)
+        except Exception:
+            self.abort()  # 连接已经断开
+            return
+        self.writes += 1
+        WRITES.inc()
+        BYTES_OUT.inc(len(data))
+
+        if self.closing:
+            self._finish()
+        elif self.writer.transport.get_write_buffer_size() > HIGH_WATER:
+            self._paused = True  # 对方读得太慢, 之后的帧先留在有界队列里
+            asyncio.ensure_future(self._drain())
+        else:
+            self._flushed.set()
+
+    async def _drain(self):
+        try:
+            await self.writer.drain()
+        except Exception:
+            self.abort()
+            return
+        self._paused = False
+        self._flushed.set()
+        self._schedule()
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class Presence():
+    # 带版本号的在线用户表: 上线/下线只把用户名记为待定, 合并成一批变化 (版本号加一) 由 publish(version, online, offline)
+    # 推送; 两批之间至少间隔 tick 秒, 空闲之后的第一个变化立即推送; 同一批里先下线又上线的用户不产生任何推送
+    # 最近 history 批变化保存在 log 里, 客户端可以请求某个版本之后的变化, 更早的版本返回完整列表
+    users: set  # 已经发布的在线用户
+    log: deque  # (version, online, offline)
+
+    def __init__(self, is_online, publish, tick=0.05, history=1024):
+        self.is_online = is_online  # username -> 用户当前是否在线 (本进程或其他进程)
+        self.publish = publish
+        self.tick = tick
+        self.version = 0
+        self.users = set()
+        self.log = deque(maxlen=history)
+        self._dirty = set()
+        self._handle = None
+        self._last_flush = 0.0
+        self._snapshot = (0, [])
+
+        self.batches = 0
+        self.changes = 0
+        self.coalesced = 0  # 一个 tick 内状态没有净变化的用户数
+
+    def touch(self, username):
+        self._dirty.add(username)
+        if self._handle is None:
+            loop = asyncio.get_event_loop()
+            self._handle = loop.call_at(max(self._last_flush + self.tick, loop.time()), self.flush)
+
+    def flush(self):
+        self._handle = None
+        self._last_flush = asyncio.get_event_loop().time()
+        dirty, self._dirty = self._dirty, set()
+        online = []
+        offline = []
+        for username in dirty:
+            state = self.is_online(username)
+            if state and username not in self.users:
+                self.users.add(username)
+                online.append(username)
+            elif not state and username in self.users:
+                self.users.discard(username)
+                offline.append(username)
+        self.coalesced += len(dirty) - len(online) - len(offline)
+        if not online and not offline:
+            return
+
+        self.version += 1
+        self.batches += 1
+        self.changes += len(online) + len(offline)
+        self.log.append((self.version, online, offline))
+        try:
+            self.publish(self.version, online, offline)
+        except Exception:
+            logger.exception('推送在线状态失败')
+
+    def snapshot(self):  # 当前在线用户列表, 同一个版本内复用
+        if self._snapshot[0] != self.version:
+            self._snapshot = (self.version, list(self.users))
+        return self._snapshot[1]
+
+    def changes_since(self, version):
+        # version 之后的净变化; version 为 None, 太旧或者不属于本进程时返回 full 为 True 的完整列表
+        if version is not None and version == self.version:
+            return {'version': self.version, 'full': False, 'online': [], 'offline': []}
+        if version is None or version > self.version or not self.log or self.log[0][0] > version + 1:
+            return {'version': self.version, 'full': True, 'online': self.snapshot(), 'offline': []}
+
+        states = dict()
+        for batch_version, online, offline in self.log:
+            if batch_version > version:
+                for username in online:
+                    states[username] = True
+                for username in offline:
+                    states[username] = False
+        return {
+            'version': self.version,
+            'full': False,
+            'online': [username for username, state in states.items() if state],
+            'offline': [username for username, state in states.items() if not state]
+        }
+
+    def stats(self):
+        return {
+            'version': self.version,
+            'users': len(self.users),
+            'pending': len(self._dirty),
+            'batches': self.batches,
+            'changes': self.changes,
+            'coalesced': self.coalesced
+        }
@@ -1,37 +1,113 @@
 import asyncio
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 from utils.protocols import *
-from utils.model import User, SQLAlchemy
+from utils.user_store import UserStore
+from utils.offline_store import OfflineStore
+from utils.history_ring import HistoryRing
 from utils.tools import *
+from classes.broadcast import spawn_broadcast
+from classes.outbound import OutboundQueue, DROP_OLDEST
+from classes.crypto_pool import CryptoPool
+from classes.keypool import DHKeyPool
+from classes.presence import Presence
+from classes.admin import AdminServer
+from utils import metrics
+from utils import profiling
+from classes.bus import RoutingBackend, create_backend
+from utils import crypto
 from base64 import b64decode, b64encode
 import time
-import rsa
 from functools import wraps
 import traceback
 from selectors import EpollSelector
 import logging
+import os
+import signal
+import tempfile
 
 _selector = EpollSelector()
 _loop = asyncio.SelectorEventLoop(_selector)
 asyncio.set_event_loop(_loop)
 
-engine = create_engine('sqlite:///user.db')
-SQLAlchemy.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-
-global_users = dict()
+DEFAULT_DB_URL = 'sqlite:///user.db'
+user_store: UserStore = None
+crypto_pool: CryptoPool = None
+dh_keypool: DHKeyPool = None
+
+DH_KEYPOOL_MIN_SIZE = 16
+DH_KEYPOOL_MAX_SIZE = 1024
+
+global_users = dict()  # 本进程的在线用户
+presence: Presence = None  # 本进程看到的在线用户表 (包括其他进程/节点的用户), 上下线合并后批量推送
+PRESENCE_TICK = 0.05
+PRESENCE_HISTORY = 1024
+offline: OfflineStore = None  # 收件人不在线时保存私聊和 DH 请求, 登录时按顺序投递
+OFFLINE_DIR = None  # None 表示不保存离线消息
+OFFLINE_OPTIONS = dict()
+OFFLINE_BATCH = 256  # 投递时每次读出的消息数
+draining = dict()  # 正在投递离线消息的用户 -> 任务, 期间发给他的新消息也先进入离线队列, 保证顺序
+OFFLINE_CONFIRM_TIMEOUT = 30  # 等待其他进程确认离线消息已经投递的秒数, 超时后留到下次上线
+bus_deliveries = dict()  # (用户名, 一批最后的 seq) -> 等待确认的 future
+
+history: HistoryRing = None  # 公共聊天最近的消息, 登录时推送
+HISTORY_PATH = None  # 公共聊天历史的文件, None 表示不保存
+HISTORY_OPTIONS = dict()
+HISTORY_LOGIN = 200  # 登录时推送的最近消息数
+HISTORY_PAGE_BYTES = 256 * 1024  # 每页历史消息的最大字节数
+bus: RoutingBackend = None  # 多进程/集群模式下连接其他工作进程和节点的总线, 单进程时为 None
+BUS_ADDRESS = None
+
+OUTBOUND_MAX_FRAMES = 1024
+OUTBOUND_MAX_BYTES = 4 * 1024 * 1024
+OUTBOUND_POLICY = DROP_OLDEST
+
+HANDSHAKE_MODES = None  # 接受的密钥交换方式, None 表示当前密码学实现支持的全部方式
+
+COMPRESSION_ENABLED = True  # 是否接受客户端请求的压缩
+COMPRESS_LEVEL = 6
+COMPRESS_THRESHOLD = 32  # 短于该字节数的帧不压缩 (有跨帧的历史, 很短的帧也能压缩)
+COMPRESS_MAX_FRAME = 1024 * 1024  # 解压后单帧的上限, 防止压缩炸弹
+
+admin: AdminServer = None  # 本机管理接口 (Prometheus 格式的 /metrics)
+ADMIN_ADDRESS = None
+
+profiler: profiling.SamplingProfiler = None  # 运行中的采样分析器, 由管理接口或 SIGUSR1 开关
+PROFILE_DIR = None  # 信号触发的分析结果写到这个目录, None 表示系统临时目录
+PROFILE_INTERVAL = 0.005
+TRACEMALLOC_FRAMES = 16
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-
-class Server(DH):
-    session: Session
-    public_key: rsa.PublicKey
-    private_key: rsa.PrivateKey
+CONNECTIONS = metrics.gauge('chat_connections', '当前的 TCP 连接数 (包括还没有握手的)')
+FRAMES_IN = metrics.counter('chat_inbound_frames_total', '收到的帧数')
+BYTES_IN = metrics.counter('chat_inbound_bytes_total', '收到的字节数 (包括长度前缀)')
+HANDSHAKES = metrics.counter('chat_handshakes_total', '握手次数', ('kex', 'result'))
+HANDSHAKE_SECONDS = metrics.histogram('chat_handshake_seconds', '处理一次握手请求的时间', ('kex',))
+REQUEST_SECONDS = metrics.histogram('chat_request_seconds', '按请求类型统计的处理时间', ('type',))
+REQUEST_CPU = metrics.counter('chat_request_cpu_seconds_total',
+                              '按请求类型统计的处理函数自身占用的 CPU 时间 (不含等待数据库/进程池期间其他任务的时间)', ('type',))
+PUSHES = metrics.counter('chat_pushes_total', '单独推送给一个连接的帧数 (不含广播)', ('type',))
+# 以下在导出时计算
+metrics.gauge('chat_users', '本进程登录的用户数', func=lambda: len(global_users))
+metrics.gauge('chat_remote_users', '其他进程/节点上的在线用户数', func=lambda: len(bus.users) if bus is not None else 0)
+metrics.gauge('chat_outbound_queue_frames', '所有发送队列里等待发出的帧数',
+              func=lambda: sum(len(server.outbound.frames) for server in global_users.values()))
+metrics.gauge('chat_outbound_queue_frames_max', '最深的发送队列里等待发出的帧数',
+              func=lambda: max((len(server.outbound.frames) for server in global_users.values()), default=0))
+metrics.gauge('chat_dh_keypool_size', '预生成的 DH 密钥数', func=lambda: len(dh_keypool.entries) if dh_keypool else 0)
+metrics.counter('chat_dh_keypool_misses_total', '握手时 DH 密钥池为空的次数',
+                func=lambda: dh_keypool.misses if dh_keypool else 0)
+metrics.gauge('chat_offline_messages', '等待投递的离线消息数', func=lambda: offline.messages if offline else 0)
+metrics.gauge('chat_offline_bytes', '等待投递的离线消息字节数', func=lambda: offline.bytes if offline else 0)
+metrics.gauge('chat_offline_segments', '离线消息的段文件数', func=lambda: len(offline.segments) if offline else 0)
+metrics.gauge('chat_history_messages', '保存的公共聊天历史消息数', func=lambda: history.messages if history else 0)
+metrics.gauge('chat_presence_version', '在线用户表的版本号', func=lambda: presence.version if presence else 0)
+
+
+class Server():
     writer: asyncio.StreamWriter
     reader: asyncio.StreamReader
+    outbound: OutboundQueue
 
     login = False
     died = False
@@ -39,16 +115,19 @@ class Server(DH):
     challenge = ""
 
     handshake = False
-    client_count = 0
-    server_count = 0
-    aes_gcm_key = b''
+    version = 1  # 握手协商出的协议版本
+    cipher: SessionCipher
+    codec = JSON_CODEC  # 握手时协商的帧编码格式
+    compressor: FrameCompressor = None  # 握手时协商的压缩, 每个方向一个流
+    decompressor: FrameDecompressor = None
 
     def __init__(self, reader, writer, private_key, public_key):
         self.public_key = public_key
         self.private_key = private_key
-        self.session = Session()
         self.writer = writer
         self.reader = reader
+        self.outbound = OutboundQueue(writer, OUTBOUND_MAX_FRAMES, OUTBOUND_MAX_BYTES, OUTBOUND_POLICY,
+                                      on_close=self.on_outbound_closed)
 
         peername = self.writer.get_extra_info('peername')
         logger.info(f'接受来自 {peername[0]}:{peername[1]} 的链接')
@@ -59,68 +138,60 @@ class Server(DH):
         else:
             return False
 
-    def add_server_count(self):
-        self.server_count += 1
-        if self.server_count == 18446744073709551616:
-            self.server_count = 0
-
-    def add_client_count(self):
-        self.client_count += 1
-        if self.client_count == 18446744073709551616:
-            self.client_count = 0
+    def on_outbound_closed(self):
+        self.died = True
 
     def login_required(func):
         @wraps(func)
-        def wrapper(self, *args, **kwargs):
+        async def wrapper(self, *args, **kwargs):
             if self.login:
-                return func(self, *args, **kwargs)
+                return await func(self, *args, **kwargs)
             else:
                 return {'success': False, 'msg': '请先登录'}
 
         return wrapper
 
-    def handle_handshake(self, request):
-        dh_private = self.dh_gen_private()
-        dh_public = self.dh_get_public(dh_private)
-
-        dh_public = dh_public.to_bytes(233, 'big')
-        dh_public_sign = rsa.sign(dh_public, self.private_key, 'SHA-512')
-
-        dh_other_public = b64decode(request['dh_public'])
-        client_count = b64decode(request['client_count'])
-        server_count = b64decode(request['server_count'])
-
-        dh_other_public = rsa.decrypt(dh_other_public, self.private_key)
-        client_count = rsa.decrypt(client_count, self.private_key)
-        server_count = rsa.decrypt(server_count, self.private_key)
-
-        dh_other_public = int.from_bytes(dh_other_public, 'big')
-        tmp_key = self.dh_get_common_key(dh_private, dh_other_public)
-        self.aes_gcm_key = sha3_256(tmp_key)
-
-        self.client_count = unpack('>Q', client_count)[0]
-        self.server_count = unpack('>Q', server_count)[0]
+    async def handle_handshake(self, request):
+        # 旧客户端的握手请求没有 version 和 kex 字段, 按 1 版本的 DH 握手处理
+        version = min(int(request.get('version', 1)), PROTOCOL_VERSION)
+        kex = request.get('kex', crypto.KEX_DH)
+        modes = get_handshake_modes()
+        if kex not in modes:  # 连接保持未握手状态, 客户端可以换一种方式重新握手
+            return {'success': False, 'msg': '不支持的密钥交换方式', 'data': {'version': PROTOCOL_VERSION, 'kex': modes}}
+
+        # RSA 与 DH 运算在进程池中完成, 已建立的连接不受握手风暴影响
+        if kex == crypto.KEX_X25519:
+            dh_public, dh_public_sign, aes_gcm_key, client_count, server_count = \
+                await crypto_pool.server_handshake_x25519(b64decode(request['x25519_public']))
+            data = {'x25519_public': b64encode(dh_public).decode('utf-8')}
+        else:
+            dh_other_public = b64decode(request['dh_public'])
+            client_count = b64decode(request['client_count'])
+            server_count = b64decode(request['server_count'])
+            entry = dh_keypool.pop() if dh_keypool is not None else None  # 预生成并已签名的 DH 密钥
+            dh_public, dh_public_sign, aes_gcm_key, client_count, server_count = \
+                await crypto_pool.server_handshake(dh_other_public, client_count, server_count, entry)
+            data = {'dh_public': b64encode(dh_public).decode('utf-8')}
+
+        self.cipher = SessionCipher(aes_gcm_key, server_count, client_count)
+        self.codec = negotiate_wire(request.get('wire'))
+        compression = negotiate_compression(request.get('compress')) if COMPRESSION_ENABLED else None
+        if compression is not None:
+            self.compressor = FrameCompressor(COMPRESS_LEVEL, COMPRESS_THRESHOLD)
+            self.decompressor = FrameDecompressor(COMPRESS_MAX_FRAME)
         self.handshake = True
-        res = {
-            'success': True,
-            'data': {
-                'dh_public': b64encode(dh_public).decode('utf-8'),
-                'sign': b64encode(dh_public_sign).decode('utf-8')
-            }
-        }
-        return res
-
-    def handle_register(self, request):
+        self.version = version
+        data['sign'] = b64encode(dh_public_sign).decode('utf-8')
+        data['version'] = version
+        data['kex'] = kex
+        data['wire'] = self.codec.name
+        data['compress'] = compression
+        return {'success': True, 'data': data}
+
+    async def handle_register(self, request):
         public_key = request['pubkey']
         if vaild_public_key(public_key) and verify_username(request['username']):
-            count = self.session.query(User).filter_by(username=request['username']).count()
-            if count == 0:
-                u = User()
-                u.username = request['username']
-                u.public_key = public_key
-                u.key_hash = sha3_256(public_key)
-                self.session.add(u)
-                self.session.commit()
+            if await user_store.add_user(request['username'], public_key):
                 res = {'success': True, 'msg': '注册成功'}
             else:
                 res = {'success': False, 'msg': '已经有同名用户辣'}
@@ -128,37 +199,33 @@ class Server(DH):
             res = {'success': False}
         return res
 
-    def handle_get_challenge(self, request):
+    async def handle_get_challenge(self, request):
         self.challenge = random_string()
         return {'success': True, 'data': {'challenge': self.challenge}}
 
-    def handle_login(self, request):
+    async def handle_login(self, request):
         if self.challenge != "" and verify_username(request['username']):
             sign = b64decode(request['sign'])
             username = request['username']
-            if self.session.query(User).filter_by(username=username).count():
-                u = self.session.query(User).filter_by(username=username).one()
-                public_key = rsa.PublicKey.load_pkcs1(u.public_key)
-                try:
-                    ret = rsa.verify(self.challenge.encode(), sign, public_key)
-                    assert ret == 'SHA-512'
+            public_key = await user_store.get_public_key(username)
+            if public_key is not None:
+                if await crypto_pool.verify(self.challenge.encode(), sign, public_key):
                     res = {'success': True, 'msg': '登录成功'}
                     self.login = True
                     self.username = request['username']
 
                     if self.username in global_users:  # 将对方踢下线
-                        global_users[self.username].push_data('kicked', {})
-                        global_users[self.username].died = True
-                        global_users[self.username].writer.close()
-                        logger.info(f'{self.username} 被踢下线')
+                        await kick(global_users[self.username])
                     global_users[self.username] = self
                     logger.info(f'{self.username} 上线')
 
-                    for username in global_users:
-                        if username != self.username:
-                            server = global_users[username]
-                            server.push_data('online', self.username)
-                except Exception:
+                    presence.touch(self.username)
+                    if history is not None and self.version >= 5:  # 和加入 global_users 在同一步, 之后的消息都在历史之后
+                        await self.push_data('history', history_page(None, HISTORY_LOGIN), droppable=False)
+                    if bus is not None:
+                        bus.online(self.username)  # 其他进程中的同名连接由总线踢下线
+                    start_drain(self.username)  # 在登录响应之后推送离线消息
+                else:
                     res = {'success': False, 'msg': '私钥错误'}
             else:
                 res = {'success': False, 'msg': '用户不存在'}
@@ -168,77 +235,91 @@ class Server(DH):
         return res
 
     @login_required
-    def handle_send_everyone(self, request):
-        for username in global_users:
-            if username != self.username:
-                server: Server = global_users[username]
-                data = {
-                    'from': self.username,
-                    'message': request['message']
-                }
-                server.push_data('send_everyone', data)
+    async def handle_send_everyone(self, request):
+        data = {
+            'from': self.username,
+            'message': request['message']
+        }
+        if history is not None:  # seq 为本进程历史里的编号, 客户端据此向前翻页
+            data['seq'] = history.append(self.username, data['message'])
+        others = [server for server in global_users.values() if server is not self]
+        spawn_broadcast(others, 'send_everyone', data)
+        if bus is not None:
+            bus.broadcast('send_everyone', data)
         res = {'success': True, 'type': 'send_everyone_info'}
         return res
 
     @login_required
-    def handle_dh_request(self, request):
+    async def handle_history(self, request):  # 向前翻页: before 为客户端已有的最早一条的 seq
+        if history is None:
+            return {'success': False, 'type': 'history', 'msg': '服务器没有保存公共聊天历史'}
+        limit = min(int(request.get('limit', HISTORY_LOGIN)), history.max_messages)
+        return {'success': True, 'type': 'history', 'data': history_page(request.get('before'), limit)}
+
+    @login_required
+    async def handle_dh_request(self, request):
         username = request['username']
         request.pop('username')
         request['from'] = self.username
-        if username in global_users:
-            server = global_users[username]
-            server.push_data('dh_request', request)
-            res = {'success': True, 'type': 'dh_request_info'}
-        else:
-            res = {'success': False, 'type': 'dh_request_info'}
-        return res
+        return delivery_response(await deliver_user(username, 'dh_request', request), 'dh_request_info')
 
     @login_required
-    def handle_send_user(self, request):
+    async def handle_send_user(self, request):
         username = request['username']
         request.pop('username')
         request['from'] = self.username
-        if username in global_users:
-            server = global_users[username]
-            server.push_data('send_user', request)
-            res = {'success': True, 'type': 'send_user_info'}
-        else:
-            res = {'success': False, 'type': 'send_user_info'}
-        return res
+        return delivery_response(await deliver_user(username, 'send_user', request), 'send_user_info')
 
     @login_required
-    def handel_list(self, request):
-        users = set(global_users.keys())
-        users.remove(self.username)
-        users = list(users)
+    async def handel_list(self, request):  # 旧客户端使用, 新客户端用 presence 请求增量同步
+        users = [username for username in presence.snapshot() if username != self.username]
         return {'success': True, 'type': 'list', 'data': users}
 
-    def handle_default(self, request):
+    @login_required
+    async def handle_presence(self, request):  # since 为客户端已知的版本, 为 None 时返回完整列表
+        return {'success': True, 'type': 'presence', 'data': presence.changes_since(request.get('since'))}
+
+    async def handle_default(self, request):
         return {'success': False, 'msg': '不支持的请求类型'}
 
-    def handle_request(self, request):
+    async def handle_request(self, request):
         handle_dict = {
             'register': self.handle_register,
             'get_challenge': self.handle_get_challenge,
             'login': self.handle_login,
             'list': self.handel_list,
+            'presence': self.handle_presence,
+            'history': self.handle_history,
             'send_everyone': self.handle_send_everyone,
             'dh_request': self.handle_dh_request,
             'send_user': self.handle_send_user
         }
-        func = handle_dict.get(request['type'], self.handle_default)
-        return func(request['data'])
+        req_type = request['type']
+        func = handle_dict.get(req_type)
+        if func is None:
+            func = self.handle_default
+            req_type = 'other'  # 标签只使用已知的请求类型
+        if not metrics.ENABLED:
+            return await func(request['data'])
+        timed = profiling.CpuTimed(func(request['data']))
+        start = time.perf_counter()
+        try:
+            return await timed
+        finally:
+            REQUEST_SECONDS.labels(req_type).observe(time.perf_counter() - start)
+            REQUEST_CPU.labels(req_type).inc(timed.cpu)
 
-    def push_data(self, req_type, data):
+    async def push_data(self, req_type, data, droppable=True):
         data = {
             'type': req_type,
             'data': data
         }
         logger.debug(f'{self.username}: {data}')
-        data = pack_enc_data(data, self.server_count, self.aes_gcm_key)
+        PUSHES.labels(req_type).inc()
+        await self.outbound.put(encode_data(data, self.codec), droppable)
 
-        self.add_server_count()
-        self.writer.write(data)
+    async def push_raw(self, data):  # data 为已经序列化的明文, 广播时多个连接共用
+        await self.outbound.put(data)
 
     async def start_listen(self):
         try:
@@ -250,30 +331,199 @@ class Server(DH):
                 else:
                     length = read_length(length)
                     request = await self.reader.readexactly(length)
+                    FRAMES_IN.inc()
+                    BYTES_IN.inc(length + 4)
 
                     if not self.handshake:
                         request = unpack_data(request)
-                        response = self.handle_handshake(request)
-                        response = pack_data(response)
+                        kex = request.get('kex', crypto.KEX_DH)
+                        kex = kex if kex in (crypto.KEX_X25519, crypto.KEX_DH) else 'other'
+                        start = time.perf_counter()
+                        try:
+                            response = await self.handle_handshake(request)
+                        except Exception:
+                            HANDSHAKES.labels(kex, 'error').inc()
+                            raise
+                        HANDSHAKE_SECONDS.labels(kex).observe(time.perf_counter() - start)
+                        HANDSHAKES.labels(kex, 'ok' if self.handshake else 'rejected').inc()
+                        self.writer.write(pack_data(response))
+                        if self.handshake:
+                            self.outbound.start(self.cipher, self.compressor)  # 握手之后的数据都经过发送队列
                     else:
-                        request = unpack_enc_data(request, self.client_count, self.aes_gcm_key)
-                        self.add_client_count()
+                        request = unpack_enc_data(request, self.cipher, self.codec, self.decompressor)
                         if not self.verify_timestamp(request['timestamp']):
                             self.died = True
                             return  # 检验时间戳不正确, 可能遇到重放攻击
-                        response = self.handle_request(request)
-                        response = pack_enc_data(response, self.server_count, self.aes_gcm_key)
-                        self.add_server_count()
+                        response = await self.handle_request(request)
+                        if 'id' in request:  # 客户端按 id 把响应对应到请求, 推送不带 id
+                            response['id'] = request['id']
+                        await self.outbound.put(encode_data(response, self.codec), droppable=False)
                     logger.debug(f'{self.username}: {request}')
-                    self.writer.write(response)
         except Exception:
             self.died = True  # 遭遇异常退出
             logger.info(f'{self.username} 下线')
             return
 
 
-PUBLIC_KEY: rsa.PublicKey
-PRIVATE_KEY: rsa.PrivateKey
+async def kick(server):
+    await server.push_data('kicked', {})
+    server.died = True
+    server.outbound.close()
+    logger.info(f'{server.username} 被踢下线')
+
+
+async def route_user(username, req_type, data):  # 推送给本进程或其他进程的用户, 用户不在线时返回 False
+    if username in global_users:
+        await global_users[username].push_data(req_type, data)
+        return True
+    if bus is not None and bus.owner(username) is not None:
+        bus.send_user(username, req_type, data)
+        return True
+    return False
+
+
+SENT = 'sent'
+QUEUED = 'queued'
+
+
+async def deliver_user(username, req_type, data):
+    # 在线时直接推送, 不在线时保存到离线队列; 返回 SENT, QUEUED, 或者 None (用户不存在或离线队列已满)
+    if offline is not None and username in draining:
+        try:
+            return QUEUED if await offline.put(username, req_type, data) else None
+        except OSError:
+            return None  # 已经记录日志
+    if await route_user(username, req_type, data):
+        return SENT
+    if offline is None or await user_store.get_public_key(username) is None:
+        return None
+    try:
+        return QUEUED if await offline.put(username, req_type, data) else None
+    except OSError:
+        return None  # 已经记录日志
+
+
+def delivery_response(status, res_type):
+    if status == SENT:
+        return {'success': True, 'type': res_type}
+    elif status == QUEUED:
+        return {'success': True, 'type': res_type, 'queued': True}
+    return {'success': False, 'type': res_type}
+
+
+def start_drain(username):  # 用户在本进程或其他进程上线后, 投递本进程保存的离线消息
+    if offline is not None and offline.count(username) and username not in draining:
+        draining[username] = asyncio.ensure_future(drain_offline(username))
+
+
+async def drain_offline(username):
+    # 一批消息全部交给连接的 transport 之后才从磁盘删除; 连接在这之前断开时整批留到下次登录 (至少一次, 可能重复)
+    try:
+        while True:
+            messages = await offline.fetch(username, OFFLINE_BATCH)
+            if not messages:
+                return
+            server = global_users.get(username)
+            if server is not None and not server.died:
+                for seq, req_type, data in messages:
+                    await server.push_data(req_type, data, droppable=False)
+                await server.outbound.wait_flushed()  # 也避免对方读得慢时把整个离线队列堆进发送队列
+                if server.outbound.closed:
+                    return
+            elif bus is not None and bus.owner(username) is not None:
+                if not await deliver_by_bus(username, messages):
+                    return
+            else:
+                return  # 又下线了
+            offline.ack(username, messages[-1][0])
+    except Exception:
+        logger.exception(f'投递 {username} 的离线消息失败')
+    finally:
+        draining.pop(username, None)
+
+
+async def deliver_by_bus(username, messages):  # 用户在其他进程上, 等那个进程确认整批已经交给连接
+    seq = messages[-1][0]
+    future = bus_deliveries[(username, seq)] = asyncio.get_event_loop().create_future()
+    try:
+        for message_seq, req_type, data in messages:
+            bus.send_user(username, req_type, data, durable=True, ack=seq if message_seq == seq else None)
+        return await asyncio.wait_for(future, OFFLINE_CONFIRM_TIMEOUT)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        bus_deliveries.pop((username, seq), None)
+
+
+async def on_bus_delivered(message):
+    future = bus_deliveries.get((message['username'], message['seq']))
+    if future is not None and not future.done():
+        future.set_result(True)
+
+
+async def confirm_delivery(server, message):  # 其他进程发来的离线消息交给连接之后回复确认
+    await server.outbound.wait_flushed()
+    if not server.outbound.closed:
+        bus.delivered(message['reply'], message['username'], message['ack'])
+
+
+async def on_bus_presence(message):  # 其他进程的用户上线/下线
+    presence.touch(message['username'])
+    if message['op'] == 'online':
+        start_drain(message['username'])
+
+
+def is_user_online(username):
+    return username in global_users or (bus is not None and bus.owner(username) is not None)
+
+
+def publish_presence(version, online, offline):
+    # 协议版本 4 起的客户端每批只收到一帧 presence, 旧客户端仍然逐个收到 online/offline
+    current = []
+    legacy = []
+    for server in global_users.values():
+        (current if server.version >= 4 else legacy).append(server)
+    if current:
+        spawn_broadcast(current, 'presence', {'version': version, 'online': online, 'offline': offline})
+    if legacy:
+        for username in online:
+            spawn_broadcast([server for server in legacy if server.username != username], 'online', username)
+        for username in offline:
+            spawn_broadcast(legacy, 'offline', username)
+
+
+async def on_bus_kick(message):  # 用户在其他进程重新登录
+    server = global_users.pop(message['username'], None)
+    if server is not None:
+        await kick(server)
+
+
+async def on_bus_send_user(message):
+    server = global_users.get(message['username'])
+    if server is not None:
+        await server.push_data(message['type'], message['data'], droppable=not message.get('durable'))
+        if 'ack' in message:
+            asyncio.ensure_future(confirm_delivery(server, message))  # 不阻塞总线上后面的消息
+
+
+async def on_bus_broadcast(message):
+    if history is not None and message['type'] == 'send_everyone':  # 每个进程各自保存一份, seq 换成本进程的编号
+        message['data']['seq'] = history.append(message['data']['from'], message['data']['message'])
+    spawn_broadcast(global_users.values(), message['type'], message['data'])
+
+
+def history_page(before, limit):  # records 为原始记录, 不在服务器上逐条解析
+    first, records, more = history.page(before, limit, HISTORY_PAGE_BYTES)
+    return {'first': first, 'records': records, 'more': more}
+
+
+async def on_bus_connected(message):  # 连上 (或重新连上) 总线后重新登记本进程的在线用户
+    for username in global_users:
+        bus.online(username)
+
+
+PUBLIC_KEY = None
+PRIVATE_KEY = None
 
 def set_server_keys(public_key, private_key):
     global PUBLIC_KEY
@@ -282,22 +532,347 @@ def set_server_keys(public_key, private_key):
     PUBLIC_KEY = public_key
     PRIVATE_KEY = private_key
 
+
+def set_crypto_workers(max_workers):  # 0 表示在事件循环里直接计算
+    global crypto_pool
+
+    if crypto_pool is not None:
+        crypto_pool.close()
+    crypto_pool = CryptoPool(PRIVATE_KEY, max_workers)
+
+
+def set_bus(address, worker):
+    # address 为 unix:/path (单机多进程, 主进程的总线) 或 tcp:host:port (集群, broker_main.py), worker 为唯一的进程名
+    global bus
+    global BUS_ADDRESS
+
+    BUS_ADDRESS = address
+    bus = create_backend(address, worker, {
+        'connected': on_bus_connected,
+        'online': on_bus_presence,
+        'offline': on_bus_presence,
+        'kick': on_bus_kick,
+        'send_user': on_bus_send_user,
+        'delivered': on_bus_delivered,
+        'broadcast': on_bus_broadcast
+    })
+
+
+def set_offline_store(path, **options):  # path 为 None 时不保存离线消息, options 见 OfflineStore
+    global OFFLINE_DIR
+    global OFFLINE_OPTIONS
+
+    OFFLINE_DIR = path
+    OFFLINE_OPTIONS = options
+
+
+def start_offline_store():
+    global offline
+
+    if offline is not None:
+        offline.close()
+        offline = None
+    if OFFLINE_DIR is not None:
+        offline = OfflineStore(OFFLINE_DIR, **OFFLINE_OPTIONS)
+        offline.open()
+        offline.start()
+
+
+def set_history(path, max_messages=1000, max_bytes=4 * 1024 * 1024, login_messages=200):
+    # path 为 None 时不保存公共聊天历史; 登录时推送最近 login_messages 条, 更早的由客户端翻页请求
+    global HISTORY_PATH
+    global HISTORY_OPTIONS
+    global HISTORY_LOGIN
+
+    HISTORY_PATH = path
+    HISTORY_OPTIONS = {'max_messages': max_messages, 'max_bytes': max_bytes}
+    HISTORY_LOGIN = login_messages
+
+
+def start_history():
+    global history
+
+    if history is not None:
+        history.close()
+        history = None
+    if HISTORY_PATH is not None:
+        history = HistoryRing(HISTORY_PATH, **HISTORY_OPTIONS)
+        history.open()
+
+
+def set_presence(tick=0.05, history=1024):  # tick 秒内的上下线合并成一批推送, 保留 history 批变化用于增量同步
+    global presence
+    global PRESENCE_TICK
+    global PRESENCE_HISTORY
+
+    PRESENCE_TICK = tick
+    PRESENCE_HISTORY = history
+    presence = Presence(is_user_online, publish_presence, tick, history)
+
+
+def set_admin(address):  # unix:/path 或 tcp:127.0.0.1:port, None 表示不开启管理接口
+    global ADMIN_ADDRESS
+
+    ADMIN_ADDRESS = address
+
+
+async def start_admin():
+    global admin
+
+    if admin is not None:
+        admin.close()
+    admin = AdminServer()
+    admin.route('/metrics', lambda query: (200, metrics.CONTENT_TYPE, metrics.render()))
+    admin.route('/handlers', admin_handlers)
+    admin.route('/profile', admin_profile)
+    admin.route('/profile/start', admin_profile_start)
+    admin.route('/profile/stop', admin_profile_stop)
+    admin.route('/tracemalloc/start', admin_tracemalloc_start)
+    admin.route('/tracemalloc/top', admin_tracemalloc_top)
+    admin.route('/tracemalloc/stop', admin_tracemalloc_stop)
+    await admin.start(ADMIN_ADDRESS)
+
+
+def set_profile_dir(path):  # SIGUSR1/SIGUSR2 触发的分析结果的输出目录
+    global PROFILE_DIR
+
+    PROFILE_DIR = path
+
+
+def start_profiler(interval=None):
+    global profiler
+
+    if profiler is not None:
+        return False
+    profiler = profiling.SamplingProfiler(interval or PROFILE_INTERVAL)
+    profiler.start()
+    logger.info(f'开始采样分析, 间隔 {profiler.interval * 1000:g} 毫秒')
+    return True
+
+
+def stop_profiler():  # 返回折叠栈文本, 没有运行时返回 None
+    global profiler
+
+    if profiler is None:
+        return None
+    current, profiler = profiler, None
+    current.stop()
+    logger.info(f'停止采样分析, 共 {current.samples} 次采样')
+    return current.folded()
+
+
+def handler_cpu_table():  # 每种请求的次数, 处理函数 CPU 时间合计和平均值, 按 CPU 时间排序
+    rows = []
+    for (req_type,), cpu in REQUEST_CPU.children.items():
+        seconds = REQUEST_SECONDS.children.get((req_type,))
+        count = sum(seconds.counts) if seconds else 0
+        wall = seconds.sum if seconds else 0.0
+        rows.append((cpu.value, req_type, count, wall))
+    rows.sort(reverse=True)
+    lines = [f'{"type":<16}{"count":>10}{"cpu_s":>12}{"cpu_us/req":>12}{"wall_us/req":>13}']
+    for cpu, req_type, count, wall in rows:
+        lines.append(f'{req_type:<16}{count:>10}{cpu:>12.6f}{cpu / max(count, 1) * 1e6:>12.1f}'
+                     f'{wall / max(count, 1) * 1e6:>13.1f}')
+    return '\n'.join(lines) + '\n'
+
+
+def admin_handlers(query):
+    return 200, 'text/plain; charset=utf-8', handler_cpu_table()
+
+
+async def admin_profile(query):  # /profile?seconds=10 采样一段时间后返回折叠栈, 可以直接交给 flamegraph.pl 或 speedscope
+    seconds = float(query.get('seconds', 10))
+    if not 0 < seconds <= 600:
+        return 400, 'text/plain', 'seconds 需要在 0 到 600 之间\n'
+    if not start_profiler(float(query['interval']) if 'interval' in query else None):
+        return 400, 'text/plain', '采样分析已经在运行\n'
+    await asyncio.sleep(seconds)
+    folded = stop_profiler()
+    if folded is None:
+        return 400, 'text/plain', '采样分析已经被其他请求停止\n'
+    return 200, 'text/plain; charset=utf-8', folded
+
+
+def admin_profile_start(query):
+    if not start_profiler(float(query['interval']) if 'interval' in query else None):
+        return 400, 'text/plain', '采样分析已经在运行\n'
+    return 200, 'text/plain', '开始采样分析\n'
+
+
+def admin_profile_stop(query):
+    folded = stop_profiler()
+    if folded is None:
+        return 400, 'text/plain', '采样分析没有运行\n'
+    return 200, 'text/plain; charset=utf-8', folded
+
+
+def admin_tracemalloc_start(query):
+    profiling.start_tracemalloc(int(query.get('frames', TRACEMALLOC_FRAMES)))
+    return 200, 'text/plain', '开始跟踪内存分配\n'
+
+
+def admin_tracemalloc_top(query):
+    key = query.get('key', 'lineno')
+    if key not in ('lineno', 'filename', 'traceback'):
+        return 400, 'text/plain', 'key 只能是 lineno, filename 或 traceback\n'
+    return 200, 'text/plain; charset=utf-8', profiling.top_allocations(int(query.get('limit', 30)), key)
+
+
+def admin_tracemalloc_stop(query):
+    top = profiling.top_allocations(int(query.get('limit', 30)))
+    profiling.stop_tracemalloc()
+    return 200, 'text/plain; charset=utf-8', top
+
+
+def profile_path(kind):
+    return os.path.join(PROFILE_DIR or tempfile.gettempdir(), f'chat_{kind}_{os.getpid()}_{int(time.time())}')
+
+
+def on_sigusr1():  # 第一次开始采样, 第二次停止并把折叠栈写到文件
+    if profiler is None:
+        start_profiler()
+        return
+    path = profile_path('profile') + '.folded'
+    with open(path, 'w') as f:
+        f.write(stop_profiler())
+    logger.info(f'采样结果写入 {path}')
+
+
+def on_sigusr2():  # 第一次开始跟踪内存分配, 第二次停止并把分配最多的位置写到文件
+    if not profiling.tracemalloc.is_tracing():
+        profiling.start_tracemalloc(TRACEMALLOC_FRAMES)
+        logger.info('开始跟踪内存分配')
+        return
+    path = profile_path('tracemalloc') + '.txt'
+    with open(path, 'w') as f:
+        f.write(profiling.top_allocations(100, 'traceback'))
+    profiling.stop_tracemalloc()
+    logger.info(f'内存分配统计写入 {path}')
+
+
+def install_profile_signals():
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGUSR1, on_sigusr1)
+    loop.add_signal_handler(signal.SIGUSR2, on_sigusr2)
+
+
+def set_dh_keypool(min_size, max_size):  # max_size 为 0 时不预生成, 每次握手现场计算
+    global DH_KEYPOOL_MIN_SIZE
+    global DH_KEYPOOL_MAX_SIZE
+
+    DH_KEYPOOL_MIN_SIZE = min(min_size, max_size)
+    DH_KEYPOOL_MAX_SIZE = max_size
+
+
+def set_handshake_modes(modes):
+    global HANDSHAKE_MODES
+
+    for kex in modes:
+        if kex not in crypto.get_provider().kex:
+            raise ValueError(f'当前密码学实现不支持 {kex} 握手')
+    HANDSHAKE_MODES = list(modes)
+
+
+def get_handshake_modes():
+    return HANDSHAKE_MODES or list(crypto.get_provider().kex)
+
+
+def set_user_store(url, max_workers=4, key_cache_size=10000):
+    global user_store
+
+    if user_store is not None:
+        user_store.close()
+    user_store = UserStore(url, max_workers, key_cache_size)
+
+
+def set_outbound_limits(max_frames, max_bytes, policy):
+    global OUTBOUND_MAX_FRAMES
+    global OUTBOUND_MAX_BYTES
+    global OUTBOUND_POLICY
+
+    OUTBOUND_MAX_FRAMES = max_frames
+    OUTBOUND_MAX_BYTES = max_bytes
+    OUTBOUND_POLICY = policy
+
+
+def set_compression(enabled, level=6, threshold=32, max_frame=1024 * 1024):
+    global COMPRESSION_ENABLED
+    global COMPRESS_LEVEL
+    global COMPRESS_THRESHOLD
+    global COMPRESS_MAX_FRAME
+
+    COMPRESSION_ENABLED = enabled
+    COMPRESS_LEVEL = level
+    COMPRESS_THRESHOLD = threshold
+    COMPRESS_MAX_FRAME = max_frame
+
+
+def get_compression_stats():  # 在线连接的压缩比和压缩/解压耗时之和
+    stats = {'connections': 0, 'bytes_in': 0, 'bytes_out': 0, 'compress_time': 0.0,
+             'recv_bytes_in': 0, 'recv_bytes_out': 0, 'decompress_time': 0.0}
+    for server in global_users.values():
+        if server.compressor is None:
+            continue
+        sent = server.compressor.stats()
+        received = server.decompressor.stats()
+        stats['connections'] += 1
+        stats['bytes_in'] += sent['bytes_in']
+        stats['bytes_out'] += sent['bytes_out']
+        stats['compress_time'] += sent['cpu_time']
+        stats['recv_bytes_in'] += received['bytes_in']
+        stats['recv_bytes_out'] += received['bytes_out']
+        stats['decompress_time'] += received['cpu_time']
+    stats['ratio'] = stats['bytes_out'] / stats['bytes_in'] if stats['bytes_in'] else 1.0
+    return stats
+
+
+def get_outbound_stats():  # 每个在线用户的发送队列深度和缓冲字节数
+    return {username: server.outbound.stats() for username, server in global_users.items()}
+
 async def new_server(reader, writer):
     global PUBLIC_KEY
     global PRIVATE_KEY
 
+    CONNECTIONS.inc()
     server = Server(reader, writer, PRIVATE_KEY, PUBLIC_KEY)
-    await server.start_listen()
-    writer.close()
+    try:
+        await server.start_listen()
+    finally:
+        CONNECTIONS.dec()
+    server.outbound.close()
     if server.username in global_users and global_users[server.username].died:
         global_users.pop(server.username)  # 删除正常退出的用户
-
-        for username in global_users:
-            if username != server.username:
-                global_users[username].push_data('offline', server.username)  # 通知其他用户
-
-
-async def start_server(host, port):
+        presence.touch(server.username)  # 通知其他用户
+        if bus is not None:
+            bus.offline(server.username)
+
+
+def start_dh_keypool():
+    global dh_keypool
+
+    if dh_keypool is not None:
+        dh_keypool.close()
+        dh_keypool = None
+    if DH_KEYPOOL_MAX_SIZE > 0 and crypto.KEX_DH in get_handshake_modes():
+        dh_keypool = DHKeyPool(crypto_pool, DH_KEYPOOL_MIN_SIZE, DH_KEYPOOL_MAX_SIZE)
+        dh_keypool.start()
+
+
+async def start_server(host, port, reuse_port=False):  # reuse_port: 多个工作进程共享同一个端口
+    if user_store is None:
+        set_user_store(DEFAULT_DB_URL)
+    if crypto_pool is None:
+        set_crypto_workers(0)
+    if presence is None:
+        set_presence(PRESENCE_TICK, PRESENCE_HISTORY)
+    start_dh_keypool()
+    start_offline_store()
+    start_history()
+    install_profile_signals()
+    if ADMIN_ADDRESS is not None:
+        await start_admin()
+    if bus is not None:
+        await bus.connect(BUS_ADDRESS)
     logger.info(f'服务器开启在 {host}:{port}')
-    server = await asyncio.start_server(new_server, host, port)
+    server = await asyncio.start_server(new_server, host, port, reuse_port=reuse_port)
     await server.serve_forever()
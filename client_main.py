@@ -1,25 +1,34 @@
 from ui.ui_Login import Ui_Login
 from ui.ui_MainWindow import Ui_MainWindow
+from ui.ui_Search import Ui_Search
 from PyQt5 import QtWidgets
 import sys
-from classes.client import get_client, Client
+from classes.client import get_client, make_crypto_executor, Client
+from classes.history_model import ChatHistoryModel
+from utils.message_store import MessageStore
 import asyncio
 from os.path import basename, exists
-import rsa
 import json
 import time
-from PyQt5.QtCore import Qt, QStringListModel
+from PyQt5.QtCore import QStringListModel, QTimer
 from PyQt5.QtGui import QKeyEvent
-from PyQt5.QtWidgets import QListWidgetItem, QDesktopWidget
+from PyQt5.QtWidgets import QDesktopWidget, QAbstractItemView
 from utils.tools import verify_username
+from utils import crypto
 from quamash import QEventLoop
 from base64 import b64encode
 import functools
 
 with open('server_public_key', 'r') as f:
-    server_public_key = rsa.PublicKey.load_pkcs1(f.read())
+    server_public_key = crypto.load_public_key(f.read())
+
+HISTORY_PAGE = 100  # 每次从本地聊天记录加载的消息数
+HISTORY_KEEP = 200  # 会话在内存里保留的消息数, 正在往上翻看的会话除外
+SEARCH_LIMIT = 100  # 每次搜索显示的结果数, 从新到旧
+FRAME_INTERVAL = 16  # 收到的消息每隔这么多毫秒一起更新界面
 
 client: Client
+crypto_executor = make_crypto_executor()  # 私聊 DH 和登录签名, 不阻塞界面; 在创建 QApplication 之前启动工作进程
 app = QtWidgets.QApplication(sys.argv)
 loop = QEventLoop(app)
 asyncio.set_event_loop(loop)
@@ -84,6 +93,7 @@ class Login(QtWidgets.QWidget, Ui_Login):
             server_addr = self.text_server_addr.text()
             server_port = int(self.text_server_port.text())
             client = await get_client(server_addr, server_port, server_public_key)
+            client.crypto_executor = crypto_executor
         except Exception:
             QtWidgets.QMessageBox.warning(None, " ", "无法连接到服务器")
             return
@@ -95,17 +105,27 @@ class Login(QtWidgets.QWidget, Ui_Login):
 
         with open(self.private_key_path, 'r') as f:
             data = json.loads(f.read())
-            private_key = rsa.PrivateKey.load_pkcs1(data['private_key'])
-            public_key = rsa.PublicKey.load_pkcs1(data['public_key'])
+            private_key = crypto.load_private_key(data['private_key'])
+            public_key = crypto.load_public_key(data['public_key'])
 
-        register_res = await client.send_register(public_key, username)
-        login_res = await client.send_login(private_key, username)
+        # 注册和获取挑战同时发出, 服务器按顺序处理, 登录少等一个往返
+        register_res, login_res = await asyncio.gather(
+            client.send_register(public_key, username),
+            client.send_login(private_key, username)
+        )
 
         if not register_res['success'] and not login_res['success']:
             QtWidgets.QMessageBox.warning(None, " ", "这个用户名已经有人使用, 或者私钥文件不正确")
             client.writer.close()
             return
 
+        try:
+            main_window.open_store(username, data['private_key'])
+        except ValueError:
+            QtWidgets.QMessageBox.warning(None, " ", "本地聊天记录不是用这个私钥加密的")
+            client.writer.close()
+            return
+
         self.save_last_settings()
         self.hide()
         main_window.show()
@@ -118,6 +138,40 @@ class Login(QtWidgets.QWidget, Ui_Login):
             self.btn_public_key.setText(basename(public_key_path))
 
 
+class SearchDialog(QtWidgets.QDialog, Ui_Search):  # 在本地聊天记录里搜索, 可以只搜索一个会话
+    def __init__(self, parent=None):
+        QtWidgets.QDialog.__init__(self, parent)
+        Ui_Search.__init__(self)
+        self.setupUi(self)
+        self.store: MessageStore = None
+        self.btn_search.clicked.connect(self.search)
+        self.text_query.returnPressed.connect(self.search)
+
+    def open_search(self, store, conversation):  # 默认只搜索当前会话
+        self.store = store
+        self.combo_conversation.clear()
+        self.combo_conversation.addItem("全部")
+        self.combo_conversation.addItems(sorted(store.conversations()))
+        index = self.combo_conversation.findText(conversation)
+        self.combo_conversation.setCurrentIndex(max(index, 0))
+        self.show()
+        self.activateWindow()
+        self.text_query.setFocus()
+
+    def search(self):
+        query = self.text_query.text().strip()
+        if not query:
+            return
+        conversation = self.combo_conversation.currentText() if self.combo_conversation.currentIndex() > 0 else None
+        results = self.store.search(query, conversation, SEARCH_LIMIT)
+        for message in results:  # 标题里加上会话名
+            message['from'] = f"[{message['conversation']}] {message['from']}"
+        self.list_results.setModel(ChatHistoryModel(results[::-1]))
+        self.list_results.scrollToBottom()
+        if not results:
+            QtWidgets.QMessageBox.information(self, " ", "没有找到包含这些关键词的消息")
+
+
 class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     def __init__(self):
         QtWidgets.QMainWindow.__init__(self)
@@ -126,15 +180,29 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.list_users.clicked.connect(self.switch_history)
         self.btn_send.clicked.connect(self.send_message)
         self.btn_look_key.clicked.connect(self.show_aes_key)
+        self.btn_search.clicked.connect(self.show_search)
+        self.list_history.verticalScrollBar().valueChanged.connect(self.load_older_history)
 
         self.text_msg_key_press_event = self.text_msg.keyPressEvent
         self.text_msg.keyPressEvent = self.keyPressEvent
 
         self.users = set()
-        self.history = dict()
+        self.history = dict()  # 用户名 -> ChatHistoryModel, 只保存最近的消息, 完整记录在 store 里
+        self.store: MessageStore = None
+        self.search_dialog = SearchDialog(self)
+        self.incoming = []  # (用户名, 消息), 等待下一帧处理
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(FRAME_INTERVAL)
+        self.flush_timer.timeout.connect(self.flush_messages)
 
         self.public_room_name = "<公共聊天>"
         self.curr_select = self.public_room_name
+        self.history[self.public_room_name] = ChatHistoryModel()
+        self.show_history(self.history[self.public_room_name])
+        self.history_first = None  # 已经收到的最早一条公共聊天历史的 seq
+        self.history_more = False  # 服务器上是否还有更早的历史
+        self.history_loading = False
 
     def keyPressEvent(self, event):
         key_event = QKeyEvent(event)
@@ -144,30 +212,23 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             self.text_msg_key_press_event(event)
 
     def refresh_user_list(self, client: Client, response):
-        self.users = set(response['data'])
+        self.users = set(response['data'])  # 私聊密钥在打开会话时才协商
         self.users.add(self.public_room_name)
-        for username in self.users:
-            self.history[username] = []
-            client.send_dh_request(username, True)  # 发送握手请求
-
         self.list_users.setModel(QStringListModel(self.users))
 
     def user_online(self, client: Client, response):
         username = response['data']
-        self.history[username] = []
-
         self.users.add(username)
-        client.send_dh_request(username, True)  # 发送握手请求
         self.list_users.setModel(QStringListModel(self.users))
 
     def user_offline(self, client: Client, response):
         username = response['data']
         self.users.remove(username)
-        self.history.pop(username)
+        self.history.pop(username, None)  # 聊天记录在本地保存, 再次打开会话时重新加载
         self.list_users.setModel(QStringListModel(self.users))
         if self.curr_select == username:  # 当前选择用户是下线的用户时, 刷新聊天框
             self.curr_select = self.public_room_name
-            self.refresh_history(self.history[self.public_room_name])
+            self.show_history(self.history[self.public_room_name])
 
     def kicked(self, client: Client, response):
         QtWidgets.QMessageBox.warning(None, " ", "您已经被踢下线, 如果非本人操作, 请确认私钥是否泄露")
@@ -176,45 +237,134 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     def show_aes_key(self):
         if self.curr_select == self.public_room_name:
             message = "公共房间只存在 客户端-服务端 加密"
-        else:
+        elif client.ensure_key(self.curr_select):
             message = b64encode(client.user_dh_keys[self.curr_select]['dh_common_key']).decode()
+        else:
+            message = "正在与对方协商密钥"
         QtWidgets.QMessageBox.warning(None, " ", message)
 
+    def show_search(self):
+        self.search_dialog.open_search(self.store, self.curr_select)
+
     def handle_send_everyone(self, client: Client, response):
         response['data']['me'] = False
         response['data']['time'] = time.strftime('%H:%M:%S')
-        self.history[self.public_room_name].append(response['data'])
+        self.add_message(self.public_room_name, response['data'])
+
+    def handle_history(self, client: Client, response):  # 登录时推送的最近消息, 或者滚动到顶部时请求的更早一页
+        data = response['data']
+        if self.history_first is not None and data['first'] >= self.history_first:
+            return  # 重复的页
+        page = [{
+            'from': message['from'],
+            'message': message['message'],
+            'me': message['from'] == client.username,
+            'time': time.strftime('%m-%d %H:%M:%S', time.localtime(message['timestamp'])),
+            'seq': message['seq']
+        } for message in data['messages'] if self.history_first is None or message['seq'] < self.history_first]
+        older = self.history_first is not None
+        model = self.history[self.public_room_name]
+        model.prepend(page)
+        self.history_first = data['first']
+        self.history_more = data['more']
+        self.history_loading = False
         if self.curr_select == self.public_room_name:
-            self.refresh_history(self.history[self.public_room_name])
+            if older:  # 停在翻页之前最上面的那条消息
+                self.list_history.scrollTo(model.index(len(page) * 2), QAbstractItemView.PositionAtTop)
+            else:
+                self.list_history.scrollToBottom()
+
+    def load_older_history(self, value):  # 滚动到顶部时加载更早的一页: 公共聊天向服务器请求, 私聊从本地记录读取
+        if value != 0:
+            return
+        if self.curr_select == self.public_room_name:
+            if self.history_more and not self.history_loading:
+                self.history_loading = True
+                client.send_get_history(self.history_first)
+            return
+        model = self.history[self.curr_select]
+        if model.messages:
+            page = self.store.page(self.curr_select, model.messages[0]['id'], HISTORY_PAGE)
+            if page:
+                model.prepend(page)
+                self.list_history.scrollTo(model.index(len(page) * 2), QAbstractItemView.PositionAtTop)
 
     def handle_send_user(self, client: Client, response):
         response['data']['me'] = False
         response['data']['time'] = time.strftime('%H:%M:%S')
-        self.history[response['data']['from']].append(response['data'])
-        if self.curr_select == response['data']['from']:
-            self.refresh_history(self.history[response['data']['from']])
-
-    def refresh_history(self, history):
-        self.list_history.clear()
-
-        for i in history:
-            item_a = QListWidgetItem(f"{i['from']} in {i['time']}:  ")
-            item_b = QListWidgetItem(i['message'] + "  ")
-            if i['me']:
-                item_a.setTextAlignment(Qt.AlignRight)
-                item_b.setTextAlignment(Qt.AlignRight)
-            else:
-                item_a.setTextAlignment(Qt.AlignLeft)
-                item_b.setTextAlignment(Qt.AlignLeft)
-            self.list_history.addItem(item_a)
-            self.list_history.addItem(item_b)
-
+        self.add_message(response['data']['from'], response['data'])
+
+    def handle_send_user_lost(self, client: Client, response):  # 收到无法解密的私聊, 已经重新协商密钥
+        self.add_message(response['data']['from'], {
+            'from': response['data']['from'],
+            'message': '[收到一条无法解密的消息, 已重新协商密钥, 请对方重新发送]',
+            'me': False,
+            'time': time.strftime('%H:%M:%S')
+        })
+
+    def open_store(self, username, key_material):  # 登录后打开本地聊天记录, 私钥不对时抛出 ValueError
+        store = MessageStore(f'{username}.history.db', key_material)
+        store.open()
+        if self.store is not None:
+            self.store.close()
+        self.store = store
+
+    def get_model(self, username):  # 第一次打开会话时从本地记录加载最近一页
+        model = self.history.get(username)
+        if model is None:
+            messages = self.store.page(username, None, HISTORY_PAGE) if username != self.public_room_name else []
+            model = self.history[username] = ChatHistoryModel(messages)
+        return model
+
+    def trim_history(self, username):  # 内存里只保留最近的消息
+        model = self.history.get(username)
+        if model is not None and model.trim(HISTORY_KEEP) and username == self.public_room_name:
+            seqs = [message['seq'] for message in model.messages if 'seq' in message]
+            if seqs:  # 自己发的消息没有 seq, 从最早的带 seq 的消息往前翻页
+                self.history_first = seqs[0]
+                self.history_more = True
+
+    def add_message(self, username, message):  # 消息先排队, 每帧由 flush_messages 一起处理
+        self.incoming.append((username, message))
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def flush_messages(self):
+        # 一帧里的消息在一个事务里写入本地记录, 每个会话只插入一次行 (不重建列表), 只滚动一次
+        incoming, self.incoming = self.incoming, []
+        if not incoming:
+            return
+        conversations = dict()
+        for username, message in incoming:
+            if username not in conversations:
+                self.get_model(username)  # 在写入之前加载, 本地记录里的最近一页不包括这些消息
+                conversations[username] = []
+            conversations[username].append(message)
+        # 公共聊天也写入本地记录以便搜索, 但显示时仍然从服务器翻页, 只通过翻页收到的历史不在本地记录里
+        for (_, message), message_id in zip(incoming, self.store.append_many(incoming)):
+            message['id'] = message_id
+        scrollbar = self.list_history.verticalScrollBar()
+        at_bottom = scrollbar.value() == scrollbar.maximum()
+        for username, messages in conversations.items():
+            self.history[username].extend(messages)
+            if self.curr_select != username or at_bottom:  # 正在往上翻看时不删除更早的消息, 也不跳到底部
+                self.trim_history(username)
+        if self.curr_select in conversations and at_bottom:
+            self.list_history.scrollToBottom()
+
+    def show_history(self, model):  # 切换会话只换模型, 视图按需取可见的行
+        self.list_history.verticalScrollBar().blockSignals(True)  # 切换时不触发翻页
+        self.list_history.setModel(model)
         self.list_history.scrollToBottom()
+        self.list_history.verticalScrollBar().blockSignals(False)
 
     def switch_history(self):
         username = self.list_users.currentIndex().data()
+        self.trim_history(self.curr_select)
         self.curr_select = username
-        self.refresh_history(self.history[username])
+        if username != self.public_room_name:  # 本地缓存里没有密钥时开始协商, 发出的消息排队等待
+            client.ensure_key(username)
+        self.show_history(self.get_model(username))
 
     def send_message(self):
         global client
@@ -227,13 +377,13 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             else:
                 client.send_to_user(self.curr_select, message)
                 target = self.curr_select
-            self.history[target].append({
+            self.add_message(target, {
                 'from': client.username,
                 'message': message,
                 'me': True,
                 'time': time.strftime('%H:%M:%S')
             })
-            self.refresh_history(self.history[target])
+            self.flush_messages()  # 自己的消息立即显示, 排在已经收到的消息之后
             self.text_msg.clear()
 
     async def start_listen(self):
@@ -243,10 +393,13 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             'online': self.user_online,
             'offline': self.user_offline,
             'send_everyone': self.handle_send_everyone,
-            'send_user': self.handle_send_user
+            'send_user': self.handle_send_user,
+            'send_user_lost': self.handle_send_user_lost,
+            'history': self.handle_history
         }
         global client
         self.lab_username.setText(client.username)
+        client.key_cache = self.store  # 协商好的私聊密钥加密保存在本地记录里
         client.send_get_users()
         await client.start_listen(callbacks)
 
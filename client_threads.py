@@ -3,23 +3,29 @@ from ui.ui_MainWindow import Ui_MainWindow
 from PyQt5 import QtWidgets
 import sys
 from classes.client import get_client, Client
+from classes.history_model import ChatHistoryModel
 import asyncio
 from os.path import basename, exists
-import rsa
 import json
 import time
-from PyQt5.QtCore import QThread, Qt, QStringListModel
+from PyQt5.QtCore import QThread, QStringListModel
 from PyQt5.QtGui import QKeyEvent
-from PyQt5.QtWidgets import QListWidgetItem
 from utils.tools import verify_username
+from utils import crypto
 
 with open('server_public_key', 'r') as f:
-    server_public_key = rsa.PublicKey.load_pkcs1(f.read())
+    server_public_key = crypto.load_public_key(f.read())
 
 client: Client
 loop = asyncio.get_event_loop()
 
 
+def load_user_keys(path):  # gen_user_key.py 生成的私钥文件 -> (public_key, private_key), 按当前的密码学实现解析
+    with open(path, 'r') as f:
+        data = json.loads(f.read())
+    return crypto.load_public_key(data['public_key']), crypto.load_private_key(data['private_key'])
+
+
 class Login(QtWidgets.QWidget, Ui_Login):
     private_key_path = ""
     thread = None
@@ -74,10 +80,7 @@ class Login(QtWidgets.QWidget, Ui_Login):
             QtWidgets.QMessageBox.warning(None, " ", "输入有效的用户名")
             return
 
-        with open(self.private_key_path, 'r') as f:
-            data = json.loads(f.read())
-            private_key = rsa.PrivateKey.load_pkcs1(data['private_key'])
-            public_key = rsa.PublicKey.load_pkcs1(data['public_key'])
+        public_key, private_key = load_user_keys(self.private_key_path)
 
         task = asyncio.ensure_future(client.send_register(public_key, username))
         loop.run_until_complete(task)
@@ -121,6 +124,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.setupUi(self)
         self.list_users.clicked.connect(self.switch_history)
         self.btn_send.clicked.connect(self.send_message)
+        self.btn_search.hide()  # 这个客户端不保存本地聊天记录
 
         self.text_msg_key_press_event = self.text_msg.keyPressEvent
         self.text_msg.keyPressEvent = self.keyPressEvent
@@ -142,17 +146,15 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.users = set(response['data'])
         self.users.add(self.public_room_name)
         for username in self.users:
-            self.history[username] = []
-            client.send_dh_request(username, True)  # 发送握手请求
+            self.history[username] = ChatHistoryModel()
 
         self.list_users.setModel(QStringListModel(self.users))
 
     def user_online(self, client:Client, response):
         username = response['data']
-        self.history[username] = []
+        self.history[username] = ChatHistoryModel()
 
         self.users.add(username)
-        client.send_dh_request(username, True)  # 发送握手请求
         self.list_users.setModel(QStringListModel(self.users))
 
     def user_offline(self, client:Client, response):
@@ -162,7 +164,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.list_users.setModel(QStringListModel(self.users))
         if self.curr_select == username:  # 当前选择用户是下线的用户时, 刷新聊天框
             self.curr_select = self.public_room_name
-            self.refresh_history(self.history[self.public_room_name])
+            self.show_history(self.history[self.public_room_name])
 
     def kicked(self, client:Client, response):
         global app
@@ -172,38 +174,28 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
     def handle_send_everyone(self, client:Client, response):
         response['data']['me'] = False
         response['data']['time'] = time.strftime('%H:%M:%S')
-        self.history[self.public_room_name].append(response['data'])
-        if self.curr_select == self.public_room_name:
-            self.refresh_history(self.history[self.public_room_name])
+        self.add_message(self.public_room_name, response['data'])
 
     def handle_send_user(self, client:Client, response):
         response['data']['me'] = False
         response['data']['time'] = time.strftime('%H:%M:%S')
-        self.history[response['data']['from']].append(response['data'])
-        if self.curr_select == response['data']['from']:
-            self.refresh_history(self.history[response['data']['from']])
-
-    def refresh_history(self, history):
-        self.list_history.clear()
-
-        for i in history:
-            item_a = QListWidgetItem(f"{i['from']} in {i['time']}:  ")
-            item_b = QListWidgetItem(i['message'] + "  ")
-            if i['me']:
-                item_a.setTextAlignment(Qt.AlignRight)
-                item_b.setTextAlignment(Qt.AlignRight)
-            else:
-                item_a.setTextAlignment(Qt.AlignLeft)
-                item_b.setTextAlignment(Qt.AlignLeft)
-            self.list_history.addItem(item_a)
-            self.list_history.addItem(item_b)
+        self.add_message(response['data']['from'], response['data'])
+
+    def add_message(self, username, message):
+        self.history[username].append(message)
+        if self.curr_select == username:
+            if self.list_history.model() is not self.history[username]:  # 用户列表刷新后换了模型
+                self.list_history.setModel(self.history[username])
+            self.list_history.scrollToBottom()
 
+    def show_history(self, model):
+        self.list_history.setModel(model)
         self.list_history.scrollToBottom()
 
     def switch_history(self):
         username = self.list_users.currentIndex().data()
         self.curr_select = username
-        self.refresh_history(self.history[username])
+        self.show_history(self.history[username])
 
     def send_message(self):
         global client
@@ -216,13 +208,12 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             else:
                 client.send_to_user(self.curr_select, message)
                 target = self.curr_select
-            self.history[target].append({
+            self.add_message(target, {
                 'from': client.username,
                 'message': message,
                 'me': True,
                 'time': time.strftime('%H:%M:%S')
             })
-            self.refresh_history(self.history[target])
             self.text_msg.clear()
 
     def start_listen(self):
@@ -239,7 +230,8 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         loop.run_until_complete(client.start_listen(callbacks))
 
 
-app = QtWidgets.QApplication(sys.argv)
-login = Login()
-login.show()
-sys.exit(app.exec_())
+if __name__ == '__main__':
+    app = QtWidgets.QApplication(sys.argv)
+    login = Login()
+    login.show()
+    sys.exit(app.exec_())
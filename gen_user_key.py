@@ -1,10 +1,10 @@
-import rsa
+from utils import crypto
 import json
 
-public_key, private_key = rsa.newkeys(2048)
+public_key, private_key = crypto.newkeys(2048)
 data = {
-    'public_key': public_key.save_pkcs1().decode(),
-    'private_key': private_key.save_pkcs1().decode()
+    'public_key': crypto.save_public_key(public_key),
+    'private_key': crypto.save_private_key(private_key)
 }
 
 data = json.dumps(data)
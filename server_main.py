@@ -1,14 +1,164 @@
-from classes.server import start_server, set_server_keys
+from classes.server import start_server, set_server_keys, set_outbound_limits, set_user_store, set_crypto_workers, \
+    set_handshake_modes, set_dh_keypool, set_bus, set_compression, set_presence, set_admin, \
+    set_profile_dir, set_offline_store, set_history
+from classes.bus import BusHub
+from classes import server
+from classes.outbound import POLICIES, DROP_OLDEST
+from utils.offline_store import SYNC_MODES, SYNC_GROUP
+from utils import crypto
+import argparse
 import asyncio
-import rsa
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
 
 
-if __name__ == '__main__':
+def parse_args():
+    parser = argparse.ArgumentParser(description='加密聊天室服务器')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='工作进程数, 大于 1 时各进程通过 SO_REUSEPORT 共享端口, 经主进程的总线互相路由')
+    parser.add_argument('--bus-path', default=None, help='多进程模式下总线的 Unix socket 路径')
+    parser.add_argument('--broker', default=None,
+                        help='集群模式: broker_main.py 的地址 (tcp:host:port), 各节点通过它共享在线用户并转发消息')
+    parser.add_argument('--node-id', default=None, help='集群中本节点的名字, 默认为 host:port')
+    parser.add_argument('--crypto-provider', choices=list(crypto.PROVIDERS), default=crypto.DEFAULT_PROVIDER,
+                        help='RSA/DH 运算的实现')
+    parser.add_argument('--kex', nargs='+', choices=[crypto.KEX_X25519, crypto.KEX_DH], default=None,
+                        help='接受的握手密钥交换方式, 默认为密码学实现支持的全部方式')
+    parser.add_argument('--dh-keypool', type=int, nargs=2, default=[16, 1024], metavar=('MIN', 'MAX'),
+                        help='预生成 DH 密钥池的大小范围, 随握手速率调整; MAX 为 0 时不预生成')
+    parser.add_argument('--crypto-workers', type=int, default=2, help='握手 RSA 运算的进程数, 0 表示不使用进程池')
+    parser.add_argument('--no-compression', action='store_true', help='拒绝客户端请求的逐连接压缩')
+    parser.add_argument('--compress-level', type=int, default=6, help='zlib 压缩级别')
+    parser.add_argument('--compress-threshold', type=int, default=32, help='短于该字节数的帧不压缩')
+    parser.add_argument('--compress-max-frame', type=int, default=1024 * 1024, help='解压后单帧的最大字节数')
+    parser.add_argument('--presence-tick', type=float, default=0.05, help='合并上下线推送的间隔 (秒)')
+    parser.add_argument('--presence-history', type=int, default=1024, help='保留多少批在线状态变化用于增量同步')
+    parser.add_argument('--admin', default=None,
+                        help='管理接口地址 (Prometheus 格式的 /metrics), 例如 tcp:127.0.0.1:9100 或 unix:/tmp/chat_admin.sock; '
+                             '多进程模式下第 i 个工作进程使用端口 +i 或路径后缀 .i')
+    parser.add_argument('--profile-dir', default=None, help='SIGUSR1/SIGUSR2 触发的采样和内存分配统计的输出目录, 默认为系统临时目录')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='DEBUG 会记录解密后的请求')
+    parser.add_argument('--db', default='sqlite:///user.db', help='用户数据库地址 (SQLAlchemy URL)')
+    parser.add_argument('--db-workers', type=int, default=4, help='数据库线程池和连接池大小')
+    parser.add_argument('--key-cache-size', type=int, default=10000, help='已解析用户公钥的 LRU 缓存大小')
+    parser.add_argument('--offline-dir', default='offline',
+                        help='离线消息目录, 为空字符串时不保存离线消息; 多进程模式下第 i 个工作进程使用子目录 i')
+    parser.add_argument('--offline-max-messages', type=int, default=1000, help='每个用户最多保存的离线消息数')
+    parser.add_argument('--offline-max-bytes', type=int, default=1024 * 1024, help='每个用户最多保存的离线消息字节数')
+    parser.add_argument('--offline-total-bytes', type=int, default=1024 * 1024 * 1024, help='所有离线消息的总字节数上限')
+    parser.add_argument('--offline-ttl', type=float, default=7 * 24 * 3600, help='离线消息保存的秒数')
+    parser.add_argument('--offline-sync', choices=SYNC_MODES, default=SYNC_GROUP,
+                        help='group: 合并 fsync, each: 每条消息 fsync, none: 不主动 fsync')
+    parser.add_argument('--history-file', default='history.ring',
+                        help='保存公共聊天最近消息的文件, 为空字符串时不保存; 多进程模式下第 i 个工作进程使用后缀 .i')
+    parser.add_argument('--history-messages', type=int, default=1000, help='保存的公共聊天消息数')
+    parser.add_argument('--history-bytes', type=int, default=4 * 1024 * 1024, help='公共聊天历史的数据区字节数')
+    parser.add_argument('--history-login', type=int, default=200, help='登录时推送的最近消息数')
+    parser.add_argument('--outbound-max-frames', type=int, default=1024, help='每个连接发送队列的最大帧数')
+    parser.add_argument('--outbound-max-bytes', type=int, default=4 * 1024 * 1024, help='每个连接发送队列的最大字节数')
+    parser.add_argument('--outbound-policy', choices=POLICIES, default=DROP_OLDEST, help='发送队列溢出时的策略')
+    return parser.parse_args()
+
+
+def worker_address(address, index):  # 多进程模式下每个工作进程的管理接口地址
+    scheme, _, rest = address.partition(':')
+    if scheme == 'tcp':
+        host, _, port = rest.rpartition(':')
+        return f'tcp:{host}:{int(port) + index}'
+    return f'{address}.{index}'
+
+
+def run_server(args, worker=None, bus_address=None):  # worker 为总线上的进程名, 为 None 时单独运行
+    logging.getLogger().setLevel(args.log_level)
+    crypto.set_provider(args.crypto_provider)
     with open('server_private_key', 'r') as f:
-        private_key = rsa.PrivateKey.load_pkcs1(f.read())
+        private_key = crypto.load_private_key(f.read())
     with open('server_public_key', 'r') as f:
-        public_key = rsa.PublicKey.load_pkcs1(f.read())
+        public_key = crypto.load_public_key(f.read())
 
     set_server_keys(public_key, private_key)
+    set_crypto_workers(args.crypto_workers)
+    if args.kex:
+        set_handshake_modes(args.kex)
+    set_dh_keypool(*args.dh_keypool)
+    set_compression(not args.no_compression, args.compress_level, args.compress_threshold, args.compress_max_frame)
+    set_user_store(args.db, args.db_workers, args.key_cache_size)
+    set_presence(args.presence_tick, args.presence_history)
+    set_admin(args.admin)
+    set_profile_dir(args.profile_dir)
+    set_offline_store(args.offline_dir or None, max_messages=args.offline_max_messages, max_bytes=args.offline_max_bytes,
+                      max_total_bytes=args.offline_total_bytes, ttl=args.offline_ttl, sync=args.offline_sync)
+    set_history(args.history_file or None, args.history_messages, args.history_bytes, args.history_login)
+    set_outbound_limits(args.outbound_max_frames, args.outbound_max_bytes, args.outbound_policy)
+    if worker is not None:
+        set_bus(bus_address, worker)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(start_server('127.0.0.1', 9999))
+    try:
+        loop.run_until_complete(start_server(args.host, args.port, reuse_port=args.workers > 1))
+    finally:
+        if server.crypto_pool is not None:
+            server.crypto_pool.close()  # 结束握手进程池, 不留下孤儿进程
+        if server.offline is not None:
+            server.offline.close()
+        if server.history is not None:
+            server.history.close()
+
+
+def run_workers(args):  # 主进程只运行总线 (集群模式下使用 broker), 连接由内核在各工作进程之间分配
+    loop = asyncio.get_event_loop()
+    bus_path = None
+    if args.broker:
+        bus_address = args.broker
+    else:
+        bus_path = args.bus_path or os.path.join(tempfile.gettempdir(), f'chat_bus_{args.port}.sock')
+        if os.path.exists(bus_path):
+            os.unlink(bus_path)
+        bus_address = f'unix:{bus_path}'
+        loop.run_until_complete(BusHub().start(bus_address))
+
+    ctx = multiprocessing.get_context('spawn')
+    processes = []
+    for worker in range(args.workers):
+        worker_args = argparse.Namespace(**vars(args))
+        if args.admin:
+            worker_args.admin = worker_address(args.admin, worker)
+        if args.offline_dir:
+            worker_args.offline_dir = os.path.join(args.offline_dir, str(worker))
+        if args.history_file:
+            worker_args.history_file = f'{args.history_file}.{worker}'
+        processes.append(ctx.Process(target=run_server, args=(worker_args, f'{args.node_id}/{worker}', bus_address)))
+    for process in processes:
+        process.start()
+
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    for signum in (signal.SIGUSR1, signal.SIGUSR2):  # 转发给所有工作进程, 各自把分析结果写到以自己 pid 命名的文件
+        loop.add_signal_handler(signum, lambda signum=signum: [os.kill(p.pid, signum) for p in processes if p.is_alive()])
+    try:
+        loop.run_forever()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        if bus_path is not None:
+            os.unlink(bus_path)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    args.node_id = args.node_id or f'{args.host}:{args.port}'
+    if args.workers > 1:
+        run_workers(args)
+    elif args.broker:
+        run_server(args, args.node_id, args.broker)
+    else:
+        run_server(args)
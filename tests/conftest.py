@@ -0,0 +1,7 @@
+# 测试从仓库根目录导入模块; 界面测试不需要显示器
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
@@ -0,0 +1,57 @@
+# 公共消息的广播在处理函数返回之前进入每个连接的发送队列, 之后推送给同一个连接的消息排在它后面
+import asyncio
+from classes import server as server_module
+from classes.broadcast import spawn_broadcast
+from classes.server import Server
+
+
+class DummyWriter:
+    transport = None
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 0)
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_server(username):
+    server = Server(None, DummyWriter(), None, None)  # 没有开始加密, 帧留在发送队列里
+    server.username = username
+    server.handshake = True
+    server.login = True
+    return server
+
+
+def pushed(server):
+    return [server.codec.decode(data)['type'] for data, _ in server.outbound.frames]
+
+
+def test_send_everyone_before_later_pushes(monkeypatch):
+    async def main():
+        sender = make_server('sender')
+        peers = [make_server(f'user{i}') for i in range(600)]  # 超过原来每次让出事件循环的 256 个连接
+        monkeypatch.setattr(server_module, 'global_users', {server.username: server for server in [sender, *peers]})
+        await sender.handle_send_everyone({'message': 'hello'})
+        for peer in peers:
+            await peer.push_data('send_user', {'from': 'sender'})
+        return peers
+
+    peers = asyncio.new_event_loop().run_until_complete(main())
+    assert all(pushed(peer) == ['send_everyone', 'send_user'] for peer in peers)
+
+
+def test_spawn_broadcast_orders_presence():
+    async def main():
+        peers = [make_server(f'user{i}') for i in range(300)]
+        spawn_broadcast(peers, 'presence', {'version': 1, 'online': ['a'], 'offline': []})
+        spawn_broadcast(peers, 'send_everyone', {'from': 'a', 'message': 'hi'})
+        for peer in peers:
+            peer.outbound.offer(peer.codec.encode({'type': 'send_user', 'data': {}}))
+        return peers
+
+    peers = asyncio.new_event_loop().run_until_complete(main())
+    assert all(pushed(peer) == ['presence', 'send_everyone', 'send_user'] for peer in peers)
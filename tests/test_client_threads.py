@@ -0,0 +1,59 @@
+# client_threads.py 的登录流程: 按当前的密码学实现读取服务器公钥和用户私钥文件, 连接、注册并登录
+import asyncio
+import importlib
+import json
+import socket
+import pytest
+from PyQt5 import QtWidgets
+from bench.common import load_bench_keys, spawn_server, stop_server
+from utils import crypto
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def provider(request):
+    previous = crypto.get_provider().name
+    crypto.set_provider(request.param)
+    yield request.param
+    crypto.set_provider(previous)
+
+
+@pytest.mark.parametrize('provider', ['cryptography', 'python'], indirect=True)
+def test_login(provider, tmp_path, monkeypatch):
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    keys = load_bench_keys()
+    (tmp_path / 'server_public_key').write_text(crypto.save_public_key(keys['server_public']))
+    monkeypatch.chdir(tmp_path)  # 客户端从当前目录读取 server_public_key, 登录成功后在这里保存设置
+    client_threads = importlib.import_module('client_threads')
+
+    public_key, private_key = crypto.newkeys(1024)
+    key_path = tmp_path / 'user.json'
+    key_path.write_text(json.dumps({'public_key': crypto.save_public_key(public_key),
+                                    'private_key': crypto.save_private_key(private_key)}))
+    warnings = []
+    started = []
+    monkeypatch.setattr(client_threads, 'server_public_key', keys['server_public'])
+    monkeypatch.setattr(QtWidgets.QMessageBox, 'warning', lambda *args: warnings.append(args[2]))
+    monkeypatch.setattr(client_threads.Runner, 'start', lambda self: started.append(self))
+
+    port = free_port()
+    server = spawn_server(port, provider)
+    try:
+        login = client_threads.Login()
+        login.text_server_addr.setText('127.0.0.1')
+        login.text_server_port.setText(str(port))
+        login.text_username.setText(f'threads_{provider}')
+        login.private_key_path = str(key_path)
+        login.login()
+        assert warnings == []
+        assert len(started) == 1
+        assert client_threads.client.username == f'threads_{provider}'
+        client_threads.loop.run_until_complete(client_threads.client.close())
+    finally:
+        stop_server(server)
+    app.processEvents()
@@ -0,0 +1,103 @@
+# 离线消息队列: 写入失败 (磁盘满, 只写入了一部分) 之后, 之前和之后保存的消息都能正确读出, 重新打开后也一样
+import asyncio
+import errno
+import os
+import pytest
+from utils.offline_store import OfflineStore
+
+
+class FailingWrite():  # 替换 os.write: 下一次写入只写一半然后抛出 ENOSPC
+    def __init__(self, monkeypatch):
+        self.armed = False
+        self.write = os.write
+        monkeypatch.setattr(os, 'write', self)
+
+    def __call__(self, fd, data):
+        if self.armed:
+            self.armed = False
+            self.write(fd, bytes(data[:len(data) // 2]))
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        return self.write(fd, data)
+
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+def messages(fetched):
+    return [data['text'] for _, _, data in fetched]
+
+
+async def put(store, text):
+    return await store.put('bobby', 'send_user', {'text': text})
+
+
+def test_put_after_failed_write(tmp_path, monkeypatch):
+    failing = FailingWrite(monkeypatch)
+
+    async def main():
+        store = OfflineStore(str(tmp_path))
+        store.open()
+        assert await put(store, 'before')
+        failing.armed = True
+        with pytest.raises(OSError):
+            await put(store, 'failed')
+        for i in range(3):
+            assert await put(store, f'after {i}')
+        fetched = messages(await store.fetch('bobby'))
+        store.close()
+        return fetched
+
+    assert run(main()) == ['before', 'after 0', 'after 1', 'after 2']
+
+    async def reopen():
+        store = OfflineStore(str(tmp_path))
+        store.open()
+        fetched = messages(await store.fetch('bobby'))
+        store.close()
+        return fetched
+
+    assert run(reopen()) == ['before', 'after 0', 'after 1', 'after 2']
+
+
+def test_queued_puts_fail_with_batch(tmp_path, monkeypatch):
+    failing = FailingWrite(monkeypatch)
+
+    async def main():
+        store = OfflineStore(str(tmp_path))
+        store.open()
+        failing.armed = True
+        results = await asyncio.gather(*[put(store, f'queued {i}') for i in range(100)], return_exceptions=True)
+        stored = [f'queued {i}' for i, result in enumerate(results) if result is True]
+        assert any(isinstance(result, OSError) for result in results)
+        assert await put(store, 'after')
+        assert store.count('bobby') == len(stored) + 1
+        fetched = messages(await store.fetch('bobby'))
+        store.close()
+        return stored, fetched
+
+    stored, fetched = run(main())
+    assert fetched == stored + ['after']
+
+
+def test_relocate_after_failed_write(tmp_path, monkeypatch):
+    failing = FailingWrite(monkeypatch)
+
+    async def main():
+        store = OfflineStore(str(tmp_path), segment_size=1024)
+        store.open()
+        for i in range(40):
+            assert await put(store, f'message {i:02d}')
+        seqs = [seq for seq, _, _ in await store.fetch('bobby', 40)]
+        store.ack('bobby', seqs[29])  # 最旧的段里只剩少量待投递的消息, 压缩时复制到当前段
+        await store.flush()
+        failing.armed = True
+        with pytest.raises(OSError):
+            await store.compact()
+        assert messages(await store.fetch('bobby')) == [f'message {i:02d}' for i in range(30, 40)]
+        await store.compact()
+        fetched = messages(await store.fetch('bobby'))
+        store.close()
+        return fetched
+
+    assert run(main()) == [f'message {i:02d}' for i in range(30, 40)]
@@ -25,22 +25,31 @@ class Ui_MainWindow(object):
         self.btn_send = QtWidgets.QPushButton(self.centralwidget)
         self.btn_send.setGeometry(QtCore.QRect(640, 540, 91, 40))
         self.btn_send.setObjectName("btn_send")
-        self.list_history = QtWidgets.QListWidget(self.centralwidget)
+        self.list_history = QtWidgets.QTableView(self.centralwidget)
         self.list_history.setGeometry(QtCore.QRect(160, 0, 570, 451))
         self.list_history.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAsNeeded)
         self.list_history.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
         self.list_history.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        self.list_history.setShowGrid(False)
+        self.list_history.setWordWrap(False)
         self.list_history.setObjectName("list_history")
+        self.list_history.horizontalHeader().setVisible(False)
+        self.list_history.horizontalHeader().setStretchLastSection(True)
+        self.list_history.verticalHeader().setVisible(False)
+        self.list_history.verticalHeader().setDefaultSectionSize(20)
         self.lab_user = QtWidgets.QLabel(self.centralwidget)
         self.lab_user.setGeometry(QtCore.QRect(170, 550, 71, 21))
         self.lab_user.setObjectName("lab_user")
         self.lab_username = QtWidgets.QLabel(self.centralwidget)
-        self.lab_username.setGeometry(QtCore.QRect(250, 550, 260, 21))
+        self.lab_username.setGeometry(QtCore.QRect(250, 550, 180, 21))
         self.lab_username.setText("")
         self.lab_username.setObjectName("lab_username")
         self.btn_look_key = QtWidgets.QPushButton(self.centralwidget)
         self.btn_look_key.setGeometry(QtCore.QRect(530, 540, 110, 40))
         self.btn_look_key.setObjectName("btn_look_key")
+        self.btn_search = QtWidgets.QPushButton(self.centralwidget)
+        self.btn_search.setGeometry(QtCore.QRect(440, 540, 90, 40))
+        self.btn_search.setObjectName("btn_search")
         MainWindow.setCentralWidget(self.centralwidget)
 
         self.retranslateUi(MainWindow)
@@ -52,5 +61,6 @@ class Ui_MainWindow(object):
         self.btn_send.setText(_translate("MainWindow", "发送"))
         self.lab_user.setText(_translate("MainWindow", "用户名:"))
         self.btn_look_key.setText(_translate("MainWindow", "查看共有秘钥"))
+        self.btn_search.setText(_translate("MainWindow", "搜索记录"))
 
 
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# Form implementation generated from reading ui file 'Search.ui'
+#
+# Created by: PyQt5 UI code generator 5.15.11
+#
+# WARNING: Any manual changes made to this file will be lost when pyuic5 is
+# run again.  Do not edit this file unless you know what you are doing.
+
+
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+
+class Ui_Search(object):
+    def setupUi(self, Search):
+        Search.setObjectName("Search")
+        Search.resize(600, 450)
+        self.text_query = QtWidgets.QLineEdit(Search)
+        self.text_query.setGeometry(QtCore.QRect(10, 10, 330, 30))
+        self.text_query.setObjectName("text_query")
+        self.combo_conversation = QtWidgets.QComboBox(Search)
+        self.combo_conversation.setGeometry(QtCore.QRect(350, 10, 150, 30))
+        self.combo_conversation.setObjectName("combo_conversation")
+        self.btn_search = QtWidgets.QPushButton(Search)
+        self.btn_search.setGeometry(QtCore.QRect(510, 5, 80, 40))
+        self.btn_search.setObjectName("btn_search")
+        self.list_results = QtWidgets.QListView(Search)
+        self.list_results.setGeometry(QtCore.QRect(10, 50, 580, 390))
+        self.list_results.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.list_results.setObjectName("list_results")
+
+        self.retranslateUi(Search)
+        QtCore.QMetaObject.connectSlotsByName(Search)
+
+    def retranslateUi(self, Search):
+        _translate = QtCore.QCoreApplication.translate
+        Search.setWindowTitle(_translate("Search", "搜索聊天记录"))
+        self.text_query.setPlaceholderText(_translate("Search", "关键词, 多个关键词用空格分开"))
+        self.btn_search.setText(_translate("Search", "搜索"))
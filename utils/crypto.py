@@ -0,0 +1,269 @@
+import os
+import warnings
+import rsa
+from utils.tools import DH
+
+# 非对称密码运算的统一入口, 服务器和客户端都通过这里调用:
+#   python       纯 Python 的 rsa 模块 + pow() 实现的 DH
+#   cryptography 基于 OpenSSL 的实现
+# 两者使用相同的线路格式 (PKCS#1 v1.5 加密, PKCS#1 v1.5 + SHA-512 签名, PKCS#1 PEM 密钥, RFC 3526 1536 位 DH 群),
+# 可以互相通信
+
+# 握手的密钥交换方式, 按优先顺序排列
+KEX_X25519 = 'x25519'  # X25519 + 服务器 RSA-PSS 签名, 会话密钥和计数器由 HKDF 导出
+KEX_DH = 'dh'  # 原有方式: RSA 加密的有限域 DH 公钥和计数器
+X25519_LABEL = b'encrypted-chat-room x25519 v2'  # 服务器签名的内容为 标签 + 客户端公钥 + 服务器公钥
+
+
+class PurePythonProvider(DH):
+    name = 'python'
+    native = False
+    kex = (KEX_DH,)
+
+    def load_public_key(self, data):
+        return rsa.PublicKey.load_pkcs1(data)
+
+    def load_private_key(self, data):
+        return rsa.PrivateKey.load_pkcs1(data)
+
+    def save_public_key(self, key):
+        return key.save_pkcs1().decode()
+
+    def save_private_key(self, key):
+        return key.save_pkcs1().decode()
+
+    def newkeys(self, bits):
+        return rsa.newkeys(bits)
+
+    def sign(self, message, private_key):
+        return rsa.sign(message, private_key, 'SHA-512')
+
+    def verify(self, message, sign, public_key):
+        try:
+            return rsa.verify(message, sign, public_key) == 'SHA-512'
+        except rsa.VerificationError:
+            return False
+
+    def encrypt(self, message, public_key):
+        return rsa.encrypt(message, public_key)
+
+    def decrypt(self, ciphertext, private_key):
+        return rsa.decrypt(ciphertext, private_key)
+
+
+class CryptographyProvider(PurePythonProvider):
+    name = 'cryptography'
+    native = True
+    kex = (KEX_X25519, KEX_DH)
+
+    def __init__(self):
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import padding, rsa as rsa_keys, x25519
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+        self._invalid_signature = InvalidSignature
+        self._serialization = serialization
+        self._rsa = rsa_keys
+        self._padding = padding.PKCS1v15()
+        self._hash = hashes.SHA512()
+        self._pss = padding.PSS(padding.MGF1(hashes.SHA256()), padding.PSS.DIGEST_LENGTH)
+        self._pss_hash = hashes.SHA256()
+        self._x25519 = x25519
+        self._hkdf = HKDF
+
+        try:
+            from cryptography.hazmat.primitives.asymmetric import dh
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                self._dh_numbers = dh.DHParameterNumbers(self.DH_PRIME, self.DH_GENERATOR)
+                self._dh_parameters = self._dh_numbers.parameters()
+            self._dh = dh
+        except Exception:
+            self._dh = None  # 新版本 cryptography 移除了有限域 DH 时退回 pow()
+
+    def load_public_key(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        return self._serialization.load_pem_public_key(data)
+
+    def load_private_key(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        return self._serialization.load_pem_private_key(data, None)
+
+    def save_public_key(self, key):
+        return key.public_bytes(self._serialization.Encoding.PEM, self._serialization.PublicFormat.PKCS1).decode()
+
+    def save_private_key(self, key):
+        return key.private_bytes(self._serialization.Encoding.PEM,
+                                 self._serialization.PrivateFormat.TraditionalOpenSSL,
+                                 self._serialization.NoEncryption()).decode()
+
+    def newkeys(self, bits):
+        private_key = self._rsa.generate_private_key(65537, bits)
+        return private_key.public_key(), private_key
+
+    def sign(self, message, private_key):
+        return private_key.sign(message, self._padding, self._hash)
+
+    def verify(self, message, sign, public_key):
+        try:
+            public_key.verify(sign, message, self._padding, self._hash)
+        except self._invalid_signature:
+            return False
+        return True
+
+    def encrypt(self, message, public_key):
+        return public_key.encrypt(message, self._padding)
+
+    def decrypt(self, ciphertext, private_key):
+        return private_key.decrypt(ciphertext, self._padding)
+
+    def dh_gen_private(self):
+        if self._dh is None:
+            return super().dh_gen_private()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return self._dh_parameters.generate_private_key()
+
+    def dh_get_public(self, private):
+        if self._dh is None:
+            return super().dh_get_public(private)
+        return private.public_key().public_numbers().y
+
+    def dh_get_common_key(self, private, other_public):
+        if self._dh is None:
+            return super().dh_get_common_key(private, other_public)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            other_public = self._dh.DHPublicNumbers(other_public, self._dh_numbers).public_key()
+            key = private.exchange(other_public)
+        return int.from_bytes(key, 'big').to_bytes(256, 'big')  # 与 pow() 实现保持相同的长度
+
+    def dh_get_common_key_raw(self, private, public, other_public):
+        if self._dh is None:
+            return super().dh_get_common_key_raw(private, public, other_public)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            public = self._dh.DHPublicNumbers(public, self._dh_numbers)
+            private = self._dh.DHPrivateNumbers(private, public).private_key()
+        return self.dh_get_common_key(private, other_public)
+
+    def sign_pss(self, message, private_key):
+        return private_key.sign(message, self._pss, self._pss_hash)
+
+    def verify_pss(self, message, sign, public_key):
+        try:
+            public_key.verify(sign, message, self._pss, self._pss_hash)
+        except self._invalid_signature:
+            return False
+        return True
+
+    def x25519_gen_private(self):
+        return self._x25519.X25519PrivateKey.generate()
+
+    def x25519_get_public(self, private):
+        return private.public_key().public_bytes_raw()
+
+    def x25519_derive(self, private, client_public, server_public, other_public):
+        # 返回 (aes_gcm_key, client_count, server_count), 两端的公钥作为 salt 绑定到这次握手
+        shared = private.exchange(self._x25519.X25519PublicKey.from_public_bytes(other_public))
+        okm = self._hkdf(self._pss_hash, 48, client_public + server_public, X25519_LABEL).derive(shared)
+        return okm[:32], int.from_bytes(okm[32:40], 'big'), int.from_bytes(okm[40:], 'big')
+
+
+PROVIDERS = {
+    PurePythonProvider.name: PurePythonProvider,
+    CryptographyProvider.name: CryptographyProvider
+}
+DEFAULT_PROVIDER = os.environ.get('CHAT_CRYPTO_PROVIDER', CryptographyProvider.name)
+
+_provider: PurePythonProvider = None
+
+
+def set_provider(name):
+    global _provider
+
+    if name not in PROVIDERS:
+        raise ValueError(f'未知的密码学实现: {name}')
+    _provider = PROVIDERS[name]()
+    return _provider
+
+
+def get_provider():
+    if _provider is None:
+        set_provider(DEFAULT_PROVIDER)
+    return _provider
+
+
+def load_public_key(data):
+    return get_provider().load_public_key(data)
+
+
+def load_private_key(data):
+    return get_provider().load_private_key(data)
+
+
+def save_public_key(key):
+    return get_provider().save_public_key(key)
+
+
+def save_private_key(key):
+    return get_provider().save_private_key(key)
+
+
+def newkeys(bits):
+    return get_provider().newkeys(bits)
+
+
+def sign(message, private_key):
+    return get_provider().sign(message, private_key)
+
+
+def verify(message, sign, public_key):
+    return get_provider().verify(message, sign, public_key)
+
+
+def encrypt(message, public_key):
+    return get_provider().encrypt(message, public_key)
+
+
+def decrypt(ciphertext, private_key):
+    return get_provider().decrypt(ciphertext, private_key)
+
+
+def dh_gen_private():
+    return get_provider().dh_gen_private()
+
+
+def dh_get_public(private):
+    return get_provider().dh_get_public(private)
+
+
+def dh_get_common_key(private, other_public):
+    return get_provider().dh_get_common_key(private, other_public)
+
+
+def dh_get_common_key_raw(private, public, other_public):
+    return get_provider().dh_get_common_key_raw(private, public, other_public)
+
+
+def sign_pss(message, private_key):
+    return get_provider().sign_pss(message, private_key)
+
+
+def verify_pss(message, sign, public_key):
+    return get_provider().verify_pss(message, sign, public_key)
+
+
+def x25519_gen_private():
+    return get_provider().x25519_gen_private()
+
+
+def x25519_get_public(private):
+    return get_provider().x25519_get_public(private)
+
+
+def x25519_derive(private, client_public, server_public, other_public):
+    return get_provider().x25519_derive(private, client_public, server_public, other_public)
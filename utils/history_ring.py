@@ -0,0 +1,204 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from utils import metrics
+
+# 公共聊天的最近消息, 保存在固定大小的内存映射文件里, 重启后仍然存在, 登录时整段发给客户端
+#   文件为 文件头 + max_messages 个 4 字节的索引槽 + max_bytes 字节的环形数据区
+#   记录为 长度 (4, 包括记录头) + seq (8) + 时间戳 (8, double) + 发送者长度 (2) + 发送者 + 消息 (UTF-8), 连续存放,
+#   数据区末尾放不下时从 0 重新开始 (wrap), 覆盖最旧的记录; seq 为 s 的记录的偏移保存在索引槽 s % max_messages
+#   有效的记录为 first <= seq < next, 最多跨过一次 wrap: wrap_seq 为 wrap 后写在 0 处的记录, wrap_end 为 wrap 前写到的位置
+# 发送给客户端时不解析记录, 直接复制数据区里连续的一段 (wrap 时两段) 作为一个 bytes 字段, 由客户端用 iter_records 解析
+# 追加时先写入淘汰之后的文件头, 再写记录, 最后写入新的 next; 进程在中途崩溃时只会丢掉正在写的那条记录
+# 修改的页由操作系统写回, 关闭时 msync; 机器掉电时可能丢失最近的消息, 文件头校验失败时清空重新开始
+
+MAGIC = b'CHR1'
+_file_header = struct.Struct('>4sIIQQIQII')  # magic, max_messages, max_bytes, first, next, write, wrap_seq, wrap_end, CRC32
+_slot = struct.Struct('>I')
+_record = struct.Struct('>IQdH')  # 长度, seq, 时间戳, 发送者长度
+
+logger = logging.getLogger(__name__)
+
+APPENDED = metrics.counter('chat_history_appended_total', '写入公共聊天历史的消息数')
+EVICTED = metrics.counter('chat_history_evicted_total', '因为超出条数或字节数被覆盖的历史消息数')
+PAGES = metrics.counter('chat_history_pages_total', '发送给客户端的历史消息页数')
+PAGE_BYTES = metrics.counter('chat_history_page_bytes_total', '发送给客户端的历史消息字节数')
+
+
+def encode_record(seq, timestamp, sender, message):
+    sender = sender.encode()
+    message = message.encode()
+    return _record.pack(_record.size + len(sender) + len(message), seq, timestamp, len(sender)) + sender + message
+
+
+def iter_records(data):  # 客户端解析一页历史消息, 依次返回 (seq, 时间戳, 发送者, 消息)
+    data = memoryview(data)
+    pos = 0
+    while pos + _record.size <= len(data):
+        length, seq, timestamp, sender_length = _record.unpack_from(data, pos)
+        if length < _record.size + sender_length or pos + length > len(data):
+            raise ValueError('历史消息格式错误')
+        start = pos + _record.size
+        yield seq, timestamp, str(data[start:start + sender_length], 'utf-8'), \
+            str(data[start + sender_length:pos + length], 'utf-8')
+        pos += length
+
+
+class HistoryRing():
+    def __init__(self, path, max_messages=1000, max_bytes=4 * 1024 * 1024):
+        self.path = path
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.data_start = _file_header.size + max_messages * _slot.size
+        self.first = 0  # 最旧的有效记录
+        self.next = 0  # 下一条记录的 seq
+        self.write = 0  # 下一条记录在数据区的偏移
+        self.wrap_seq = 0
+        self.wrap_end = 0
+        self.file = None
+        self.map = None
+
+    @property
+    def messages(self):
+        return self.next - self.first
+
+    @property
+    def bytes(self):
+        return self.range_bytes(self.first, self.next - 1) if self.messages else 0
+
+    def open(self):
+        size = self.data_start + self.max_bytes
+        self.file = open(self.path, 'a+b')
+        try:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.file.close()
+            raise RuntimeError(f'{self.path} 正在被其他进程使用')
+        existing = os.fstat(self.file.fileno()).st_size
+        if existing != size:
+            if existing:
+                logger.warning(f'公共聊天历史 {self.path} 的大小与配置不同, 清空重新开始')
+            self.file.truncate(0)
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        if not self._load_header():
+            if existing:
+                logger.warning(f'公共聊天历史 {self.path} 的文件头无效, 清空重新开始')
+            self.first = self.next = self.write = self.wrap_seq = self.wrap_end = 0
+            self._store_header()
+        logger.info(f'公共聊天历史: {self.messages} 条消息, {self.bytes} 字节')
+
+    def _load_header(self):
+        magic, max_messages, max_bytes, first, next_seq, write, wrap_seq, wrap_end, crc = \
+            _file_header.unpack_from(self.map, 0)
+        if magic != MAGIC or crc != zlib.crc32(self.map[:_file_header.size - 4]):
+            return False
+        if (max_messages, max_bytes) != (self.max_messages, self.max_bytes) or not first <= next_seq \
+                or next_seq - first > max_messages or write > max_bytes or wrap_end > max_bytes:
+            return False
+        self.first, self.next, self.write, self.wrap_seq, self.wrap_end = first, next_seq, write, wrap_seq, wrap_end
+        return True
+
+    def _store_header(self):
+        _file_header.pack_into(self.map, 0, MAGIC, self.max_messages, self.max_bytes, self.first, self.next,
+                               self.write, self.wrap_seq, self.wrap_end, 0)
+        _slot.pack_into(self.map, _file_header.size - 4, zlib.crc32(self.map[:_file_header.size - 4]))
+
+    def _offset(self, seq):  # 记录在数据区的偏移
+        return _slot.unpack_from(self.map, _file_header.size + seq % self.max_messages * _slot.size)[0]
+
+    def _length(self, offset):
+        return _slot.unpack_from(self.map, self.data_start + offset)[0]
+
+    def append(self, sender, message, timestamp=None):  # 返回 seq, 单条消息超过整个数据区时不保存并返回 None
+        record = encode_record(self.next, time.time() if timestamp is None else timestamp, sender, message)
+        if len(record) > self.max_bytes:
+            return None
+        evicted = self.first
+        if self.messages >= self.max_messages:
+            self.first = self.next - self.max_messages + 1
+        write = self.write
+        if write + len(record) > self.max_bytes:  # 从数据区开头重新写, 上一圈里剩下的记录都在 write 之后, 全部淘汰
+            self.first = max(self.first, self.wrap_seq)
+            self.wrap_seq = self.next
+            self.wrap_end = write
+            write = 0
+        while self.first < self.wrap_seq and self._offset(self.first) < write + len(record):
+            self.first += 1  # 上一圈里被新记录覆盖的记录
+        if self.first == self.next:
+            self.wrap_seq = self.next  # 没有有效记录, 不需要 wrap 的信息
+        EVICTED.inc(self.first - evicted)
+        self.write = write
+        self._store_header()  # 先让被覆盖的记录失效
+
+        self.map[self.data_start + write:self.data_start + write + len(record)] = record
+        _slot.pack_into(self.map, _file_header.size + self.next % self.max_messages * _slot.size, write)
+        seq = self.next
+        self.next += 1
+        self.write = write + len(record)
+        self._store_header()
+        APPENDED.inc()
+        return seq
+
+    def range_bytes(self, first, last):  # first..last 的记录在数据区占用的字节数
+        end = self._offset(last)
+        end += self._length(end)
+        start = self._offset(first)
+        if first < self.wrap_seq <= last:
+            return self.wrap_end - start + end
+        return end - start
+
+    def read_range(self, first, last):  # first..last 的原始记录, 最多两次切片
+        end = self._offset(last)
+        end += self._length(end)
+        start = self._offset(first)
+        base = self.data_start
+        if first < self.wrap_seq <= last:
+            return self.map[base + start:base + self.wrap_end] + self.map[base:base + end]
+        return self.map[base + start:base + end]
+
+    def page(self, before=None, limit=200, max_bytes=256 * 1024):
+        # seq 小于 before 的最新 limit 条消息 (before 为 None 时为最新的消息), 总字节数不超过 max_bytes;
+        # 返回 (第一条的 seq, 原始记录, 是否还有更早的消息)
+        last = self.next - 1 if before is None else min(before, self.next) - 1
+        if last < self.first or limit <= 0:
+            return last + 1, b'', False
+        low = max(self.first, last - limit + 1)
+        high = last
+        while low < high:  # 二分查找满足字节数限制的最早一条, 至少返回一条
+            middle = (low + high) // 2
+            if self.range_bytes(middle, last) > max_bytes:
+                low = middle + 1
+            else:
+                high = middle
+        data = self.read_range(low, last)
+        PAGES.inc()
+        PAGE_BYTES.inc(len(data))
+        return low, data, low > self.first
+
+    def stats(self):
+        return {
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'first': self.first,
+            'next': self.next,
+            'max_messages': self.max_messages,
+            'max_bytes': self.max_bytes
+        }
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# 客户端本地的聊天记录, 保存在 SQLite 里, 静态加密:
+#   密钥由用户私钥文件里的私钥经 HKDF 导出 (盐随机生成, 保存在 meta 表), 依次为 AES-GCM, HMAC 和搜索词的密钥各 32 字节
+#   每条消息 {from, message, me, time} 序列化后单独加密, nonce 随机; 会话名 (对方用户名) 只保存 HMAC,
+#   同时作为 AES-GCM 的附加数据, 记录不能被挪到其他会话; conversation 表里另外保存加密的会话名, 用于搜索时按会话筛选
+#   id 自增, 同一会话内按 id 排序即为收发顺序; 界面只加载最近一页, 向上滚动时按 id 往前翻页
+# 用错私钥打开时校验 meta 表里的 check 失败, 抛出 ValueError
+#
+# 全文搜索: 写入消息时在同一个事务里更新 FTS5 倒排索引 (contentless, 不保存原文), 索引里的词是明文词的带密钥哈希,
+#   数据库里不出现明文; 英文和数字按整词, 中日韩文字按单字和相邻两字 (查询时用两字, 只有一个字时用单字),
+#   再加上表示会话的词; 查询时所有词都要出现, 从新到旧取候选消息, 解密后确认每个关键词都是原文的子串
+#
+# 私聊密钥缓存: 与对方协商好的密钥加密后保存在 session_key 表, 带过期时间, 重新登录后不必再次 DH
+
+KEY_INFO = b'encrypted chat room local history'
+CHECK = b'local history key check'
+INDEX_VERSION = b'1'
+
+_cjk = '぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+_token = re.compile(f'[{_cjk}]+|[^\\W{_cjk}]+')
+_cjk_run = re.compile(f'[{_cjk}]')
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB);
+CREATE TABLE IF NOT EXISTS message (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    peer BLOB NOT NULL,
+    nonce BLOB NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS message_peer ON message (peer, id);
+CREATE TABLE IF NOT EXISTS conversation (id INTEGER PRIMARY KEY, peer BLOB UNIQUE NOT NULL, nonce BLOB, name BLOB);
+CREATE TABLE IF NOT EXISTS session_key (peer BLOB PRIMARY KEY, nonce BLOB NOT NULL, data BLOB NOT NULL, expires REAL);
+CREATE VIRTUAL TABLE IF NOT EXISTS message_index USING fts5(terms, content='', detail=none);
+'''
+
+
+def derive_keys(key_material, salt):  # -> (AES-GCM 密钥, HMAC 密钥, 搜索词密钥)
+    okm = HKDF(hashes.SHA256(), 96, salt, KEY_INFO).derive(key_material)
+    return okm[:32], okm[32:64], okm[64:]
+
+
+def index_terms(text):  # 消息里用于建立索引的明文词
+    terms = set()
+    for run in _token.findall(text.casefold()):
+        if _cjk_run.match(run):
+            terms.update(run)
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.add(run)
+    return terms
+
+
+def query_terms(text):  # 查询里的明文词, 必须全部出现
+    terms = set()
+    for run in _token.findall(text.casefold()):
+        if _cjk_run.match(run) and len(run) > 1:
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.add(run)
+    return terms
+
+
+class MessageStore():
+    def __init__(self, path, key_material):
+        self.path = path
+        self.key_material = key_material.encode() if isinstance(key_material, str) else key_material
+        self.db = None
+        self.aead = None
+        self.mac_key = None
+        self.term_key = None
+        self._peers = dict()  # 会话名 -> HMAC, 会话数量很少, 不设上限
+        self._names = dict()  # HMAC -> 会话名
+        self._conversations = dict()  # 会话名 -> conversation 表的 id
+
+    def open(self):
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # 断电时可能丢失最近的消息, 但不会损坏
+        self.db.executescript(_schema)
+        salt = self._meta('salt')
+        if salt is None:
+            salt = os.urandom(16)
+            enc_key, self.mac_key, self.term_key = derive_keys(self.key_material, salt)
+            self.aead = AESGCM(enc_key)
+            nonce = os.urandom(12)
+            with self.db:
+                self.db.execute('INSERT INTO meta VALUES (?, ?)', ('salt', salt))
+                self.db.execute('INSERT INTO meta VALUES (?, ?)', ('check', nonce + self.aead.encrypt(nonce, CHECK, b'')))
+                self.db.execute('INSERT INTO meta VALUES (?, ?)', ('index', INDEX_VERSION))
+        else:
+            enc_key, self.mac_key, self.term_key = derive_keys(self.key_material, salt)
+            self.aead = AESGCM(enc_key)
+            check = self._meta('check')
+            try:
+                self.aead.decrypt(check[:12], check[12:], b'')
+            except InvalidTag:
+                self.db.close()
+                self.db = None
+                raise ValueError('私钥与本地聊天记录不匹配')
+        self.key_material = None
+        for conversation_id, peer, nonce, name in self.db.execute('SELECT id, peer, nonce, name FROM conversation'):
+            name = self.aead.decrypt(nonce, name, peer).decode()
+            self._peers[name] = peer
+            self._names[peer] = name
+            self._conversations[name] = conversation_id
+        if self._meta('index') != INDEX_VERSION:
+            self.reindex()
+
+    def _meta(self, name):
+        row = self.db.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _peer(self, conversation):
+        peer = self._peers.get(conversation)
+        if peer is None:
+            h = hmac.HMAC(self.mac_key, hashes.SHA256())
+            h.update(conversation.encode())
+            peer = self._peers[conversation] = h.finalize()[:16]
+            self._names[peer] = conversation
+        return peer
+
+    def _conversation_id(self, conversation):  # 第一次写入某个会话时保存加密的会话名
+        conversation_id = self._conversations.get(conversation)
+        if conversation_id is None:
+            peer = self._peer(conversation)
+            nonce = os.urandom(12)
+            self.db.execute('INSERT OR IGNORE INTO conversation (peer, nonce, name) VALUES (?, ?, ?)',
+                            (peer, nonce, self.aead.encrypt(nonce, conversation.encode(), peer)))
+            conversation_id = self.db.execute('SELECT id FROM conversation WHERE peer = ?', (peer,)).fetchone()[0]
+            self._conversations[conversation] = conversation_id
+        return conversation_id
+
+    def _hash_term(self, term):
+        return hashlib.blake2b(term.encode(), digest_size=8, key=self.term_key).hexdigest()
+
+    def _index_row(self, conversation, text):
+        return ' '.join([f'c{self._conversation_id(conversation)}'] +
+                        [self._hash_term(term) for term in index_terms(text)])
+
+    def append(self, conversation, message):  # 返回消息的 id
+        return self.append_many([(conversation, message)])[0]
+
+    def append_many(self, items):  # [(会话名, 消息)] 在一个事务里写入, 返回 id 列表
+        ids = []
+        with self.db:
+            for conversation, message in items:
+                peer = self._peer(conversation)
+                nonce = os.urandom(12)
+                data = self.aead.encrypt(nonce, json.dumps(message).encode(), peer)
+                message_id = self.db.execute('INSERT INTO message (peer, nonce, data) VALUES (?, ?, ?)',
+                                             (peer, nonce, data)).lastrowid
+                self.db.execute('INSERT INTO message_index (rowid, terms) VALUES (?, ?)',
+                                (message_id, self._index_row(conversation, message['message'])))
+                ids.append(message_id)
+        return ids
+
+    def _decrypt(self, message_id, peer, nonce, data):
+        message = json.loads(self.aead.decrypt(nonce, data, peer))
+        message['id'] = message_id
+        return message
+
+    def page(self, conversation, before=None, limit=100):
+        # id 小于 before 的最近 limit 条消息 (before 为 None 时为最新的), 按时间顺序排列, 每条带上 id
+        peer = self._peer(conversation)
+        if before is None:
+            rows = self.db.execute('SELECT id, nonce, data FROM message WHERE peer = ? ORDER BY id DESC LIMIT ?',
+                                   (peer, limit)).fetchall()
+        else:
+            rows = self.db.execute('SELECT id, nonce, data FROM message WHERE peer = ? AND id < ? '
+                                   'ORDER BY id DESC LIMIT ?', (peer, before, limit)).fetchall()
+        return [self._decrypt(message_id, peer, nonce, data) for message_id, nonce, data in reversed(rows)]
+
+    def search(self, text, conversation=None, limit=50):
+        # 包含 text 里所有关键词的消息, 从新到旧, 每条带上 id 和 conversation; conversation 不为 None 时只搜索这个会话
+        keywords = _token.findall(text.casefold())  # 和索引同样分词, 标点不参与子串确认
+        terms = query_terms(text)
+        if not terms:
+            return []
+        match = [self._hash_term(term) for term in terms]
+        if conversation is not None:
+            conversation_id = self._conversations.get(conversation)
+            if conversation_id is None:
+                return []
+            match.append(f'c{conversation_id}')
+        match = ' AND '.join(f'"{term}"' for term in match)
+        results = []
+        before = None
+        batch = limit * 2
+        while len(results) < limit:
+            if before is None:
+                rows = self.db.execute('SELECT rowid FROM message_index WHERE message_index MATCH ? '
+                                       'ORDER BY rowid DESC LIMIT ?', (match, batch)).fetchall()
+            else:
+                rows = self.db.execute('SELECT rowid FROM message_index WHERE message_index MATCH ? AND rowid < ? '
+                                       'ORDER BY rowid DESC LIMIT ?', (match, before, batch)).fetchall()
+            if not rows:
+                break
+            ids = [row[0] for row in rows]
+            before = ids[-1]
+            placeholders = ','.join('?' * len(ids))
+            for message_id, peer, nonce, data in self.db.execute(
+                    f'SELECT id, peer, nonce, data FROM message WHERE id IN ({placeholders}) ORDER BY id DESC', ids):
+                message = self._decrypt(message_id, peer, nonce, data)
+                content = message['message'].casefold()
+                if all(keyword in content for keyword in keywords):  # 去掉两字组合碰巧都出现的候选
+                    message['conversation'] = self._names.get(peer)
+                    results.append(message)
+                    if len(results) == limit:
+                        break
+            batch = min(batch * 2, 4096)
+        return results
+
+    def conversations(self):  # 写入过消息的会话名
+        return list(self._conversations)
+
+    def reindex(self):  # 重建全文索引, 用于没有索引的旧版本记录
+        with self.db:
+            self.db.execute("INSERT INTO message_index (message_index) VALUES ('delete-all')")
+            for message_id, peer, nonce, data in self.db.execute('SELECT id, peer, nonce, data FROM message').fetchall():
+                message = self._decrypt(message_id, peer, nonce, data)
+                conversation = self._names.get(peer)
+                terms = [self._hash_term(term) for term in index_terms(message['message'])]
+                if conversation is not None:  # 旧版本没有保存会话名, 这些消息只能在全部会话里搜索到
+                    terms.append(f'c{self._conversation_id(conversation)}')
+                self.db.execute('INSERT INTO message_index (rowid, terms) VALUES (?, ?)', (message_id, ' '.join(terms)))
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('index', INDEX_VERSION))
+
+    def save_session_key(self, conversation, key, expires):
+        peer = self._peer(conversation)
+        nonce = os.urandom(12)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO session_key VALUES (?, ?, ?, ?)',
+                            (peer, nonce, self.aead.encrypt(nonce, key, b'session key' + peer), expires))
+
+    def load_session_key(self, conversation):  # -> (密钥, 过期时间), 没有或者已经过期时返回 None
+        peer = self._peer(conversation)
+        row = self.db.execute('SELECT nonce, data, expires FROM session_key WHERE peer = ?', (peer,)).fetchone()
+        if row is None:
+            return None
+        nonce, data, expires = row
+        if expires <= time.time():
+            self.delete_session_key(conversation)
+            return None
+        return self.aead.decrypt(nonce, data, b'session key' + peer), expires
+
+    def delete_session_key(self, conversation):
+        with self.db:
+            self.db.execute('DELETE FROM session_key WHERE peer = ?', (self._peer(conversation),))
+
+    def count(self, conversation):
+        return self.db.execute('SELECT COUNT(*) FROM message WHERE peer = ?', (self._peer(conversation),)).fetchone()[0]
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,481 @@
+import asyncio
+import fcntl
+import logging
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from utils.protocols import BINARY_CODEC
+from utils import metrics
+
+# 离线消息的持久化队列: 收件人不在线时, 私聊和 DH 请求 (仍然是端到端加密的内容) 追加到分段日志里, 下次登录时按顺序投递
+#   目录里是编号递增的段文件 0000000000000001.log ..., 只追加写入, 写满 segment_size 后换新段
+#   记录为 长度 (4) + CRC32 (4) + 类型 (1) + seq (8) + 时间戳 (8, double) + 用户名长度 (2) + 用户名 + 内容,
+#   CRC 覆盖长度之后的部分, 启动时只解析定长的头部, 不解码内容
+#     put  内容为二进制编码的 {type, data}
+#     ack  没有内容, 该用户 seq 及之前的消息都已投递
+#   seq 在整个目录内递增; 内存里只保存每个用户待投递消息的位置, 投递时再从文件读出
+#   写入由单独的线程完成, 上一次 fsync 期间到达的记录合并成一批写入并 fsync 一次 (group commit)
+#   过期 (ttl) 的消息在压缩时从索引删除, 最旧的段没有待投递消息时直接删除;
+#   空间放大过大时把最旧的段里剩下的消息原样复制到当前段, 然后删除最旧的段
+#   段只从最旧的开始删除, 保证 ack 记录不会早于它确认的 put 记录被删除
+# 启动时顺序扫描所有段重建索引, 最后一段末尾写了一半的记录会被截掉
+# 写入失败 (例如磁盘满) 时这一批和之后排队的记录都失败, 之后换新段写入, 失败的段末尾可能留下不完整的记录
+# 投递是至少一次: 推送之后、ack 落盘之前进程崩溃的话, 下次登录会重复收到这些消息
+
+SYNC_GROUP = 'group'  # 合并 fsync
+SYNC_EACH = 'each'  # 每条记录单独 fsync, 用于对比
+SYNC_NONE = 'none'  # 只写入页缓存, 由操作系统决定何时落盘
+SYNC_MODES = (SYNC_GROUP, SYNC_EACH, SYNC_NONE)
+
+MAX_BATCH = 4096  # 一批最多合并的记录数
+COMPACT_RATIO = 0.5  # 最旧的段里待投递的字节少于该比例, 或者所有段的总大小超过待投递字节的 1 / COMPACT_RATIO 倍时复制并删除它
+
+OP_PUT = 1
+OP_ACK = 2
+
+_header = struct.Struct('>II')  # 长度 (不含这 8 字节), CRC32
+_meta = struct.Struct('>BQdH')  # 类型, seq, 时间戳, 用户名长度
+
+logger = logging.getLogger(__name__)
+
+STORED = metrics.counter('chat_offline_stored_total', '保存的离线消息数')
+DELIVERED = metrics.counter('chat_offline_delivered_total', '已投递并确认的离线消息数')
+EXPIRED = metrics.counter('chat_offline_expired_total', '过期删除的离线消息数')
+REJECTED = metrics.counter('chat_offline_rejected_total', '因为超出配额被拒绝的离线消息数')
+RELOCATED = metrics.counter('chat_offline_relocated_total', '压缩时复制到新段的离线消息数')
+COMMIT_SECONDS = metrics.histogram('chat_offline_commit_seconds', '一批离线消息写入并 fsync 的时间')
+COMMIT_RECORDS = metrics.histogram('chat_offline_commit_records', '每批写入的记录数', buckets=metrics.SIZE_BUCKETS)
+
+
+class Record():
+    __slots__ = ('seq', 'segment', 'offset', 'length', 'timestamp')
+
+    def __init__(self, seq, segment, offset, length, timestamp):
+        self.seq = seq
+        self.segment = segment  # 段编号, 压缩复制后会改变
+        self.offset = offset
+        self.length = length  # 包括记录头
+        self.timestamp = timestamp
+
+
+class Segment():
+    __slots__ = ('id', 'size', 'records', 'live_bytes', 'readers')
+
+    def __init__(self, segment_id, size=0):
+        self.id = segment_id
+        self.size = size
+        self.records = set()  # 这个段里待投递的消息
+        self.live_bytes = 0
+        self.readers = 0  # 正在读取这个段的 fetch 数, 不为 0 时不删除
+
+
+class Mailbox():
+    __slots__ = ('records', 'bytes')
+
+    def __init__(self):
+        self.records = deque()  # 按 seq 排列
+        self.bytes = 0
+
+
+def encode_record(op, username, seq, timestamp=0.0, body=b''):
+    username = username.encode()
+    payload = _meta.pack(op, seq, timestamp, len(username)) + username + body
+    return _header.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_body(record):  # 完整的 put 记录 -> (seq, type, data)
+    _, seq, _, name_length = _meta.unpack_from(record, _header.size)
+    body = BINARY_CODEC.decode(record[_header.size + _meta.size + name_length:])
+    return seq, body['type'], body['data']
+
+
+def scan_records(data):  # 依次返回 (偏移, 长度, 类型, seq, 时间戳, 用户名), 遇到不完整或者校验失败的记录时停止
+    pos = 0
+    view = memoryview(data)
+    while pos + _header.size <= len(data):
+        length, crc = _header.unpack_from(data, pos)
+        start = pos + _header.size
+        end = start + length
+        if end > len(data) or length < _meta.size or zlib.crc32(view[start:end]) != crc:
+            return
+        op, seq, timestamp, name_length = _meta.unpack_from(data, start)
+        name = start + _meta.size
+        yield pos, end - pos, op, seq, timestamp, data[name:name + name_length].decode()
+        pos = end
+
+
+class OfflineStore():
+    def __init__(self, path, max_messages=1000, max_bytes=1024 * 1024, max_total_bytes=1024 * 1024 * 1024,
+                 ttl=7 * 24 * 3600, segment_size=16 * 1024 * 1024, sync=SYNC_GROUP, compact_interval=60):
+        if sync not in SYNC_MODES:
+            raise ValueError(f'未知的同步方式: {sync}')
+        self.path = path
+        self.max_messages = max_messages  # 每个用户的配额
+        self.max_bytes = max_bytes
+        self.max_total_bytes = max_total_bytes  # 所有用户待投递消息的总字节数上限
+        self.ttl = ttl
+        self.segment_size = segment_size
+        self.sync = sync
+        self.compact_interval = compact_interval
+
+        self.mailboxes = dict()  # 用户名 -> Mailbox, 没有待投递消息的用户不在这里
+        self.segments = dict()  # 段编号 -> Segment, 按编号从小到大插入
+        self.active = None  # 正在写入的段
+        self.next_seq = 1
+        self.messages = 0
+        self.bytes = 0
+
+        self.commits = 0
+        self.committed_records = 0
+        self.expired = 0
+        self.relocated = 0
+
+        self._loop = asyncio.get_event_loop()
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='offline-write')
+        self._reader = ThreadPoolExecutor(2, thread_name_prefix='offline-read')
+        self._pending = []  # 等待写入的 (段编号, 记录, future)
+        self._last = None  # 最近一条记录的 future
+        self._writing = False
+        self._fds = dict()  # 段编号 -> 写入用的文件描述符, 只在写线程里使用
+        self._lock = None
+        self._task = None
+
+    def open(self):  # 启动时调用一次, 扫描所有段重建索引
+        os.makedirs(self.path, exist_ok=True)
+        self._lock = open(os.path.join(self.path, 'LOCK'), 'w')
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise RuntimeError(f'离线消息目录 {self.path} 正在被其他进程使用')
+
+        start = time.perf_counter()
+        puts = dict()  # 用户名 -> {seq: Record}
+        acks = dict()  # 用户名 -> 已确认的最大 seq
+        names = sorted(name for name in os.listdir(self.path) if name.endswith('.log'))
+        for i, name in enumerate(names):
+            segment_id = int(name[:-4])
+            with open(os.path.join(self.path, name), 'rb') as f:
+                data = f.read()
+            end = 0
+            for offset, length, op, seq, timestamp, username in scan_records(data):
+                end = offset + length
+                if op == OP_PUT:  # 压缩复制过的记录以后出现的位置为准
+                    puts.setdefault(username, dict())[seq] = Record(seq, segment_id, offset, length, timestamp)
+                elif seq > acks.get(username, 0):
+                    acks[username] = seq
+                self.next_seq = max(self.next_seq, seq + 1)
+            if end < len(data):
+                if i == len(names) - 1:
+                    logger.warning(f'离线消息段 {name} 末尾有 {len(data) - end} 字节不完整的记录, 截断')
+                    os.truncate(os.path.join(self.path, name), end)
+                else:
+                    logger.error(f'离线消息段 {name} 在偏移 {end} 处损坏, 忽略之后的记录')
+            self.segments[segment_id] = Segment(segment_id, end)
+
+        deadline = time.time() - self.ttl
+        for username, records in puts.items():
+            acked = acks.get(username, 0)
+            live = [records[seq] for seq in sorted(records) if seq > acked and records[seq].timestamp > deadline]
+            for record in live:
+                self._add(username, record)
+
+        if self.segments:
+            self.active = self.segments[max(self.segments)]
+        else:
+            self.active = self.segments[1] = Segment(1)
+        logger.info(f'离线消息: {len(self.segments)} 段, {len(self.mailboxes)} 个用户的 {self.messages} 条消息, '
+                    f'扫描用时 {time.perf_counter() - start:.2f} 秒')
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._compact_forever())
+
+    def _add(self, username, record):
+        mailbox = self.mailboxes.get(username)
+        if mailbox is None:
+            mailbox = self.mailboxes[username] = Mailbox()
+        mailbox.records.append(record)
+        mailbox.bytes += record.length
+        segment = self.segments[record.segment]
+        segment.records.add(record)
+        segment.live_bytes += record.length
+        self.messages += 1
+        self.bytes += record.length
+
+    def _remove(self, mailbox, record):
+        mailbox.bytes -= record.length
+        segment = self.segments[record.segment]
+        segment.records.discard(record)
+        segment.live_bytes -= record.length
+        self.messages -= 1
+        self.bytes -= record.length
+
+    def count(self, username):
+        mailbox = self.mailboxes.get(username)
+        return len(mailbox.records) if mailbox is not None else 0
+
+    async def put(self, username, req_type, data):  # 落盘之后返回 True, 超出配额时返回 False
+        now = time.time()
+        seq = self.next_seq
+        record = encode_record(OP_PUT, username, seq, now, BINARY_CODEC.encode({'type': req_type, 'data': data}))
+        mailbox = self.mailboxes.get(username)
+        count, size = (len(mailbox.records), mailbox.bytes) if mailbox is not None else (0, 0)
+        if count >= self.max_messages or size + len(record) > self.max_bytes or \
+                self.bytes + len(record) > self.max_total_bytes:
+            REJECTED.inc()
+            return False
+        self.next_seq += 1
+        segment_id, offset, future = self._append(record)
+        record = Record(seq, segment_id, offset, len(record), now)
+        self._add(username, record)  # 先加入索引, 配额检查包括正在写入的消息
+        try:
+            await future
+        except Exception:
+            mailbox = self.mailboxes.get(username)  # 没有写入的记录不能留在索引里
+            if mailbox is not None and record in mailbox.records:
+                mailbox.records.remove(record)
+                self._remove(mailbox, record)
+                if not mailbox.records:
+                    del self.mailboxes[username]
+            raise
+        STORED.inc()
+        return True
+
+    async def fetch(self, username, limit=256):  # 最早的 limit 条待投递消息 [(seq, type, data)]
+        mailbox = self.mailboxes.get(username)
+        if mailbox is None:
+            return []
+        records = list(islice(mailbox.records, limit))
+        if self._last is not None and not self._last.done():
+            await asyncio.shield(self._last)  # 等这些记录写入文件
+        segments = {record.segment for record in records}
+        for segment_id in segments:
+            self.segments[segment_id].readers += 1
+        try:
+            locations = [(record.segment, record.offset, record.length) for record in records]
+            return await self._loop.run_in_executor(self._reader, self._read, locations)
+        finally:
+            for segment_id in segments:
+                self.segments[segment_id].readers -= 1
+
+    def _read(self, locations):
+        fds = dict()
+        try:
+            messages = []
+            for segment_id, offset, length in locations:
+                fd = fds.get(segment_id)
+                if fd is None:
+                    fd = fds[segment_id] = os.open(self._segment_path(segment_id), os.O_RDONLY)
+                messages.append(decode_body(os.pread(fd, length, offset)))
+            return messages
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+
+    def ack(self, username, seq):  # seq 及之前的消息已经投递
+        mailbox = self.mailboxes.get(username)
+        if mailbox is None:
+            return
+        records = mailbox.records
+        count = 0
+        while records and records[0].seq <= seq:
+            self._remove(mailbox, records.popleft())
+            count += 1
+        if not records:
+            del self.mailboxes[username]
+        DELIVERED.inc(count)
+        future = self._append(encode_record(OP_ACK, username, seq))[2]
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())  # 写入失败已经记录过日志
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.path, f'{segment_id:016d}.log')
+
+    def _append(self, record):  # 分配位置并排队写入, 返回 (段编号, 偏移, future)
+        if self.active.size > 0 and self.active.size + len(record) > self.segment_size:
+            segment_id = self.active.id + 1
+            self.active = self.segments[segment_id] = Segment(segment_id)
+        offset = self.active.size
+        self.active.size += len(record)
+        if self.sync == SYNC_EACH or not self._pending or len(self._pending) % MAX_BATCH == 0:
+            future = self._loop.create_future()
+        else:
+            future = self._pending[-1][2]  # 与前一条记录在同一批里写入
+        self._pending.append((self.active.id, record, future))
+        self._last = future
+        self._kick()
+        return self.active.id, offset, future
+
+    def _kick(self):
+        if self._writing or not self._pending:
+            return
+        size = 1 if self.sync == SYNC_EACH else MAX_BATCH
+        batch, self._pending = self._pending[:size], self._pending[size:]
+        self._writing = True
+        asyncio.ensure_future(self._commit(batch))
+
+    async def _commit(self, batch):
+        start = time.perf_counter()
+        try:
+            await self._loop.run_in_executor(self._writer, self._write, batch)
+        except Exception as e:
+            logger.exception('写入离线消息失败')
+            error = e
+        else:
+            error = None
+        COMMIT_SECONDS.observe(time.perf_counter() - start)
+        COMMIT_RECORDS.observe(len(batch))
+        self.commits += 1
+        self.committed_records += len(batch)
+        if error is not None:
+            # 段文件末尾可能留下写了一半的记录, 排队的记录按写入成功分配的偏移都对不上: 一起失败, 之后写入新的段
+            batch, self._pending = batch + self._pending, []
+            segment_id = self.active.id + 1
+            self.active = self.segments[segment_id] = Segment(segment_id)
+        for future in {id(future): future for _, _, future in batch}.values():
+            if not future.done():
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+        self._writing = False
+        self._kick()
+
+    def _write(self, batch):  # 在写线程里执行
+        created = False
+        touched = []
+        i = 0
+        while i < len(batch):
+            segment_id = batch[i][0]
+            j = i
+            while j < len(batch) and batch[j][0] == segment_id:
+                j += 1
+            fd = self._fds.get(segment_id)
+            if fd is None:
+                path = self._segment_path(segment_id)
+                created = created or not os.path.exists(path)
+                fd = self._fds[segment_id] = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            data = memoryview(b''.join(record for _, record, _ in batch[i:j]))
+            while data:
+                data = data[os.write(fd, data):]
+            touched.append(fd)
+            i = j
+        if self.sync != SYNC_NONE:
+            for fd in touched:
+                os.fdatasync(fd)
+            if created:
+                dir_fd = os.open(self.path, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)  # 新建的段文件本身也要落盘
+                finally:
+                    os.close(dir_fd)
+        last = batch[-1][0]
+        for segment_id in [segment_id for segment_id in self._fds if segment_id < last]:
+            os.close(self._fds.pop(segment_id))  # 之前的段已经写满
+
+    async def flush(self):  # 等待已经排队的记录全部写入
+        if self._last is not None and not self._last.done():
+            await asyncio.shield(self._last)
+
+    def expire(self):
+        deadline = time.time() - self.ttl
+        for username in list(self.mailboxes):
+            mailbox = self.mailboxes[username]
+            records = mailbox.records
+            while records and records[0].timestamp <= deadline:
+                self._remove(mailbox, records.popleft())
+                self.expired += 1
+                EXPIRED.inc()
+            if not records:
+                del self.mailboxes[username]
+
+    async def compact(self):
+        self.expire()
+        stop = self.active.id  # 只处理压缩开始时已经写满的段, 不再复制本次复制出来的消息
+        while True:
+            head = self.segments[min(self.segments)]
+            if head.id >= stop or head.readers:
+                return
+            if head.records:
+                disk = sum(segment.size for segment in self.segments.values())
+                if head.live_bytes >= head.size * COMPACT_RATIO and self.bytes >= disk * COMPACT_RATIO:
+                    return
+                await self._relocate(head)
+                if head.records or head.readers:
+                    return  # 复制期间又有读取, 下次再试
+            del self.segments[head.id]
+            await self._loop.run_in_executor(self._writer, os.remove, self._segment_path(head.id))
+
+    async def _relocate(self, segment):  # 把段里待投递的消息原样追加到当前段
+        records = sorted(segment.records, key=lambda record: record.offset)
+        locations = [(segment.id, record.offset, record.length) for record in records]
+        data = await self._loop.run_in_executor(self._reader, self._read_raw, locations)
+        futures = dict()
+        moved = []
+        for record, raw in zip(records, data):
+            if record.segment != segment.id or record not in segment.records:
+                continue  # 读取期间已经投递或者过期
+            moved.append((record, record.offset))
+            segment_id, offset, future = self._append(raw)
+            futures[id(future)] = future
+            self._move(record, segment_id, offset)
+            self.relocated += 1
+            RELOCATED.inc()
+        if futures:
+            try:
+                await asyncio.gather(*futures.values())  # 副本全部落盘之后才能删除原来的段
+            except Exception:
+                for record, offset in moved:  # 副本没有写入, 还在索引里的消息指回原来的位置
+                    if record in self.segments[record.segment].records:
+                        self._move(record, segment.id, offset)
+                raise
+
+    def _move(self, record, segment_id, offset):
+        old = self.segments[record.segment]
+        old.records.discard(record)
+        old.live_bytes -= record.length
+        record.segment, record.offset = segment_id, offset
+        new = self.segments[segment_id]
+        new.records.add(record)
+        new.live_bytes += record.length
+
+    def _read_raw(self, locations):
+        with open(self._segment_path(locations[0][0]), 'rb') as f:
+            return [os.pread(f.fileno(), length, offset) for _, offset, length in locations]
+
+    async def _compact_forever(self):
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                await self.compact()
+            except Exception:
+                logger.exception('压缩离线消息失败')
+
+    def stats(self):
+        return {
+            'users': len(self.mailboxes),
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'segments': len(self.segments),
+            'disk_bytes': sum(segment.size for segment in self.segments.values()),
+            'commits': self.commits,
+            'records_per_commit': self.committed_records / self.commits if self.commits else 0,
+            'expired': self.expired,
+            'relocated': self.relocated
+        }
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._writer.submit(self._close_fds).result()
+        self._writer.shutdown(wait=True)
+        self._reader.shutdown(wait=True)
+        if self._lock is not None:
+            self._lock.close()
+
+    def _close_fds(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
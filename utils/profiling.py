@@ -0,0 +1,135 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# 运行时可以开关的分析工具, 服务器通过管理接口或者信号使用:
+#   SamplingProfiler  后台线程定期采样所有线程的调用栈, 输出 flamegraph.pl / speedscope 可以直接读取的折叠栈
+#   tracemalloc       统计分配最多的代码位置
+#   CpuTimed          包装一个协程, 只累计它自己每一步占用的线程 CPU 时间, 用于按请求类型统计处理函数的 CPU
+# 握手进程池里的 RSA/DH 运算在其他进程中, 不会出现在采样里
+
+
+class SamplingProfiler():
+    # 采样线程需要拿到 GIL, 事件循环长时间不释放 GIL 时采样会推迟, 但不会漏掉那段调用栈
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()  # 折叠栈 -> 采样次数
+        self.samples = 0
+        self.started = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    self.stacks[self.fold(names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+
+    @staticmethod
+    def fold(thread_name, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        names.append(thread_name)
+        return ';'.join(reversed(names))
+
+    def folded(self):  # 每行 "线程;最外层函数;...;最内层函数 次数"
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def status(self):
+        return {
+            'running': self.running,
+            'interval': self.interval,
+            'samples': self.samples,
+            'stacks': len(self.stacks),
+            'seconds': time.time() - self.started if self.started else 0
+        }
+
+
+def start_tracemalloc(frames=1):
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    tracemalloc.start(frames)
+
+
+def stop_tracemalloc():
+    tracemalloc.stop()
+
+
+def top_allocations(limit=30, key='lineno'):  # key 为 lineno, filename 或 traceback
+    if not tracemalloc.is_tracing():
+        return 'tracemalloc 没有开启\n'
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+    ))
+    statistics = snapshot.statistics(key)
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f'traced {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB, '
+             f'{len(statistics)} sites, top {min(limit, len(statistics))}']
+    for stat in statistics[:limit]:
+        frames = list(reversed(stat.traceback))  # Traceback 从最外层排到最内层, 这里先输出分配发生的位置
+        lines.append(f'{stat.size / 1024:>10.1f} KiB {stat.count:>8} blocks  {frames[0]}')
+        if key == 'traceback':
+            lines.extend(f'{"":>30}{frame}' for frame in frames[1:])
+    return '\n'.join(lines) + '\n'
+
+
+class CpuTimed():
+    # await CpuTimed(coro) 与 await coro 相同, 结束后 cpu 为协程自己各步占用的线程 CPU 秒数,
+    # 不包含等待 (数据库, 进程池) 期间事件循环运行其他任务的时间
+    __slots__ = ('coro', 'cpu')
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.cpu = 0.0
+
+    def __await__(self):
+        send = self.coro.send
+        throw = self.coro.throw
+        value = None
+        error = None
+        while True:
+            start = time.thread_time()
+            try:
+                future = send(value) if error is None else throw(error)
+            except StopIteration as e:  # 协程返回
+                self.cpu += time.thread_time() - start
+                return e.value
+            except BaseException:
+                self.cpu += time.thread_time() - start
+                raise
+            self.cpu += time.thread_time() - start
+            try:
+                value = yield future
+                error = None
+            except BaseException as e:  # 取消等异常传给被包装的协程
+                value = None
+                error = e
@@ -1,4 +1,6 @@
-from struct import unpack, pack
+from struct import unpack, Struct
+from base64 import b64encode, b64decode
+import time
 import zlib
 import json
 from utils.tools import sha3_256, random_string
@@ -9,15 +11,42 @@ from cryptography.hazmat.primitives import padding
 
 cryptography_backend = default_backend()
 
+PROTOCOL_VERSION = 5  # 1: 握手请求里没有 version 字段的旧客户端, 2: 可协商密钥交换方式, 3: 响应带回请求的 id,
+#                      4: 在线状态合并成带版本号的 presence 批量推送, 5: 登录时推送公共聊天历史, 可以向前翻页
+COUNT_MASK = 0xFFFFFFFFFFFFFFFF  # 计数器为 64 位, 溢出后回到 0
+_nonce_struct = Struct('>Q')
+_length_struct = Struct('>I')
+_double_struct = Struct('>d')
 
-def encrypt_aes_gcm(data, count, key):
-    aes_gcm = AESGCM(key)
-    return aes_gcm.encrypt(pack('>Q', count), data, None)
 
+class SessionCipher():
+    # 一个连接的 AES-GCM 会话状态: 密钥只初始化一次, 两个方向的计数器作为 nonce
+    send_count: int
+    recv_count: int
 
-def decrypt_aes_gcm(data, count, key):
-    aes_gcm = AESGCM(key)
-    return aes_gcm.decrypt(pack('>Q', count), data, None)
+    def __init__(self, key, send_count, recv_count):
+        aes_gcm = AESGCM(key)
+        self._encrypt = aes_gcm.encrypt
+        self._decrypt = aes_gcm.decrypt
+        self.send_count = send_count & COUNT_MASK
+        self.recv_count = recv_count & COUNT_MASK
+        self._send_nonce = bytearray(8)
+        self._recv_nonce = bytearray(8)
+
+    def seal(self, data):
+        _nonce_struct.pack_into(self._send_nonce, 0, self.send_count)
+        self.send_count = (self.send_count + 1) & COUNT_MASK
+        return self._encrypt(self._send_nonce, data, None)
+
+    def open(self, data):
+        _nonce_struct.pack_into(self._recv_nonce, 0, self.recv_count)
+        data = self._decrypt(self._recv_nonce, data, None)
+        self.recv_count = (self.recv_count + 1) & COUNT_MASK  # 解密失败时不推进计数器
+        return data
+
+    def seal_frame(self, data):
+        data = self.seal(data)
+        return _length_struct.pack(len(data)) + data
 
 
 def encrypt_aes_cbc(data, key):
@@ -44,33 +73,324 @@ def decrypt_aes_cbc(iv, ciphertext, key):
     return unpadded_data
 
 
+# 帧内容的编码格式, 在握手时协商 (握手帧本身总是 JSON):
+#   json    原来的格式, bytes 字段编码成 base64 字符串
+#   binary  带类型标记的二进制格式, bytes 字段直接保存, 长度和整数使用 varint
+# 两种格式解码出的 bytes 字段分别是 str (base64) 和 bytes, 使用者通过 as_bytes 统一处理
+
+# 二进制格式中用编号代替的常用字符串 (字段名和取值), 只能在末尾追加
+SYMBOLS = (
+    'type', 'data', 'timestamp', 'success', 'msg', 'from', 'message', 'username', 'iv', 'ciphertext',
+    'dh_public', 'init', 'sign', 'challenge', 'pubkey', 'send_user', 'send_everyone', 'dh_request', 'list',
+    'online', 'offline', 'kicked', 'register', 'get_challenge', 'login', 'send_everyone_info',
+    'send_user_info', 'dh_request_info', 'op', 'worker', 'broadcast', 'id',
+    'presence', 'version', 'since', 'full',
+    'history', 'records', 'first', 'before', 'limit', 'more', 'seq'
+)
+SYMBOL_IDS = {symbol: i for i, symbol in enumerate(SYMBOLS)}
+
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _BYTES, _LIST, _DICT, _SYMBOL, _BIGINT = range(11)
+_VARINT_MAX = 1 << 64  # 更大的整数 (例如 DH 公钥) 按 varint 长度 + 大端字节保存
+
+
+def as_bytes(value):  # bytes 字段: 二进制格式为 bytes, JSON 格式为 base64 字符串
+    if isinstance(value, str):
+        return b64decode(value)
+    return bytes(value)
+
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return b64encode(value).decode('utf-8')
+    raise TypeError(f'无法编码 {type(value).__name__}')
+
+
+class JsonCodec():
+    name = 'json'
+
+    def encode(self, data):
+        return json.dumps(data, default=_json_default).encode()
+
+    def decode(self, data):
+        return json.loads(bytes(data).decode('utf-8'))
+
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    value = data[pos]
+    pos += 1
+    if value < 0x80:
+        return value, pos
+    value &= 0x7F
+    shift = 7
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class BinaryCodec():
+    # 每个值以 1 字节类型标记开头; 整数为 zigzag 编码的 varint (超过 64 位时为定长字节), 字符串/bytes 为 varint 长度 + 内容,
+    # 字典的键为 varint: 奇数表示 SYMBOLS 中的编号, 偶数表示后面跟着的 UTF-8 键的长度
+    name = 'binary'
+
+    def encode(self, data):
+        out = bytearray()
+        self._encode(data, out)
+        return bytes(out)
+
+    def _encode(self, value, out):
+        value_type = type(value)
+        if value_type is str:
+            symbol = SYMBOL_IDS.get(value)
+            if symbol is not None:
+                out.append(_SYMBOL)
+                _write_varint(out, symbol)
+            else:
+                value = value.encode()
+                out.append(_STR)
+                _write_varint(out, len(value))
+                out += value
+        elif value_type is dict:
+            out.append(_DICT)
+            _write_varint(out, len(value))
+            for key, item in value.items():
+                symbol = SYMBOL_IDS.get(key)
+                if symbol is not None:
+                    _write_varint(out, symbol * 2 + 1)
+                else:
+                    key = key.encode()
+                    _write_varint(out, len(key) * 2)
+                    out += key
+                self._encode(item, out)
+        elif value_type is bool:
+            out.append(_TRUE if value else _FALSE)
+        elif value_type is int:
+            value = value << 1 if value >= 0 else (-value << 1) - 1
+            if value < _VARINT_MAX:
+                out.append(_INT)
+                _write_varint(out, value)
+            else:
+                value = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+                out.append(_BIGINT)
+                _write_varint(out, len(value))
+                out += value
+        elif value_type is float:
+            out.append(_FLOAT)
+            out += _double_struct.pack(value)
+        elif value is None:
+            out.append(_NONE)
+        elif value_type in (bytes, bytearray, memoryview):
+            out.append(_BYTES)
+            _write_varint(out, len(value))
+            out += value
+        elif value_type in (list, tuple):
+            out.append(_LIST)
+            _write_varint(out, len(value))
+            for item in value:
+                self._encode(item, out)
+        else:
+            raise TypeError(f'无法编码 {value_type.__name__}')
+
+    def decode(self, data):
+        if type(data) is not bytes:
+            data = bytes(data)
+        value, pos = self._decode(data, 0)
+        if pos != len(data):
+            raise ValueError('帧末尾有多余的数据')
+        return value
+
+    def _decode(self, data, pos):
+        tag = data[pos]
+        pos += 1
+        if tag == _SYMBOL:
+            symbol, pos = _read_varint(data, pos)
+            return SYMBOLS[symbol], pos
+        elif tag == _STR:
+            length, pos = _read_varint(data, pos)
+            return data[pos:pos + length].decode('utf-8'), pos + length
+        elif tag == _DICT:
+            count, pos = _read_varint(data, pos)
+            value = {}
+            for _ in range(count):
+                key, pos = _read_varint(data, pos)
+                if key & 1:
+                    key = SYMBOLS[key >> 1]
+                else:
+                    end = pos + (key >> 1)
+                    key, pos = data[pos:end].decode('utf-8'), end
+                value[key], pos = self._decode(data, pos)
+            return value, pos
+        elif tag == _INT or tag == _BIGINT:
+            if tag == _INT:
+                value, pos = _read_varint(data, pos)
+            else:
+                length, pos = _read_varint(data, pos)
+                value, pos = int.from_bytes(data[pos:pos + length], 'big'), pos + length
+            return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+        elif tag == _BYTES:
+            length, pos = _read_varint(data, pos)
+            if pos + length > len(data):
+                raise ValueError('bytes 字段超出帧长度')
+            return data[pos:pos + length], pos + length
+        elif tag == _FLOAT:
+            return _double_struct.unpack_from(data, pos)[0], pos + 8
+        elif tag == _TRUE:
+            return True, pos
+        elif tag == _FALSE:
+            return False, pos
+        elif tag == _NONE:
+            return None, pos
+        elif tag == _LIST:
+            count, pos = _read_varint(data, pos)
+            value = []
+            for _ in range(count):
+                item, pos = self._decode(data, pos)
+                value.append(item)
+            return value, pos
+        raise ValueError(f'未知的类型标记 {tag}')
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+CODECS = {codec.name: codec for codec in (BINARY_CODEC, JSON_CODEC)}
+WIRE_FORMATS = tuple(CODECS)  # 客户端的偏好顺序
+
+
+def negotiate_wire(offered):  # 旧客户端不带 wire 字段, 使用 JSON
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return JSON_CODEC
+
+
+# 握手时协商的逐连接压缩: 每个方向一个跨帧保留历史的 deflate 流, 在加密之前压缩,
+# 每帧开头 1 字节标记是否压缩, 短于阈值的帧不压缩
+COMPRESS_ZLIB = 'zlib'
+COMPRESSIONS = (COMPRESS_ZLIB,)
+ZLIB_WBITS = 12  # 双方都使用 4KB 的窗口, 每个连接的压缩和解压状态只占几十 KB
+ZLIB_MEM_LEVEL = 5
+_RAW_FRAME = b'\x00'
+_DEFLATE_FRAME = b'\x01'
+
+
+def negotiate_compression(offered, supported=COMPRESSIONS):  # 旧客户端不带 compress 字段, 不压缩
+    for name in offered or ():
+        if name in supported:
+            return name
+    return None
+
+
+class FrameCompressor():
+    # 一个方向的压缩: 每帧以 Z_SYNC_FLUSH 结束, 接收方收到一帧就能完整解出, 之后的帧仍然可以引用之前的内容
+    def __init__(self, level=6, threshold=32):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -ZLIB_WBITS, ZLIB_MEM_LEVEL)
+        self.threshold = threshold
+        self.frames = 0
+        self.compressed_frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+
+    def compress(self, data):
+        self.frames += 1
+        self.bytes_in += len(data)
+        if len(data) < self.threshold:
+            self.bytes_out += len(data) + 1
+            return _RAW_FRAME + data
+        start = time.perf_counter()
+        data = _DEFLATE_FRAME + self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.cpu_time += time.perf_counter() - start
+        self.compressed_frames += 1
+        self.bytes_out += len(data)
+        return data
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'compressed_frames': self.compressed_frames,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'ratio': self.bytes_out / self.bytes_in if self.bytes_in else 1.0,
+            'cpu_time': self.cpu_time
+        }
+
+
+class FrameDecompressor():
+    # 解压后的帧超过 max_size 时报错 (连接随之断开), 不会为压缩炸弹分配内存
+    def __init__(self, max_size=1024 * 1024):
+        self._decompressor = zlib.decompressobj(-ZLIB_WBITS)
+        self.max_size = max_size
+        self.frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+
+    def decompress(self, data):
+        self.frames += 1
+        self.bytes_in += len(data)
+        flag, data = data[:1], data[1:]
+        if flag == _DEFLATE_FRAME:
+            start = time.perf_counter()
+            data = self._decompressor.decompress(data, self.max_size)
+            self.cpu_time += time.perf_counter() - start
+            if self._decompressor.unconsumed_tail:
+                raise ValueError(f'解压后的帧超过 {self.max_size} 字节')
+        elif flag != _RAW_FRAME:
+            raise ValueError('未知的压缩标记')
+        self.bytes_out += len(data)
+        return data
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'cpu_time': self.cpu_time
+        }
+
+
 def read_length(data):
     return unpack('>I', data)[0]
 
 
-def unpack_data(data):
-    #data = zlib.decompress(data)
-    return json.loads(data.decode('utf-8'))
+def unpack_data(data, codec=JSON_CODEC):
+    return codec.decode(data)
+
+
+def unpack_enc_data(data, cipher, codec=JSON_CODEC, decompressor=None):
+    data = cipher.open(data)
+    if decompressor is not None:
+        data = decompressor.decompress(data)
+    return codec.decode(data)
+
+
+def pack_data(data, codec=JSON_CODEC):
+    data = codec.encode(data)
+    return _length_struct.pack(len(data)) + data
 
 
-def unpack_enc_data(data, count, key):
-    data = decrypt_aes_gcm(data, count, key)
-    #data = zlib.decompress(data)
-    return json.loads(data.decode('utf-8'))
+def pack_enc_data(data, cipher, codec=JSON_CODEC, compressor=None):
+    data = codec.encode(data)
+    if compressor is not None:
+        data = compressor.compress(data)
+    return cipher.seal_frame(data)
 
 
-def pack_data(data):
-    data = json.dumps(data).encode()
-    #data = zlib.compress(data)
-    length = len(data)
-    length = pack('>I', length)
-    return length + data
+def encode_data(data, codec=JSON_CODEC):
+    return codec.encode(data)
 
 
-def pack_enc_data(data, count, key):
-    data = json.dumps(data).encode()
-    #data = zlib.compress(data)
-    data = encrypt_aes_gcm(data, count, key)
-    length = len(data)
-    length = pack('>I', length)
-    return length + data
+def pack_enc_raw(data, cipher, compressor=None):  # data 为已经序列化的明文
+    if compressor is not None:
+        data = compressor.compress(data)
+    return cipher.seal_frame(data)
@@ -1,11 +1,12 @@
-import rsa
 import hashlib
 import random
 import string
 
 def vaild_public_key(key):
+    from utils import crypto  # utils.crypto 依赖本模块的 DH
+
     try:
-        rsa.PublicKey.load_pkcs1(key)
+        crypto.load_public_key(key)
     except Exception:
         return False
     return True
@@ -45,3 +46,33 @@ class DH():
     def dh_get_common_key(self, private, other_public):
         key = pow(other_public, private, self.DH_PRIME)
         return int.to_bytes(key, 256, 'big')
+
+    def dh_get_common_key_raw(self, private, public, other_public):  # private 为整数形式的指数, public 为对应的公钥
+        return DH.dh_get_common_key(self, private, other_public)
+
+
+class FixedBasePow():
+    # 底数固定时的窗口法模幂: 预先计算 base^(d * 2^(window * i)), 求幂时每个窗口只需要一次查表和一次模乘
+    def __init__(self, base, modulus, bits, window=8):
+        self.modulus = modulus
+        self.bits = bits
+        self.window = window
+        self.mask = (1 << window) - 1
+        self.table = []
+        for _ in range((bits + window - 1) // window):
+            row = [1]
+            for _ in range(self.mask):
+                row.append(row[-1] * base % modulus)
+            self.table.append(row)
+            base = row[-1] * base % modulus  # base^(2^window)
+
+    def pow(self, exponent):
+        if exponent < 0 or exponent.bit_length() > self.bits:
+            raise ValueError(f'指数超过 {self.bits} 位')
+        result = 1
+        for row in self.table:
+            digit = exponent & self.mask
+            if digit:
+                result = result * row[digit] % self.modulus
+            exponent >>= self.window
+        return result
@@ -0,0 +1,130 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from utils.model import User, SQLAlchemy
+from utils import crypto
+from utils.tools import sha3_256
+
+
+class PublicKeyCache():
+    # 用户名 -> 已解析的公钥对象的有界 LRU 缓存, 只在事件循环线程里访问
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.keys = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        public_key = self.keys.get(username)
+        if public_key is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.keys.move_to_end(username)
+        return public_key
+
+    def put(self, username, public_key):
+        if self.max_size <= 0:
+            return
+        self.keys[username] = public_key
+        self.keys.move_to_end(username)
+        if len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+
+    def invalidate(self, username):
+        self.keys.pop(username, None)
+
+    def stats(self):
+        return {'size': len(self.keys), 'hits': self.hits, 'misses': self.misses}
+
+
+class UserStore():
+    # 用户表的异步接口: 所有 SQLAlchemy 调用都在有界线程池里执行, 不阻塞事件循环
+    cache: PublicKeyCache
+
+    def __init__(self, url, max_workers=4, cache_size=10000):
+        connect_args = {}
+        if url.startswith('sqlite'):
+            connect_args['check_same_thread'] = False  # 连接由连接池在工作线程之间复用
+        self.engine = create_engine(url, poolclass=QueuePool, pool_size=max_workers, max_overflow=0,
+                                    connect_args=connect_args)
+        if url.startswith('sqlite'):
+            event.listen(self.engine, 'connect', self._sqlite_pragma)
+        try:
+            SQLAlchemy.metadata.create_all(self.engine)
+        except OperationalError:
+            SQLAlchemy.metadata.create_all(self.engine)  # 多个工作进程/节点同时建表, 另一个进程已经建好
+
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='user-store')
+        self.cache = PublicKeyCache(cache_size)
+
+    @staticmethod
+    def _sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')  # 读写互不阻塞
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _get_public_key(self, username):
+        with self.Session() as session:
+            public_key = session.query(User.public_key).filter_by(username=username).scalar()
+        if public_key is not None:
+            public_key = crypto.load_public_key(public_key)  # 在工作线程里解析
+        return public_key
+
+    def _add_user(self, username, public_key):
+        with self.Session() as session:
+            u = User()
+            u.username = username
+            u.public_key = public_key
+            u.key_hash = sha3_256(public_key)
+            session.add(u)
+            try:
+                session.commit()
+            except IntegrityError:  # 用户名已存在, 由唯一索引保证
+                session.rollback()
+                return False
+        return True
+
+    def _set_public_key(self, username, public_key):
+        with self.Session() as session:
+            u = session.query(User).filter_by(username=username).one_or_none()
+            if u is None:
+                return False
+            u.public_key = public_key
+            u.key_hash = sha3_256(public_key)
+            session.commit()
+        return True
+
+    async def get_public_key(self, username):  # 返回公钥对象, 用户不存在时返回 None
+        public_key = self.cache.get(username)
+        if public_key is None:
+            public_key = await self._run(self._get_public_key, username)
+            if public_key is not None:
+                self.cache.put(username, public_key)
+        return public_key
+
+    async def add_user(self, username, public_key):  # 注册成功返回 True, 同名用户已存在返回 False
+        ret = await self._run(self._add_user, username, public_key)
+        if ret:
+            self.cache.put(username, crypto.load_public_key(public_key))
+        return ret
+
+    async def set_public_key(self, username, public_key):  # 更换公钥, 同时使缓存失效
+        self.cache.invalidate(username)
+        ret = await self._run(self._set_public_key, username, public_key)
+        self.cache.invalidate(username)  # 等待期间可能有登录把旧公钥放回缓存
+        return ret
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.engine.dispose()